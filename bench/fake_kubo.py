@@ -0,0 +1,185 @@
+"""In-process fake of the Kubo /api/v0 RPC endpoints server3 uses (ls, files/stat, resolve,
+cat, add, routing/provide), for the scripts in this directory. Not a real node: CIDs are
+hashes of the bytes and directories are plain (name, cid) lists."""
+import hashlib
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+class FakeKubo:
+    def __init__(self):
+        self.files = {}    # cid -> bytes
+        self.dirs = {}     # cid -> [(name, cid)]
+        self.calls = []    # (command, args, params)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, command):
+        with self.lock:
+            return sum(1 for call in self.calls if call[0] == command)
+
+    def add_file(self, data):
+        cid = 'bafk' + hashlib.sha256(data).hexdigest()[:40]
+        self.files[cid] = data
+        return cid
+
+    def add_dir(self, children):
+        cid = 'bafy' + hashlib.sha256(repr(children).encode()).hexdigest()[:40]
+        self.dirs[cid] = list(children)
+        return cid
+
+    def size(self, cid):
+        if cid in self.files:
+            return len(self.files[cid])
+        return sum(self.size(child) for _, child in self.dirs.get(cid, []))
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, status=200, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, obj, status=200):
+                self._send(json.dumps(obj).encode(), status)
+
+            def _error(self, message):
+                self._json({"Message": message, "Code": 0, "Type": "error"}, 500)
+
+            def _body(self):
+                if self.headers.get('Content-Length'):
+                    return self.rfile.read(int(self.headers['Content-Length']))
+                body = bytearray()
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return bytes(body)
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return bytes(body)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                command = url.path[len('/api/v0/'):]
+                args = [arg.replace('/ipfs/', '', 1) for arg in query.get('arg', [])]
+                with node.lock:
+                    node.calls.append((command, args, {k: v[0] for k, v in query.items() if k != 'arg'}))
+                body = self._body()
+                handler = getattr(self, 'cmd_' + command.replace('/', '_'), None)
+                if handler is None:
+                    return self._error('unknown command ' + command)
+                handler(args, query, body)
+
+            def _link(self, name, cid):
+                return {"Name": name, "Hash": cid, "Size": node.size(cid),
+                        "Type": 1 if cid in node.dirs else 2, "Target": ""}
+
+            def cmd_ls(self, args, query, body):
+                cid = args[0]
+                if cid not in node.dirs and cid not in node.files:
+                    return self._error('not found')
+                links = [self._link(name, child) for name, child in node.dirs.get(cid, [])]
+                if query.get('stream'):
+                    lines = [json.dumps({"Objects": [{"Hash": cid, "Links": [link]}]}) for link in links]
+                    return self._send(''.join(line + '\n' for line in lines).encode())
+                self._json({"Objects": [{"Hash": cid, "Links": links}]})
+
+            def cmd_files_stat(self, args, query, body):
+                cid = args[0]
+                if cid not in node.dirs and cid not in node.files:
+                    return self._error('not found')
+                is_dir = cid in node.dirs
+                stat = {"Hash": cid, "Size": 0 if is_dir else node.size(cid), "CumulativeSize": node.size(cid),
+                        "Type": "directory" if is_dir else "file", "Blocks": 1}
+                if query.get('with-local'):
+                    stat.update({"WithLocality": True, "Local": True, "SizeLocal": node.size(cid)})
+                self._json(stat)
+
+            def cmd_resolve(self, args, query, body):
+                cid, *names = args[0].split('/')
+                for name in names:
+                    matches = [child for child_name, child in node.dirs.get(cid, []) if child_name == unquote(name)]
+                    if not matches:
+                        return self._error('no link named ' + name)
+                    cid = matches[0]
+                self._json({"Path": f"/ipfs/{cid}"})
+
+            def cmd_cat(self, args, query, body):
+                data = node.files.get(args[0])
+                if data is None:
+                    return self._error('not found')
+                offset = int(query.get('offset', ['0'])[0])
+                length = query.get('length')
+                data = data[offset:offset + int(length[0])] if length else data[offset:]
+                self._send(data, content_type='text/plain')
+
+            def cmd_add(self, args, query, body):
+                boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+                decoder = MultipartDecoder(boundary)
+                decoder.receive_data(body)
+                decoder.receive_data(None)
+                parts, current = [], None
+                while True:
+                    event = decoder.next_event()
+                    if isinstance(event, (File, Field)):
+                        current = [unquote(event.filename or event.name), event.headers.get('Content-Type'), bytearray()]
+                        parts.append(current)
+                    elif isinstance(event, Data):
+                        current[2] += event.data
+                    elif isinstance(event, (Epilogue, NeedData)):
+                        break
+
+                added = [{"Name": name, "Hash": node.add_file(bytes(data)), "Size": str(len(data))}
+                         for name, content_type, data in parts if content_type != 'application/x-directory']
+                folders = sorted({name for name, content_type, _ in parts if content_type == 'application/x-directory'},
+                                 key=lambda name: -name.count('/'))
+                for folder in folders:
+                    prefix = folder + '/'
+                    children = [(entry["Name"][len(prefix):], entry["Hash"]) for entry in added
+                                if entry["Name"].startswith(prefix) and '/' not in entry["Name"][len(prefix):]]
+                    added.append({"Name": folder, "Hash": node.add_dir(children), "Size": "0"})
+                if query.get('progress'):
+                    added = [{"Name": name, "Bytes": len(data)} for name, content_type, data in parts
+                             if content_type != 'application/x-directory'] + added
+                self._send(''.join(json.dumps(entry) + '\n' for entry in added).encode())
+
+            def cmd_routing_provide(self, args, query, body):
+                self._json({"ID": "", "Type": 4})
+
+        return Handler
+
+def load_server(env):
+    """Import server3 from the repo root with env applied, working in a scratch directory
+    so its databases and caches don't land in the checkout"""
+    import os
+    import sys
+    import tempfile
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='server3-bench-'))
+    os.environ.update(env)
+    sys.path.insert(0, root)
+    import server3
+    return server3
@@ -0,0 +1,155 @@
+"""Old vs streaming gateway directory parser on a synthetic multi-MB listing page.
+
+    python bench/gateway_listing_parser.py [rows] [boxo|table]
+
+"old" is the pre-streaming parse_gateway_directory_html, kept below verbatim (minus
+its bare except): the whole page is downloaded as text and parsed in one go.
+"new" is server3.iter_gateway_directory_entries fed 64 KB chunks. Times are best of 3."""
+import mimetypes
+import sys
+import time
+import tracemalloc
+from html.parser import HTMLParser
+
+from fake_kubo import load_server
+
+ROOT = "bafybenchroot"
+
+def boxo_listing(rows):
+    """ipfs.io / cloudflare / pinata style grid"""
+    out = [f'''<!DOCTYPE html><html><head><title>/ipfs/{ROOT}/</title></head><body><main>
+<div class="container"><div class="ipfs-hash" translate="no">{ROOT}</div>
+<div>Index of <a href="/ipfs/{ROOT}">{ROOT}</a></div><section><div class="grid dir">
+<div class="type-icon"><div class="ipfs-_blank">&nbsp;</div></div><div><a href="/ipfs/{ROOT}/..">..</a></div><div></div><div></div>
+''']
+    for i in range(rows):
+        folder = i % 10 == 0
+        name = f"sub{i}" if folder else f"file {i}.png"
+        out.append(f'''<div class="type-icon"><div class="ipfs-{'_folder' if folder else 'png'}">&nbsp;</div></div>
+<div><a href="/ipfs/{ROOT}/{name.replace(' ', '%20')}">{name}</a></div>
+<div class="nowrap"><a class="ipfs-hash" translate="no" href="/ipfs/bafkchild{i}?filename={name}">bafk&hellip;{i}</a></div>
+<div class="nowrap" title="Cumulative size of IPFS DAG (data + metadata)">{'' if folder else f'{i * 1.5:.1f} kB'}</div>
+''')
+    out.append('</div></section></div></main></body></html>')
+    return ''.join(out)
+
+def table_listing(rows):
+    """go-ipfs / Kubo style table"""
+    out = [f'<html><body><div>Index of <a href="/ipfs/{ROOT}">{ROOT}</a></div><table>']
+    for i in range(rows):
+        out.append(f'''<tr><td class="type-icon"><div class="ipfs-{'_folder' if i % 10 == 0 else '_blank'}">&nbsp;</div></td>
+<td><a href="/ipfs/{ROOT}/n{i}">n{i}</a></td>
+<td class="no-linebreak"><a class="ipfs-hash" href="/ipfs/QmChild{i}?filename=n{i}">QmChi&hellip;</a></td>
+<td class="no-linebreak">{i} B</td></tr>''')
+    out.append('</table></body></html>')
+    return ''.join(out)
+
+def legacy_parse(html_content, parent_cid, get_file_preview_info):
+    class DirectoryParser(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.entries = []
+            self.in_link = False
+            self.current_link = None
+            self.current_text = ""
+
+        def handle_starttag(self, tag, attrs):
+            if tag == 'a':
+                self.in_link = True
+                for attr_name, attr_value in attrs:
+                    if attr_name == 'href' and attr_value.startswith('/ipfs/'):
+                        self.current_link = attr_value.replace('/ipfs/', '')
+                        break
+
+        def handle_data(self, data):
+            if self.in_link:
+                self.current_text += data
+
+        def handle_endtag(self, tag):
+            if tag == 'a' and self.in_link:
+                if self.current_link and self.current_text.strip():
+                    name = self.current_text.strip()
+                    if name not in ['..', '.']:
+                        is_dir = name.endswith('/')
+                        clean_name = name.rstrip('/')
+                        file_type = "directory" if is_dir else mimetypes.guess_type(clean_name)[0] or "application/octet-stream"
+                        preview_info = get_file_preview_info(clean_name, file_type)
+                        self.entries.append({
+                            "name": clean_name,
+                            "cid": self.current_link.split('/')[-1] if '/' in self.current_link else self.current_link,
+                            "size": 0,
+                            "size_human": "0 B",
+                            "type": file_type,
+                            "is_directory": is_dir,
+                            "parent_cid": parent_cid,
+                            **preview_info
+                        })
+                self.in_link = False
+                self.current_link = None
+                self.current_text = ""
+
+    parser = DirectoryParser()
+    parser.feed(html_content)
+    return parser.entries
+
+class PageResponse:
+    """Just enough of requests.Response for iter_gateway_directory_entries"""
+    headers = {"Content-Type": "text/html; charset=utf-8"}
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+def measure(fn, repeat=3):
+    """Best of repeat timed runs (shared machines are noisy), then one traced run for peak memory"""
+    elapsed = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        run = time.perf_counter() - started
+        elapsed = run if elapsed is None else min(elapsed, run)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    layout = sys.argv[2] if len(sys.argv) > 2 else "boxo"
+    server3 = load_server({"PREFETCH_ENABLED": "0"})
+    body = (boxo_listing if layout == "boxo" else table_listing)(rows).encode()
+    print(f"{layout} listing: {rows} rows, {len(body) / 1e6:.1f} MB, Python {sys.version.split()[0]}")
+
+    def run_old():
+        return len(legacy_parse(body.decode("utf-8"), ROOT, server3.get_file_preview_info)), None
+
+    def run_new():
+        count, first, started = 0, None, time.perf_counter()
+        for batch in server3.iter_gateway_directory_entries(PageResponse(body), ROOT):
+            if first is None:
+                first = time.perf_counter() - started
+            count += len(batch)
+        return count, first
+
+    times = {}
+    for name, fn in (("old", run_old), ("new", run_new)):
+        (count, first), times[name], peak = measure(fn)
+        line = f"  {name}: {times[name]:.2f} s, peak {peak / 1e6:.1f} MB, {count} entries"
+        if first is not None:
+            line += f", first batch after {first * 1000:.0f} ms"
+        print(line)
+    # The new parser also reads sizes and child CIDs and builds full entries (preview and
+    # thumbnail hints), which the old one never did; that, not the chunked feeding, is
+    # where any extra time goes
+    print(f"  new/old time: {times['new'] / times['old']:.2f}x "
+          f"({'slower' if times['new'] > times['old'] else 'faster'} overall)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Check that /ls on a large directory costs one ls call on the node, with no per-entry
+probes: python bench/ls_round_trips.py [entries]"""
+import sys
+import time
+
+from fake_kubo import FakeKubo, load_server
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    node = FakeKubo().start()
+    children = [(f"file-{i:05d}.txt", node.add_file(f"entry {i}".encode())) for i in range(entries)]
+    children.append(("nested", node.add_dir([])))
+    folder = node.add_dir(children)
+
+    server3 = load_server({"IPFS_API_URL": node.url, "IPFS_PRIVATE_API_URL": node.url, "PREFETCH_ENABLED": "0"})
+    client = server3.app.test_client()
+
+    started = time.perf_counter()
+    response = client.get(f"/ls?cid={folder}")
+    elapsed = time.perf_counter() - started
+    listing = response.get_json()
+
+    ls_calls, stat_calls = node.count("ls"), node.count("files/stat")
+    print(f"/ls {entries + 1} entries: HTTP {response.status_code}, {elapsed * 1000:.0f} ms, "
+          f"{ls_calls} ls call(s), {stat_calls} files/stat call(s)")
+    assert response.status_code == 200 and len(listing["entries"]) == entries + 1
+    assert sum(1 for entry in listing["entries"] if entry.get("is_directory")) == 1
+    assert ls_calls == 1 and stat_calls == 0, node.calls[:10]
+    node.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, send_file
 from flask_cors import CORS
 from urllib.parse import unquote, quote
 import requests
@@ -8,10 +8,20 @@ import io
 import sqlite3
 import os
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Epilogue
 import magic
+try:
+    from PIL import Image as PILImage, ImageOps as PILImageOps, features as pil_features
+except ImportError:
+    PILImage = None
 from threading import Lock
 import threading
-from functools import lru_cache
+from functools import lru_cache, wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import time
 import hashlib
 import uuid
@@ -19,7 +29,13 @@ from datetime import datetime, timedelta
 import csv
 import json
 import shutil
+import tempfile
 from html.parser import HTMLParser
+import queue
+import re
+import codecs
+from itertools import chain, islice
+from array import array
 
 app = Flask(__name__)
 CORS(app)
@@ -61,17 +77,12 @@ def get_db_connection():
         local_data.connection.execute('PRAGMA temp_store=MEMORY')
     return local_data.connection
 
-# Cache for metadata with longer TTL for external gateways
-@lru_cache(maxsize=1000)
-def cached_metadata_lookup(cid):
-    """Cache metadata lookups to avoid repeated IPFS calls"""
-    return _get_metadata_internal(cid)
-
 # Enhanced session for HTTP requests
+SESSION_POOL_MAXSIZE = 50
 session = requests.Session()
 adapter = requests.adapters.HTTPAdapter(
     pool_connections=20,
-    pool_maxsize=50,
+    pool_maxsize=SESSION_POOL_MAXSIZE,
     max_retries=5
 )
 session.mount('http://', adapter)
@@ -83,35 +94,1870 @@ session.headers.update({
     'Connection': 'keep-alive'
 })
 
+# ---------- IPFS Node RPC Client ----------
+IPFS_API_URL = os.environ.get("IPFS_API_URL", "http://127.0.0.1:5001")
+IPFS_PRIVATE_API_URL = os.environ.get("IPFS_PRIVATE_API_URL", "http://127.0.0.1:5002")
+IPFS_RPC_RETRY_SECONDS = float(os.environ.get("IPFS_RPC_RETRY_SECONDS", "30"))
+IPFS_RPC_CONNECT_TIMEOUT = 2
+IPFS_CHUNK_SIZE = 64 * 1024
+
+class IPFSError(Exception):
+    """An ipfs command failed (RPC error response or non-zero CLI exit)"""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or message
+
+class IPFSTimeout(IPFSError):
+    """An ipfs command ran past its timeout"""
+
+class IPFSStream:
+    """Byte stream from the node; close() releases the HTTP connection or kills the CLI process"""
+
+    def __init__(self, chunks, closer):
+        self.chunks = chunks
+        self.closer = closer
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def read_all(self):
+        try:
+            return b"".join(self.chunks)
+        finally:
+            self.close()
+
+    def close(self):
+        self.closer()
+
+class IPFSClient:
+    """Kubo /api/v0 RPC client over a keep-alive pool, with the ipfs CLI as fallback.
+
+    When the RPC socket refuses a connection the client uses the CLI for
+    IPFS_RPC_RETRY_SECONDS before trying RPC again."""
+
+    def __init__(self, name, api_url, ipfs_path, offline=False):
+        self.name = name
+        self.api_url = api_url.rstrip('/') + '/api/v0/'
+        self.ipfs_path = ipfs_path
+        self.offline = offline
+        self.rpc_down_until = 0
+        self.lock = Lock()
+        self.stats = {"rpc_calls": 0, "cli_calls": 0, "rpc_unavailable": 0, "errors": 0}
+        self.session = requests.Session()
+        rpc_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+        self.session.mount('http://', rpc_adapter)
+        self.session.mount('https://', rpc_adapter)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def rpc_available(self):
+        return time.time() >= self.rpc_down_until
+
+    # ----- transport -----
+    def _rpc(self, command, args=(), params=None, timeout=60, stream=False, data=None, headers=None):
+        query = [("arg", arg) for arg in args] + list((params or {}).items())
+        if self.offline and "offline" not in (params or {}):
+            query.append(("offline", "true"))
+        try:
+            r = self.session.post(self.api_url + command, params=query, data=data, headers=headers,
+                                  stream=stream, timeout=(IPFS_RPC_CONNECT_TIMEOUT, timeout))
+        except requests.exceptions.ConnectionError:
+            self.rpc_down_until = time.time() + IPFS_RPC_RETRY_SECONDS
+            self._count("rpc_unavailable")
+            raise
+        except requests.exceptions.Timeout as e:
+            self._count("errors")
+            raise IPFSTimeout(f"ipfs {command} timed out", str(e))
+
+        self._count("rpc_calls")
+        if r.status_code != 200:
+            try:
+                message = r.json().get("Message", r.text)
+            except ValueError:
+                message = r.text
+            r.close()
+            self._count("errors")
+            raise IPFSError(f"ipfs {command} failed", message)
+        return r
+
+    def _cli_env(self):
+        env = os.environ.copy()
+        env["IPFS_PATH"] = self.ipfs_path
+        return env
+
+    def _cli_args(self, args):
+        return ["ipfs"] + (["--offline"] if self.offline and "--offline" not in args else []) + list(args)
+
+    def _cli(self, args, timeout=60, input=None):
+        self._count("cli_calls")
+        try:
+            result = subprocess.run(self._cli_args(args), env=self._cli_env(), input=input,
+                                    capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            self._count("errors")
+            raise IPFSTimeout(f"ipfs {args[0]} timed out", str(e))
+        except FileNotFoundError:
+            self._count("errors")
+            raise IPFSError("ipfs binary not found")
+        if result.returncode != 0:
+            self._count("errors")
+            raise IPFSError(f"ipfs {args[0]} failed", result.stderr.decode(errors="replace").strip())
+        return result.stdout
+
+    @staticmethod
+    def _stderr_text(stderr):
+        stderr.seek(0)
+        return stderr.read().decode(errors="replace").strip()
+
+    def _cli_stream(self, args, timeout=None):
+        """Run a CLI command streaming stdout; the first read surfaces immediate failures.
+        stderr goes to a temp file: a full pipe nobody reads would stall the process."""
+        self._count("cli_calls")
+        stderr = tempfile.TemporaryFile()
+        try:
+            proc = subprocess.Popen(self._cli_args(args), env=self._cli_env(),
+                                    stdout=subprocess.PIPE, stderr=stderr)
+        except FileNotFoundError:
+            stderr.close()
+            self._count("errors")
+            raise IPFSError("ipfs binary not found")
+        timer = threading.Timer(timeout, proc.kill) if timeout else None
+        if timer:
+            timer.start()
+
+        def close():
+            if timer:
+                timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            stderr.close()
+
+        first = proc.stdout.read1(IPFS_CHUNK_SIZE)
+        if not first and proc.wait() != 0:
+            details = self._stderr_text(stderr)
+            close()
+            self._count("errors")
+            raise IPFSError(f"ipfs {args[0]} failed", details)
+
+        def chunks():
+            try:
+                if first:
+                    yield first
+                while True:
+                    chunk = proc.stdout.read1(IPFS_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+                if proc.wait() != 0:
+                    raise IPFSError(f"ipfs {args[0]} failed", self._stderr_text(stderr))
+            finally:
+                close()
+
+        return IPFSStream(chunks(), close)
+
+    def _call(self, rpc_fn, cli_fn):
+        if self.rpc_available():
+            try:
+                return rpc_fn()
+            except requests.exceptions.ConnectionError:
+                print(f"IPFS RPC ({self.name}) unavailable, using CLI for {IPFS_RPC_RETRY_SECONDS:.0f}s")
+        return cli_fn()
+
+    # ----- commands -----
+    def ls(self, cid, timeout=90, resolve_type=True):
+        """Directory links: [{"Name", "Hash", "Size", "Type"}]"""
+        flags = {"resolve-type": str(resolve_type).lower(), "size": "true"}
+        data = self._call(
+            lambda: self._rpc("ls", [cid], flags, timeout=timeout).json(),
+            lambda: json.loads(self._cli(["ls", "--enc=json"] + [f"--{k}={v}" for k, v in flags.items()] + [cid],
+                                         timeout=timeout)))
+        objects = data.get("Objects") or [{}]
+        return objects[0].get("Links") or []
+
+    def ls_stream(self, cid, timeout=90):
+        """Yield directory links as the node resolves them (ls --stream)"""
+        flags = {"resolve-type": "true", "size": "true", "stream": "true"}
+
+        def rpc():
+            r = self._rpc("ls", [cid], flags, timeout=timeout, stream=True)
+            return IPFSStream(r.iter_content(chunk_size=IPFS_CHUNK_SIZE), r.close)
+
+        stream = self._call(rpc, lambda: self._cli_stream(
+            ["ls", "--enc=json"] + [f"--{k}={v}" for k, v in flags.items()] + [cid], timeout=timeout))
+        try:
+            for line in _iter_lines(stream):
+                for obj in json.loads(line).get("Objects") or []:
+                    yield from obj.get("Links") or []
+        except requests.exceptions.RequestException as e:
+            raise IPFSError("ipfs ls interrupted", str(e))
+        finally:
+            stream.close()
+
+    def resolve(self, path, timeout=60):
+        """Resolve an /ipfs/ path to '/ipfs/<cid>'"""
+        return self._call(
+            lambda: self._rpc("resolve", [path], timeout=timeout).json()["Path"],
+            lambda: self._cli(["resolve", path], timeout=timeout).decode().strip())
+
+    def files_stat(self, cid_path, timeout=60, with_local=False, offline=False):
+        """UnixFS stat: Hash, Size, CumulativeSize, Type (file/directory), Local with with_local.
+        offline=True never asks the network for missing blocks."""
+        path = cid_path if cid_path.startswith("/ipfs/") else f"/ipfs/{cid_path}"
+        params = {"with-local": "true"} if with_local else {}
+        cli_flags = ["--with-local"] if with_local else []
+        if offline:
+            params["offline"] = "true"
+            cli_flags.append("--offline")
+        return self._call(
+            lambda: self._rpc("files/stat", [path], params, timeout=timeout).json(),
+            lambda: json.loads(self._cli(["files", "stat", "--enc=json"] + cli_flags + [path], timeout=timeout)))
+
+    def cat(self, cid, offset=None, length=None, timeout=None, offline=False):
+        """Stream file bytes; returns an IPFSStream that must be closed"""
+        params, cli_flags = ({"offline": "true"}, ["--offline"]) if offline else ({}, [])
+        if offset:
+            params["offset"] = str(offset)
+            cli_flags.append(f"--offset={offset}")
+        if length is not None:
+            params["length"] = str(length)
+            cli_flags.append(f"--length={length}")
+
+        def rpc():
+            r = self._rpc("cat", [cid], params, timeout=timeout, stream=True)
+            return IPFSStream(r.iter_content(chunk_size=IPFS_CHUNK_SIZE), r.close)
+
+        return self._call(rpc, lambda: self._cli_stream(["cat"] + cli_flags + [cid], timeout=timeout))
+
+    def add_path(self, path, recursive=False, timeout=180, progress=None):
+        """Add a file or (recursive) directory from disk; returns add entries, root last.
+        progress(name, bytes) receives the node's per-file byte counts over RPC."""
+        base = os.path.basename(os.path.normpath(path))
+
+        def parts():
+            # Walked lazily so large trees are never listed in memory up front
+            yield (base, None if recursive and os.path.isdir(path) else path)
+            if recursive and os.path.isdir(path):
+                for folder, dirs, files in os.walk(path):
+                    dirs.sort()
+                    rel = os.path.relpath(folder, path).replace(os.sep, '/')
+                    prefix = base if rel == '.' else f"{base}/{rel}"
+                    if rel != '.':
+                        yield (prefix, None)
+                    for name in sorted(files):
+                        yield (f"{prefix}/{name}", os.path.join(folder, name))
+
+        cli_args = ["add", "--enc=json", "--progress=false"] + (["-r"] if recursive else []) + [path]
+        return self._call(lambda: self._rpc_add(parts(), timeout, progress=progress),
+                          lambda: _parse_json_lines(self._cli(cli_args, timeout=timeout)))
+
+    def add_stream(self, name, chunks, timeout=180):
+        """Add one file from an iterable of byte chunks (e.g. an upload as it arrives).
+        Once the first chunk has been consumed there is no CLI fallback."""
+        state = {"started": False}
+
+        def tracked():
+            for chunk in chunks:
+                state["started"] = True
+                yield chunk
+
+        body = tracked()
+
+        def cli():
+            if state["started"]:
+                raise IPFSError("ipfs RPC connection lost during upload")
+            return self._cli_add_stdin(name, body, timeout)
+
+        return self._call(lambda: self._rpc_add([(name, body)], timeout), cli)
+
+    def _cli_add_stdin(self, name, chunks, timeout):
+        self._count("cli_calls")
+        stderr = tempfile.TemporaryFile()
+        try:
+            proc = subprocess.Popen(
+                self._cli_args(["add", "--enc=json", "--progress=false", f"--stdin-name={name}"]),
+                env=self._cli_env(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        except FileNotFoundError:
+            stderr.close()
+            self._count("errors")
+            raise IPFSError("ipfs binary not found")
+        # A stalled ipfs process can block the stdin writes as well as the final read,
+        # so the deadline kills it rather than timing out a single call
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            proc.kill()
+
+        deadline = threading.Timer(timeout, expire)
+        deadline.daemon = True
+        deadline.start()
+        output = b""
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+            proc.stdin.close()
+            output = proc.stdout.read()
+            proc.wait()
+        except BrokenPipeError:
+            proc.wait()
+        finally:
+            deadline.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            details = self._stderr_text(stderr)
+            stderr.close()
+        if expired.is_set():
+            self._count("errors")
+            raise IPFSTimeout("ipfs add timed out", f"no result after {timeout}s")
+        if proc.returncode != 0:
+            self._count("errors")
+            raise IPFSError("ipfs add failed", details)
+        return _parse_json_lines(output)
+
+    def _rpc_add(self, parts, timeout, params=None, progress=None):
+        boundary = uuid.uuid4().hex
+        params = dict(params or {})
+        if progress:
+            params["progress"] = "true"
+        r = self._rpc("add", params=params, timeout=timeout, stream=True,
+                      data=_multipart_add_body(parts, boundary),
+                      headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        try:
+            added = []
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if "Hash" in entry:
+                    added.append(entry)
+                elif progress and "Bytes" in entry:
+                    progress(entry.get("Name", ""), entry["Bytes"])
+            return added
+        except requests.exceptions.RequestException as e:
+            # The node accepted the request, so don't treat this as RPC being down
+            raise IPFSTimeout("ipfs add timed out", str(e))
+        finally:
+            r.close()
+
+    def provide(self, cids, timeout=300):
+        """Announce CIDs to the routing system (blocks until the walk completes)"""
+        def rpc():
+            r = self._rpc("routing/provide", list(cids), timeout=timeout, stream=True)
+            try:
+                for _ in r.iter_lines():
+                    pass
+            except requests.exceptions.RequestException as e:
+                raise IPFSTimeout("ipfs routing provide timed out", str(e))
+            finally:
+                r.close()
+
+        return self._call(rpc, lambda: self._cli(["routing", "provide"] + list(cids), timeout=timeout))
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["rpc_available"] = self.rpc_available()
+        stats["api_url"] = self.api_url
+        return stats
+
+def _iter_lines(chunks):
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+def _parse_json_lines(output):
+    if isinstance(output, bytes):
+        output = output.decode()
+    return [entry for entry in (json.loads(line) for line in output.splitlines() if line.strip()) if "Hash" in entry]
+
+def _multipart_add_body(parts, boundary):
+    """Stream a Kubo add request body; parts are (name, source) with source a file path,
+    None for a directory, or an iterable of byte chunks"""
+    for name, source in parts:
+        content_type = "application/x-directory" if source is None else "application/octet-stream"
+        yield (f'--{boundary}\r\n'
+               f'Content-Disposition: form-data; name="file"; filename="{quote(name, safe="")}"\r\n'
+               f'Content-Type: {content_type}\r\n\r\n').encode()
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                while True:
+                    chunk = f.read(IPFS_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        elif source is not None:
+            yield from source
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+ipfs_public = IPFSClient("public", IPFS_API_URL, os.path.expanduser("~/.ipfs"))
+ipfs_private = IPFSClient("private", IPFS_PRIVATE_API_URL, os.path.expanduser("~/.ipfs-private"), offline=True)
+
+def ipfs_client_for(visibility):
+    return ipfs_private if visibility == 'private' else ipfs_public
+
+# ---------- Gateway Router ----------
+GATEWAY_EWMA_ALPHA = float(os.environ.get("GATEWAY_EWMA_ALPHA", "0.3"))
+GATEWAY_DEFAULT_TTFB = float(os.environ.get("GATEWAY_DEFAULT_TTFB", "1.0"))
+GATEWAY_FAILURE_THRESHOLD = int(os.environ.get("GATEWAY_FAILURE_THRESHOLD", "3"))
+GATEWAY_OPEN_SECONDS = float(os.environ.get("GATEWAY_OPEN_SECONDS", "30"))
+GATEWAY_MAX_OPEN_SECONDS = float(os.environ.get("GATEWAY_MAX_OPEN_SECONDS", "600"))
+GATEWAY_CONNECT_TIMEOUT = float(os.environ.get("GATEWAY_CONNECT_TIMEOUT", "10"))
+GATEWAY_PREFERENCE_BONUS = 0.75
+GATEWAY_PROBE_CID = "QmXoypizjW3WknFiJnKLwHCnL72vedxjQkDDP1mXWo6uco"
+
+class GatewayRouter:
+    """Orders gateways by live latency/error score with per-gateway circuit breakers"""
+
+    def __init__(self, gateways):
+        self.lock = Lock()
+        self.stats = {}
+        for url in gateways:
+            self.stats[url] = {
+                "ewma_ttfb": None,
+                "error_rate": 0.0,
+                "requests": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "state": "closed",
+                "opened_at": None,
+                "open_seconds": GATEWAY_OPEN_SECONDS,
+                "probing": False,
+                "last_error": None
+            }
+
+    def _score(self, s, preferred):
+        """Expected seconds to a useful response; lower is better"""
+        ttfb = s["ewma_ttfb"] if s["ewma_ttfb"] is not None else GATEWAY_DEFAULT_TTFB
+        score = ttfb / max(0.05, 1.0 - s["error_rate"])
+        return score * GATEWAY_PREFERENCE_BONUS if preferred else score
+
+    def ordered(self, preferred=None):
+        """Gateways to attempt, best first; open circuits are only a last resort"""
+        now = time.time()
+        closed, half_open, still_open, probes = [], [], [], []
+
+        with self.lock:
+            for url, s in self.stats.items():
+                if s["state"] == "open" and now - s["opened_at"] >= s["open_seconds"]:
+                    s["state"] = "half_open"
+                if s["state"] == "half_open" and not s["probing"]:
+                    s["probing"] = True
+                    probes.append(url)
+
+                entry = (self._score(s, url == preferred), url)
+                if s["state"] == "closed":
+                    closed.append(entry)
+                elif s["state"] == "half_open":
+                    half_open.append(entry)
+                else:
+                    still_open.append((s["opened_at"] + s["open_seconds"], url))
+
+        for url in probes:
+            threading.Thread(target=self._probe, args=(url,), daemon=True).start()
+
+        return [url for _, url in sorted(closed)] + \
+               [url for _, url in sorted(half_open)] + \
+               [url for _, url in sorted(still_open)]
+
+    def record_success(self, url, ttfb):
+        with self.lock:
+            s = self.stats.get(url)
+            if s is None:
+                return
+            s["requests"] += 1
+            s["ewma_ttfb"] = ttfb if s["ewma_ttfb"] is None else \
+                GATEWAY_EWMA_ALPHA * ttfb + (1 - GATEWAY_EWMA_ALPHA) * s["ewma_ttfb"]
+            s["error_rate"] = (1 - GATEWAY_EWMA_ALPHA) * s["error_rate"]
+            s["consecutive_failures"] = 0
+            if s["state"] != "closed":
+                s["state"] = "closed"
+                s["open_seconds"] = GATEWAY_OPEN_SECONDS
+
+    def record_failure(self, url, error):
+        with self.lock:
+            s = self.stats.get(url)
+            if s is None:
+                return
+            s["requests"] += 1
+            s["failures"] += 1
+            s["consecutive_failures"] += 1
+            s["error_rate"] = GATEWAY_EWMA_ALPHA + (1 - GATEWAY_EWMA_ALPHA) * s["error_rate"]
+            s["last_error"] = str(error)[:200]
+            if s["state"] == "half_open":
+                # Failed probe: back off exponentially before the next one
+                s["open_seconds"] = min(s["open_seconds"] * 2, GATEWAY_MAX_OPEN_SECONDS)
+                s["state"] = "open"
+                s["opened_at"] = time.time()
+            elif s["state"] == "closed" and s["consecutive_failures"] >= GATEWAY_FAILURE_THRESHOLD:
+                s["state"] = "open"
+                s["opened_at"] = time.time()
+
+    def _probe(self, url):
+        """Half-open probe off the request path so users never wait on a sick gateway"""
+        try:
+            response = session.head(url + GATEWAY_PROBE_CID,
+                                    timeout=(GATEWAY_CONNECT_TIMEOUT, 30), allow_redirects=True)
+            response.close()
+            if response.status_code < 500 and response.status_code != 429:
+                self.record_success(url, response.elapsed.total_seconds())
+            else:
+                self.record_failure(url, f"probe status {response.status_code}")
+        except Exception as e:
+            self.record_failure(url, e)
+        finally:
+            with self.lock:
+                self.stats[url]["probing"] = False
+
+    def snapshot(self, preferred=None):
+        """Scoreboard for the /gateway endpoint"""
+        names = {v: k for k, v in GATEWAYS.items()}
+        now = time.time()
+        board = []
+        with self.lock:
+            for url, s in self.stats.items():
+                retry_in = None
+                if s["state"] == "open":
+                    retry_in = max(0.0, round(s["opened_at"] + s["open_seconds"] - now, 1))
+                board.append({
+                    "name": names.get(url, "custom"),
+                    "url": url,
+                    "state": s["state"],
+                    "score": round(self._score(s, url == preferred), 4),
+                    "ewma_ttfb_ms": round(s["ewma_ttfb"] * 1000, 1) if s["ewma_ttfb"] is not None else None,
+                    "error_rate": round(s["error_rate"], 4),
+                    "requests": s["requests"],
+                    "failures": s["failures"],
+                    "consecutive_failures": s["consecutive_failures"],
+                    "retry_in_seconds": retry_in,
+                    "last_error": s["last_error"]
+                })
+        board.sort(key=lambda g: g["score"])
+        return board
+
+gateway_router = GatewayRouter(GATEWAYS.values())
+
 # ---------- Gateway Helper Functions ----------
+def _usable_status(response, request_kwargs):
+    """200, or the partial/unsatisfiable answers a forwarded Range can legitimately get"""
+    if response.status_code == 200:
+        return True
+    return 'Range' in (request_kwargs.get('headers') or {}) and response.status_code in (206, 416)
+
 def get_gateway_url():
     """Get current primary gateway URL"""
     return CURRENT_GATEWAY
 
 def try_multiple_gateways(cid, operation='get', **kwargs):
-    """Try multiple gateways with ipfs.io priority"""
-    gateways_to_try = [CURRENT_GATEWAY] + FALLBACK_GATEWAYS
+    """Try gateways in live score order (best first, open circuits last)"""
+    gateways_to_try = gateway_router.ordered(preferred=CURRENT_GATEWAY)
 
     for gateway in gateways_to_try:
+        response = None
         try:
             url = gateway + cid
 
             if operation == 'head':
-                response = session.head(url, timeout=60, allow_redirects=True, **kwargs)
+                response = session.head(url, timeout=(GATEWAY_CONNECT_TIMEOUT, 60), allow_redirects=True, **kwargs)
             elif operation == 'get':
-                response = session.get(url, timeout=90, allow_redirects=True, **kwargs)
+                response = session.get(url, timeout=(GATEWAY_CONNECT_TIMEOUT, 90), allow_redirects=True, **kwargs)
             elif operation == 'stream':
-                response = session.get(url, stream=True, timeout=120, allow_redirects=True, **kwargs)
+                response = session.get(url, stream=True, timeout=(GATEWAY_CONNECT_TIMEOUT, 120), allow_redirects=True, **kwargs)
+
+            # Server-side errors count against the gateway; a 404 only says this CID isn't there
+            if response.status_code >= 500 or response.status_code == 429:
+                gateway_router.record_failure(gateway, f"HTTP {response.status_code}")
+            else:
+                gateway_router.record_success(gateway, response.elapsed.total_seconds())
 
-            if response.status_code == 200:
+            if _usable_status(response, kwargs):
                 return response, gateway
 
+            response.close()
+
         except Exception as e:
+            gateway_router.record_failure(gateway, e)
             print(f"Gateway {gateway} failed: {str(e)}")
             continue
 
     raise Exception("All gateways failed")
 
+# ---------- Hedged Gateway Requests ----------
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "1") == "1"
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "0.75"))
+HEDGE_IMMEDIATE = int(os.environ.get("HEDGE_IMMEDIATE", "1"))
+HEDGE_MAX_ATTEMPTS = int(os.environ.get("HEDGE_MAX_ATTEMPTS", "3"))
+HEDGE_BUDGET_RATIO = float(os.environ.get("HEDGE_BUDGET_RATIO", "0.25"))
+HEDGE_BUDGET_BURST = float(os.environ.get("HEDGE_BUDGET_BURST", "10"))
+
+# Hedges never take more than half of the shared session pool
+hedge_slots = threading.BoundedSemaphore(max(1, SESSION_POOL_MAXSIZE // 2))
+hedge_lock = Lock()
+hedge_stats = {
+    "requests": 0,
+    "hedges_launched": 0,
+    "hedge_wins": 0,
+    "budget_denied": 0,
+    "losers_closed": 0,
+    "tokens": HEDGE_BUDGET_BURST
+}
+
+def _hedge_budget_deposit():
+    """Every primary request earns HEDGE_BUDGET_RATIO hedge tokens (capped)"""
+    with hedge_lock:
+        hedge_stats["requests"] += 1
+        hedge_stats["tokens"] = min(HEDGE_BUDGET_BURST, hedge_stats["tokens"] + HEDGE_BUDGET_RATIO)
+
+def _hedge_budget_take():
+    """Spend one token on an extra request; keeps load amplification <= 1 + ratio"""
+    with hedge_lock:
+        if hedge_stats["tokens"] >= 1 and hedge_slots.acquire(blocking=False):
+            hedge_stats["tokens"] -= 1
+            hedge_stats["hedges_launched"] += 1
+            return True
+        hedge_stats["budget_denied"] += 1
+        return False
+
+def _hold_hedge_slot(response):
+    """A hedge keeps its pool slot while its body streams; close() gives it back once"""
+    close = response.close
+    state = {"held": True}
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            with hedge_lock:
+                held, state["held"] = state["held"], False
+            if held:
+                hedge_slots.release()
+
+    response.close = close_and_release
+
+def hedged_gateway_stream(cid, **kwargs):
+    """Race streaming GETs across gateways; first 200 wins and the losers are closed"""
+    gateways = gateway_router.ordered(preferred=CURRENT_GATEWAY)
+    results = queue.Queue()
+    decided = {"winner": None}
+    decided_lock = Lock()
+    _hedge_budget_deposit()
+
+    def attempt(gateway, is_hedge):
+        try:
+            response = session.get(gateway + cid, stream=True, allow_redirects=True,
+                                   timeout=(GATEWAY_CONNECT_TIMEOUT, 120), **kwargs)
+        except Exception as e:
+            if is_hedge:
+                hedge_slots.release()
+            gateway_router.record_failure(gateway, e)
+            print(f"Gateway {gateway} failed: {str(e)}")
+            results.put((gateway, None))
+            return
+        if is_hedge:
+            _hold_hedge_slot(response)
+
+        if response.status_code >= 500 or response.status_code == 429:
+            gateway_router.record_failure(gateway, f"HTTP {response.status_code}")
+        else:
+            gateway_router.record_success(gateway, response.elapsed.total_seconds())
+
+        with decided_lock:
+            won = _usable_status(response, kwargs) and decided["winner"] is None
+            if won:
+                decided["winner"] = gateway
+        if won:
+            results.put((gateway, response))
+            return
+
+        if _usable_status(response, kwargs):
+            with hedge_lock:
+                hedge_stats["losers_closed"] += 1
+        response.close()
+        results.put((gateway, None))
+
+    pending = 0
+    next_index = 0
+    hedged = set()
+
+    def launch(is_hedge):
+        nonlocal pending, next_index
+        gateway = gateways[next_index]
+        next_index += 1
+        pending += 1
+        if is_hedge:
+            hedged.add(gateway)
+        threading.Thread(target=attempt, args=(gateway, is_hedge), daemon=True).start()
+
+    launch(False)
+    while next_index < min(HEDGE_IMMEDIATE, len(gateways)) and _hedge_budget_take():
+        launch(True)
+
+    while pending:
+        try:
+            gateway, response = results.get(timeout=HEDGE_DELAY)
+        except queue.Empty:
+            # Nobody has answered yet: hedge to the next best gateway if the budget allows
+            if next_index < len(gateways) and pending < HEDGE_MAX_ATTEMPTS and _hedge_budget_take():
+                launch(True)
+            continue
+
+        pending -= 1
+        if response is not None:
+            if gateway in hedged:
+                with hedge_lock:
+                    hedge_stats["hedge_wins"] += 1
+            return response, gateway
+
+        # A failed attempt is replaced rather than hedged, so it costs no budget
+        if next_index < len(gateways):
+            launch(False)
+
+    raise Exception("All gateways failed")
+
+def open_gateway_stream(cid, **kwargs):
+    """Streaming fetch used by the content endpoints"""
+    if HEDGE_ENABLED:
+        return hedged_gateway_stream(cid, **kwargs)
+    return try_multiple_gateways(cid, 'stream', **kwargs)
+
+def get_hedge_stats():
+    with hedge_lock:
+        stats = dict(hedge_stats)
+    stats["tokens"] = round(stats["tokens"], 2)
+    stats["enabled"] = HEDGE_ENABLED
+    stats["amplification"] = round(
+        (stats["requests"] + stats["hedges_launched"]) / stats["requests"], 3) if stats["requests"] else 1.0
+    return stats
+
+# ---------- Content Cache (CID-addressed, on disk) ----------
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(os.getcwd(), 'cache'))
+CONTENT_CACHE_DIR = os.path.join(CACHE_DIR, 'content')
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+CONTENT_CACHE_MAX_OBJECT = int(os.environ.get("CONTENT_CACHE_MAX_OBJECT", str(CONTENT_CACHE_MAX_BYTES // 4)))
+CONTENT_CACHE_POLICY = os.environ.get("CONTENT_CACHE_POLICY", "lru")  # lru | lfu
+STREAM_CHUNK_SIZE = 64 * 1024
+STALE_PARTIAL_SECONDS = 3600
+
+class ContentCache:
+    """Size-capped disk cache keyed by CID path; CIDs are immutable so entries never go stale"""
+
+    def __init__(self, root, max_bytes, policy="lru"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> entry, least recently used first
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "aborted": 0, "evictions": 0}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def paths_for(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        folder = os.path.join(self.root, digest[:2])
+        return folder, os.path.join(folder, digest)
+
+    def _load(self):
+        """Rebuild the index from disk and sweep partial files left by dead streams"""
+        found = []
+        now = time.time()
+        for folder, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    if '.part-' in name:
+                        if now - os.path.getmtime(path) > STALE_PARTIAL_SECONDS:
+                            os.remove(path)
+                    elif name.endswith('.json'):
+                        with open(path) as f:
+                            meta = json.load(f)
+                        data_path = path[:-5]
+                        found.append((os.path.getatime(data_path), meta, data_path))
+                except (OSError, ValueError):
+                    continue
+
+        for _, meta, data_path in sorted(found, key=lambda item: item[0]):
+            self.entries[meta["key"]] = {
+                "path": data_path,
+                "size": meta["size"],
+                "content_type": meta.get("content_type") or "application/octet-stream",
+                "hits": 0
+            }
+            self.total_bytes += meta["size"]
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if not os.path.exists(entry["path"]):
+                # Evicted by another worker process sharing the directory
+                self._drop(key)
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            entry["hits"] += 1
+            self.stats["hits"] += 1
+            return dict(entry)
+
+    def contains(self, key):
+        """Whether key is cached, without counting a lookup or refreshing its recency"""
+        with self.lock:
+            return key in self.entries
+
+    def begin(self, key, content_type, expected_size=None):
+        """Start a tee write for key; returns None when the object shouldn't be cached"""
+        if expected_size and expected_size > CONTENT_CACHE_MAX_OBJECT:
+            return None
+        folder, final_path = self.paths_for(key)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            return CacheWriter(self, key, final_path, content_type, expected_size)
+        except OSError as e:
+            print(f"Content cache write failed for {key}: {e}")
+            return None
+
+    def publish(self, key, final_path, part_path, content_type, size):
+        meta_part = f"{final_path}.json.part-{uuid.uuid4().hex}"
+        with open(meta_part, 'w') as f:
+            json.dump({"key": key, "size": size, "content_type": content_type, "created": time.time()}, f)
+        os.replace(part_path, final_path)
+        os.replace(meta_part, final_path + '.json')
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]["size"]
+            self.entries[key] = {"path": final_path, "size": size, "content_type": content_type, "hits": 0}
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            self.stats["stores"] += 1
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            if self.policy == "lfu":
+                victim = min(self.entries, key=lambda k: self.entries[k]["hits"])
+            else:
+                victim = next(iter(self.entries))
+            path = self.entries[victim]["path"]
+            self._drop(victim)
+            self.stats["evictions"] += 1
+            for stale in (path, path + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry["size"]
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy
+            })
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+class CacheWriter:
+    """Writes one object to a private .part file and publishes it atomically on commit"""
+
+    def __init__(self, cache, key, final_path, content_type, expected_size):
+        self.cache = cache
+        self.key = key
+        self.final_path = final_path
+        self.content_type = content_type
+        self.expected_size = expected_size
+        self.part_path = f"{final_path}.part-{uuid.uuid4().hex}"
+        self.file = open(self.part_path, 'wb')
+        self.size = 0
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        if self.size > CONTENT_CACHE_MAX_OBJECT:
+            raise OSError("object exceeds CONTENT_CACHE_MAX_OBJECT")
+
+    def commit(self):
+        self.file.close()
+        if self.expected_size is not None and self.size != self.expected_size:
+            self.abort()
+            return False
+        try:
+            self.cache.publish(self.key, self.final_path, self.part_path, self.content_type, self.size)
+            return True
+        except OSError as e:
+            print(f"Content cache publish failed for {self.key}: {e}")
+            self.abort()
+            return False
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+        with self.cache.lock:
+            self.cache.stats["aborted"] += 1
+
+content_cache = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES, CONTENT_CACHE_POLICY)
+
+# ---------- Metadata Store (SQLite, shared by all workers) ----------
+METADATA_DB_PATH = os.path.join(CACHE_DIR, 'metadata.db')
+METADATA_FIELDS = ("size", "type", "is_dir")
+# Size and directory-ness are properties of the CID itself; the reported type is the
+# gateway's guess and the sniffed MIME comes from our own detector
+METADATA_TTLS = {
+    "size": float(os.environ.get("METADATA_TTL_SIZE", str(30 * 86400))),
+    "is_dir": float(os.environ.get("METADATA_TTL_IS_DIR", str(30 * 86400))),
+    "type": float(os.environ.get("METADATA_TTL_TYPE", str(7 * 86400))),
+    "mime": float(os.environ.get("METADATA_TTL_MIME", str(30 * 86400)))
+}
+METADATA_TTL_DEGRADED = float(os.environ.get("METADATA_TTL_DEGRADED", "600"))
+METADATA_NEGATIVE_BASE = float(os.environ.get("METADATA_NEGATIVE_BASE", "30"))
+METADATA_NEGATIVE_MAX = float(os.environ.get("METADATA_NEGATIVE_MAX", "3600"))
+METADATA_WARMUP_WORKERS = int(os.environ.get("METADATA_WARMUP_WORKERS", "4"))
+METADATA_WARMUP_MAX = 1000
+METADATA_WARMUP_QUEUE_MAX = int(os.environ.get("METADATA_WARMUP_QUEUE_MAX", "2000"))
+
+metadata_local = threading.local()
+
+def get_metadata_db():
+    """Get thread-local connection to the metadata cache database"""
+    if not hasattr(metadata_local, 'connection'):
+        metadata_local.connection = sqlite3.connect(METADATA_DB_PATH, check_same_thread=False, timeout=10)
+        metadata_local.connection.execute('PRAGMA journal_mode=WAL')
+        metadata_local.connection.execute('PRAGMA synchronous=NORMAL')
+    return metadata_local.connection
+
+class MetadataStore:
+    """Per-field TTL cache of CID metadata with negative caching and backoff"""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "stores": 0, "failures": 0, "warmups": 0,
+                      "warmups_dropped": 0, "type_probes": 0, "mime_hits": 0, "mime_misses": 0}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cid_metadata (
+                cid TEXT PRIMARY KEY,
+                size INTEGER,
+                size_expires REAL,
+                type TEXT,
+                type_expires REAL,
+                is_dir INTEGER,
+                is_dir_expires REAL,
+                mime TEXT,
+                mime_expires REAL,
+                source TEXT,
+                updated_at REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cid_metadata_failures (
+                cid TEXT PRIMARY KEY,
+                failures INTEGER DEFAULT 0,
+                retry_at REAL,
+                last_error TEXT,
+                updated_at REAL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, cid, fields=METADATA_FIELDS, counters=("hits", "misses")):
+        """Fresh values for every requested field, or None if any is missing/expired.
+        counters names the (hit, miss) stats to bump, so sniffed-MIME lookups don't skew the metadata ratio"""
+        columns = ", ".join(f"{f}, {f}_expires" for f in fields)
+        row = get_metadata_db().execute(
+            f"SELECT {columns} FROM cid_metadata WHERE cid = ?", (cid,)).fetchone()
+        now = time.time()
+        if row is None or any(row[i * 2] is None or (row[i * 2 + 1] or 0) < now for i in range(len(fields))):
+            self._count(counters[1])
+            return None
+        self._count(counters[0])
+        result = {f: row[i * 2] for i, f in enumerate(fields)}
+        if "is_dir" in result:
+            result["is_dir"] = bool(result["is_dir"])
+        return result
+
+    def put(self, cid, source=None, **fields):
+        """Upsert the given fields; degraded values (size 0, unknown type) expire quickly"""
+        now = time.time()
+        assignments, params = ["updated_at = ?"], [now]
+        for name, value in fields.items():
+            if value is None:
+                continue
+            degraded = (name == "size" and not value) or (name == "type" and value == "unknown")
+            ttl = METADATA_TTL_DEGRADED if degraded else METADATA_TTLS[name]
+            assignments.append(f"{name} = ?, {name}_expires = ?")
+            params.extend([int(value) if name == "is_dir" else value, now + ttl])
+        if source:
+            assignments.append("source = ?")
+            params.append(source)
+
+        conn = get_metadata_db()
+        conn.execute("INSERT OR IGNORE INTO cid_metadata (cid, updated_at) VALUES (?, ?)", (cid, now))
+        conn.execute(f"UPDATE cid_metadata SET {', '.join(assignments)} WHERE cid = ?", params + [cid])
+        conn.execute("DELETE FROM cid_metadata_failures WHERE cid = ?", (cid,))
+        conn.commit()
+        self._count("stores")
+
+    def get_field_many(self, field, cids):
+        """Fresh values of one field for many CIDs: {cid: value} (missing/expired CIDs omitted)"""
+        found = {}
+        cids = list(cids)
+        conn = get_metadata_db()
+        now = time.time()
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(cids), 500):
+            batch = cids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT cid, {field} FROM cid_metadata WHERE cid IN ({', '.join('?' * len(batch))}) "
+                f"AND {field} IS NOT NULL AND {field}_expires >= ?", batch + [now]).fetchall()
+            for cid, value in rows:
+                found[cid] = bool(value) if field == "is_dir" else value
+        with self.lock:
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(cids) - len(found)
+        return found
+
+    def put_field_many(self, field, values, source=None):
+        """Upsert one field for many CIDs in a single transaction"""
+        if not values:
+            return
+        now = time.time()
+        expires = now + METADATA_TTLS[field]
+        conn = get_metadata_db()
+        conn.executemany(f'''
+            INSERT INTO cid_metadata (cid, {field}, {field}_expires, source, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(cid) DO UPDATE SET {field} = excluded.{field}, {field}_expires = excluded.{field}_expires,
+                updated_at = excluded.updated_at
+        ''', [(cid, int(value) if field == "is_dir" else value, expires, source, now)
+               for cid, value in values.items()])
+        conn.commit()
+        with self.lock:
+            self.stats["stores"] += len(values)
+
+    def failure_backoff(self, cid):
+        """Seconds until a recently failed CID may be looked up again (0 if allowed now)"""
+        row = get_metadata_db().execute(
+            "SELECT retry_at FROM cid_metadata_failures WHERE cid = ?", (cid,)).fetchone()
+        remaining = (row[0] - time.time()) if row else 0
+        if remaining > 0:
+            self._count("negative_hits")
+            return remaining
+        return 0
+
+    def record_failure(self, cid, error):
+        conn = get_metadata_db()
+        row = conn.execute("SELECT failures FROM cid_metadata_failures WHERE cid = ?", (cid,)).fetchone()
+        failures = (row[0] if row else 0) + 1
+        now = time.time()
+        retry_at = now + min(METADATA_NEGATIVE_BASE * 2 ** (failures - 1), METADATA_NEGATIVE_MAX)
+        conn.execute('''
+            INSERT OR REPLACE INTO cid_metadata_failures (cid, failures, retry_at, last_error, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (cid, failures, retry_at, str(error)[:500], now))
+        conn.commit()
+        self._count("failures")
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        try:
+            conn = get_metadata_db()
+            stats["entries"] = conn.execute("SELECT COUNT(*) FROM cid_metadata").fetchone()[0]
+            stats["negative_entries"] = conn.execute(
+                "SELECT COUNT(*) FROM cid_metadata_failures WHERE retry_at > ?", (time.time(),)).fetchone()[0]
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
+
+metadata_store = MetadataStore(METADATA_DB_PATH)
+metadata_warmup_pool = ThreadPoolExecutor(max_workers=METADATA_WARMUP_WORKERS, thread_name_prefix="metadata-warmup")
+# Queued + running warmups; past this, further warmups are dropped rather than queued
+metadata_warmup_slots = threading.BoundedSemaphore(METADATA_WARMUP_QUEUE_MAX)
+
+class MetadataBackoff(Exception):
+    """The CID failed recently and is in its negative-cache backoff window"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Metadata lookup failed recently; retrying in {retry_after}s")
+        self.retry_after = retry_after
+
+def cached_metadata_lookup(cid):
+    """Metadata from the shared store, else one coalesced HEAD / object stat"""
+    cached = metadata_store.get(cid)
+    if cached:
+        return {"cid": cid, **cached, "gateway_used": "metadata_cache"}
+
+    retry_in = metadata_store.failure_backoff(cid)
+    if retry_in:
+        raise MetadataBackoff(int(retry_in) + 1)
+
+    # Concurrent misses for one CID share a single HEAD / object stat
+    return single_flight.do("metadata", cid, lambda: _lookup_and_store_metadata(cid))
+
+def _lookup_and_store_metadata(cid):
+    try:
+        metadata = _get_metadata_internal(cid)
+    except Exception as e:
+        metadata_store.record_failure(cid, e)
+        raise
+    metadata["is_dir"] = bool(metadata["is_dir"])
+    metadata_store.put(cid, source=metadata.get("gateway_used"),
+                       size=metadata["size"], type=metadata["type"], is_dir=metadata["is_dir"])
+    return metadata
+
+def warm_metadata(cids):
+    """Queue background lookups for CIDs not already fresh in the store; returns the queued count"""
+    queued = 0
+    for cid in cids:
+        if metadata_store.get(cid) is None and not metadata_store.failure_backoff(cid):
+            if not metadata_warmup_slots.acquire(blocking=False):
+                metadata_store._count("warmups_dropped")
+                break
+            metadata_warmup_pool.submit(_warm_one, cid)
+            queued += 1
+    return queued
+
+def _warm_one(cid):
+    try:
+        cached_metadata_lookup(cid)
+        metadata_store._count("warmups")
+    except Exception as e:
+        print(f"Metadata warmup failed for {cid}: {e}")
+    finally:
+        metadata_warmup_slots.release()
+
+# ---------- HTTP Caching & Range Helpers ----------
+MAX_BYTE_RANGES = 16
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PRIVATE_IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def cid_etag(decoded_cid, variant=None):
+    """Strong ETag derived from the CID (+ path); a CID always names the same bytes"""
+    root, _, path = decoded_cid.partition('/')
+    if not re.fullmatch(r'[A-Za-z0-9]+', root):
+        root = hashlib.sha256(root.encode()).hexdigest()[:32]
+    tag = root
+    if path:
+        tag += '-' + hashlib.sha256(path.encode()).hexdigest()[:16]
+    if variant:
+        tag += '-' + variant
+    return f'"{tag}"'
+
+def conditional_not_modified(request, etag, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """304 when If-None-Match already names this CID; call before any gateway or ipfs work"""
+    if request.if_none_match and request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return None
+
+def requested_range(request, decoded_cid, etag=None):
+    """The client's Range header, unless If-Range says it holds a different entity
+    (etag defaults to the CID's plain content ETag)"""
+    byte_range = request.headers.get("Range")
+    if not byte_range:
+        return None
+    if_range = request.headers.get("If-Range")
+    # We never send Last-Modified, so a date-valued If-Range can never match
+    if if_range and if_range.strip() != (etag or cid_etag(decoded_cid)):
+        return None
+    return byte_range
+
+def parse_byte_ranges(range_header, size):
+    """Resolve a Range header against size: list of inclusive (start, end), [] if
+    unsatisfiable, None if the header should be ignored"""
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_BYTE_RANGES:
+        return None
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            start, stop = max(0, size + start), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop - 1))
+    return ranges
+
+def _content_range_covers_all(content_range):
+    """True for 'bytes 0-(N-1)/N', i.e. a 206 that actually carries the whole object"""
+    match = re.fullmatch(r'bytes 0-(\d+)/(\d+)', (content_range or '').strip())
+    return bool(match) and int(match.group(1)) + 1 == int(match.group(2))
+
+def _read_file_range(f, start, end):
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def unsatisfiable_range_response(size, headers):
+    headers = dict(headers)
+    # A 416 says nothing lasting about the CID, so it must not be cached as immutable
+    headers.pop("Cache-Control", None)
+    headers["Content-Range"] = f"bytes */{size}" if size is not None else "bytes */*"
+    return Response(b"", status=416, headers=headers)
+
+def byte_ranges_response(read_range, ranges, size, content_type, headers, close=None):
+    """206 for one or more byte ranges (multipart/byteranges when several), whatever holds
+    the bytes: read_range(start, end) yields one inclusive range, and close() runs once
+    the response is done with, iterated or not"""
+    if not ranges:
+        if close:
+            close()
+        return unsatisfiable_range_response(size, headers)
+
+    headers = dict(headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        body = read_range(start, end)
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [(f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+                  f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode(), start, end)
+                 for start, end in ranges]
+        closing = f"\r\n--{boundary}--\r\n".encode()
+        headers["Content-Length"] = str(sum(len(head) + end - start + 1 for head, start, end in parts) + len(closing))
+
+        def generate_multi():
+            for head, start, end in parts:
+                yield head
+                yield from read_range(start, end)
+            yield closing
+
+        body = generate_multi()
+        content_type = f"multipart/byteranges; boundary={boundary}"
+
+    return Response(ClosingIterator(body, [close] if close else []), status=206,
+                    content_type=content_type, headers=headers)
+
+def file_ranges_response(path, ranges, size, content_type, headers):
+    """206 for one or more byte ranges of a local file"""
+    f = open(path, 'rb')
+    return byte_ranges_response(lambda start, end: _read_file_range(f, start, end),
+                                ranges, size, content_type, headers, f.close)
+
+# ---------- Request Coalescing ----------
+FLIGHT_WAIT_TIMEOUT = 30
+
+coalesce_lock = Lock()
+coalesce_stats = {}  # kind -> {"leaders": n, "followers": n}
+
+def _count_flight(kind, leader):
+    with coalesce_lock:
+        counts = coalesce_stats.setdefault(kind, {"leaders": 0, "followers": 0})
+        counts["leaders" if leader else "followers"] += 1
+
+def get_coalesce_stats():
+    with coalesce_lock:
+        stats = {kind: dict(counts) for kind, counts in coalesce_stats.items()}
+    for counts in stats.values():
+        # Requests served per upstream fetch
+        counts["fan_in"] = round((counts["leaders"] + counts["followers"]) / counts["leaders"], 3) \
+            if counts["leaders"] else 0.0
+    return stats
+
+class SingleFlight:
+    """Concurrent calls for the same (kind, key) share one execution and its result"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, kind, key, fn):
+        with self.lock:
+            call = self.calls.get((kind, key))
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[(kind, key)] = call
+        _count_flight(kind, leader)
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop((kind, key), None)
+            call["event"].set()
+
+single_flight = SingleFlight()
+
+positional_io_lock = Lock()
+
+def pread(fd, size, offset):
+    """os.pread where the platform has it, else seek + read under a lock"""
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with positional_io_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+def pwrite(fd, data, offset):
+    """os.pwrite where the platform has it, else seek + write under a lock"""
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    with positional_io_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+class FlightBypass(Exception):
+    """A body too large to cache is streamed straight through rather than spooled.
+    The leader gets the response it opened; anyone who joined meanwhile opens their own."""
+
+    def __init__(self, response=None, source=None):
+        super().__init__("stream is too large to share")
+        self.response = response
+        self.source = source
+
+class StreamFlight:
+    """One upstream byte stream fanned out to every concurrent client.
+
+    A pump thread writes the body into a spool file next to the content cache entry;
+    each client reads it with pread at its own pace, so memory per client is one
+    chunk. A complete spool is published into the content cache as-is."""
+
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.ready = threading.Event()
+        self.open_error = None
+        self.readers = 0
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.closed = False
+        self.fd = None
+
+    def open(self, response, source):
+        """Leader only: attach the upstream response and start pumping"""
+        length = response.headers.get("Content-Length")
+        self.response = response
+        self.source = source
+        self.encoded = bool(response.headers.get("Content-Encoding"))
+        self.content_type = response.headers.get("Content-Type", "application/octet-stream")
+        self.content_length = int(length) if length and length.isdigit() else None
+        self.cacheable = self.content_length is None or self.content_length <= CONTENT_CACHE_MAX_OBJECT
+
+        folder, self.final_path = content_cache.paths_for(self.key)
+        os.makedirs(folder, exist_ok=True)
+        self.spool_path = f"{self.final_path}.part-{uuid.uuid4().hex}"
+        self.spool = open(self.spool_path, 'wb', buffering=0)
+        self.fd = os.open(self.spool_path, os.O_RDONLY)
+        threading.Thread(target=self._pump, daemon=True).start()
+        self.ready.set()
+
+    def _pump(self):
+        completed = False
+        try:
+            for chunk in self.response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                self.spool.write(chunk)
+                with self.cond:
+                    self.written += len(chunk)
+                    if self.written > CONTENT_CACHE_MAX_OBJECT:
+                        self.cacheable = False
+                    abandoned = self.readers == 0 and not self.cacheable
+                    self.cond.notify_all()
+                if abandoned:
+                    # Nobody is listening and the result can't be cached: stop pulling
+                    raise IOError("all clients disconnected")
+            completed = True
+        except Exception as e:
+            print(f"Shared stream for {self.key} failed: {e}")
+            self.error = e
+        finally:
+            self.response.close()
+            self.spool.close()
+            stream_flights.remove(self)
+
+            published = False
+            if completed and self.cacheable and (self.encoded or self.content_length in (None, self.written)):
+                try:
+                    content_cache.publish(self.key, self.final_path, self.spool_path, self.content_type, self.written)
+                    published = True
+                except OSError as e:
+                    print(f"Content cache publish failed for {self.key}: {e}")
+            if not published:
+                try:
+                    os.remove(self.spool_path)  # readers keep their open descriptor
+                except OSError:
+                    pass
+
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self._maybe_close()
+
+    def read(self, start=0, end=None):
+        """Bytes [start, end] as they arrive; the caller must close() the result"""
+        return _FlightBody(self, start, end)
+
+    def _read(self, start, end):
+        offset = start
+        while end is None or offset <= end:
+            with self.cond:
+                while self.written <= offset and not self.done:
+                    self.cond.wait(FLIGHT_WAIT_TIMEOUT)
+                available, done, error = self.written, self.done, self.error
+
+            if offset < available:
+                limit = available if end is None else min(available, end + 1)
+                chunk = pread(self.fd, min(STREAM_CHUNK_SIZE, limit - offset), offset)
+                if not chunk:
+                    raise IOError("shared stream spool truncated")
+                offset += len(chunk)
+                yield chunk
+            elif done:
+                if error is not None:
+                    raise IOError(f"upstream stream failed: {error}")
+                return
+
+    def leave(self):
+        with self.cond:
+            self.readers -= 1
+        self._maybe_close()
+
+    def _maybe_close(self):
+        with self.cond:
+            if self.done and self.readers <= 0 and not self.closed and self.fd is not None:
+                self.closed = True
+                os.close(self.fd)
+
+class _FlightBody:
+    """Response iterable for one flight reader; close() releases the reader even if never iterated"""
+
+    def __init__(self, flight, start, end):
+        self.flight = flight
+        self.gen = flight._read(start, end)
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.gen)
+
+    def close(self):
+        self.gen.close()
+        if not self.released:
+            self.released = True
+            self.flight.leave()
+
+class StreamFlights:
+    """Registry of in-flight upstream streams keyed by CID path"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+
+    def acquire(self, key):
+        """Join the in-flight stream for key, or become its leader and open it"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = StreamFlight(key)
+                self.flights[key] = flight
+            with flight.cond:
+                flight.readers += 1
+        _count_flight("stream", leader)
+
+        if leader:
+            try:
+                r, used_gateway = open_gateway_stream(key)
+                length = r.headers.get("Content-Length")
+                if length and length.isdigit() and int(length) > CONTENT_CACHE_MAX_OBJECT:
+                    # Spooling it would only fill the disk outside the cache's budget
+                    raise FlightBypass(r, used_gateway)
+                flight.open(r, used_gateway)
+            except Exception as e:
+                flight.open_error = FlightBypass() if isinstance(e, FlightBypass) else e
+                self.remove(flight)
+                flight.ready.set()
+                raise
+        else:
+            flight.ready.wait()
+            if flight.open_error is not None:
+                with flight.cond:
+                    flight.readers -= 1
+                raise flight.open_error
+        return flight
+
+    def join_existing(self, key, offset):
+        """Join a running flight only if byte offset is already spooled (instant seek)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None or not flight.ready.is_set() or flight.open_error is not None:
+                return None
+            with flight.cond:
+                if flight.written <= offset:
+                    return None
+                flight.readers += 1
+        _count_flight("stream", False)
+        return flight
+
+    def remove(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+stream_flights = StreamFlights()
+
+# ---------- Local Node Content ----------
+LOCAL_FIRST_ENABLED = os.environ.get("LOCAL_FIRST_ENABLED", "1") == "1"
+LOCAL_CHECK_TIMEOUT = float(os.environ.get("LOCAL_CHECK_TIMEOUT", "2"))
+LOCAL_CHECK_TTL = float(os.environ.get("LOCAL_CHECK_TTL", "600"))
+LOCAL_CHECK_NEGATIVE_TTL = float(os.environ.get("LOCAL_CHECK_NEGATIVE_TTL", "60"))
+LOCAL_CHECK_MAX_ENTRIES = 20000
+SNIFF_BYTES = 4096
+
+class LocalAvailability:
+    """Cached answer to "is this file fully in our own public node's repo?".
+
+    Checked with an offline files/stat --with-local, so a miss never waits on the
+    network. Positive answers are re-checked after LOCAL_CHECK_TTL in case the node
+    garbage-collected the blocks; negative ones after LOCAL_CHECK_NEGATIVE_TTL."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()   # cid -> (size or None, expires)
+        self.stats = {"local": 0, "remote": 0, "checks": 0, "check_errors": 0}
+
+    def _store(self, cid, size, ttl):
+        with self.lock:
+            self.entries[cid] = (size, time.time() + ttl)
+            self.entries.move_to_end(cid)
+            while len(self.entries) > LOCAL_CHECK_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def mark_local(self, cid, size):
+        """Record content we just added ourselves"""
+        self._store(cid, size, LOCAL_CHECK_TTL)
+
+    def size_if_local(self, cid):
+        """File size if every block of cid is local, else None"""
+        if not LOCAL_FIRST_ENABLED:
+            return None
+        with self.lock:
+            cached = self.entries.get(cid)
+        if cached and cached[1] > time.time():
+            size = cached[0]
+        else:
+            size = single_flight.do("local", cid, lambda: self._check(cid))
+        with self.lock:
+            self.stats["local" if size is not None else "remote"] += 1
+        return size
+
+    def _check(self, cid):
+        with self.lock:
+            self.stats["checks"] += 1
+        try:
+            stat = ipfs_public.files_stat(cid, timeout=LOCAL_CHECK_TIMEOUT, with_local=True, offline=True)
+            # Directories go to gateways, which render the listing page
+            size = stat.get("Size") if stat.get("Type") == "file" and stat.get("Local") else None
+        except Exception as e:
+            # Offline stat fails when the root block isn't local, which is the common miss
+            if not isinstance(e, IPFSError):
+                with self.lock:
+                    self.stats["check_errors"] += 1
+            size = None
+        self._store(cid, size, LOCAL_CHECK_TTL if size is not None else LOCAL_CHECK_NEGATIVE_TTL)
+        return size
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["tracked"] = len(self.entries)
+        served = stats["local"] + stats["remote"]
+        stats["local_rate"] = round(stats["local"] / served, 4) if served else 0.0
+        stats["enabled"] = LOCAL_FIRST_ENABLED
+        return stats
+
+local_content = LocalAvailability()
+mime_detector = magic.Magic(mime=True)
+mime_detector_lock = Lock()
+
+def sniff_mime(head):
+    """MIME type of the first bytes of a file (libmagic handles aren't thread-safe)"""
+    with mime_detector_lock:
+        return mime_detector.from_buffer(head)
+
+MIME_COUNTERS = ("mime_hits", "mime_misses")
+
+def local_content_type(decoded_cid):
+    """Sniffed MIME for local content, cached in the metadata store"""
+    cached = metadata_store.get(decoded_cid, ("mime",), counters=MIME_COUNTERS)
+    if cached:
+        return cached["mime"]
+    head = ipfs_public.cat(decoded_cid, length=SNIFF_BYTES, timeout=LOCAL_CHECK_TIMEOUT, offline=True).read_all()
+    mime_type = sniff_mime(head) if head else "application/octet-stream"
+    metadata_store.put(decoded_cid, source="local_node", mime=mime_type)
+    return mime_type
+
+def local_node_body(decoded_cid, offset=0, length=None, client=None):
+    """Stream (part of) a file from the local node (or the given one)"""
+    stream = (client or ipfs_public).cat(decoded_cid, offset=offset, length=length, offline=True)
+    try:
+        for chunk in stream:
+            yield chunk
+    except requests.exceptions.RequestException as e:
+        # Headers are already sent; abort the connection rather than truncate silently
+        print(f"Local node stream error for {decoded_cid}: {e}")
+        raise
+    finally:
+        stream.close()
+
+# ---------- CID Content Streaming ----------
+def _range_start(byte_range):
+    """First byte of a simple 'bytes=N-...' range, else None"""
+    match = re.fullmatch(r'bytes=(\d+)-\d*', byte_range.strip())
+    return int(match.group(1)) if match else None
+
+def open_cid_content(decoded_cid, byte_range=None):
+    """Resolve a CID to a cached file or, on a miss, a live gateway stream.
+    byte_range is forwarded to gateways so seeks don't restart from byte 0."""
+    prefetcher.note_use(decoded_cid, ("content", "head"))
+    entry = content_cache.lookup(decoded_cid)
+    if entry:
+        return {
+            "cid": decoded_cid,
+            "source": "disk_cache",
+            "content_type": entry["content_type"],
+            "content_length": entry["size"],
+            "path": entry["path"],
+            "response": None,
+            "range": byte_range
+        }
+
+    # Content we hold ourselves (e.g. our own uploads) is read from the local node
+    local_size = local_content.size_if_local(decoded_cid)
+    if local_size is not None:
+        try:
+            content_type = local_content_type(decoded_cid)
+        except Exception as e:
+            print(f"Local node read failed for {decoded_cid}, using gateways: {e}")
+        else:
+            return {
+                "cid": decoded_cid,
+                "source": "local_node",
+                "content_type": content_type,
+                "content_length": local_size,
+                "path": None,
+                "response": None,
+                "local": True,
+                "range": byte_range
+            }
+
+    # Full reads (and bytes=0-) coalesce onto one shared upstream stream; other ranges
+    # join one only when their first byte is already spooled
+    flight = None
+    r = None
+    try:
+        if byte_range is None or byte_range.strip() == "bytes=0-":
+            flight = stream_flights.acquire(decoded_cid)
+        elif _range_start(byte_range) is not None:
+            flight = stream_flights.join_existing(decoded_cid, _range_start(byte_range))
+    except FlightBypass as e:
+        r, used_gateway = e.response, e.source
+    if flight:
+        return {
+            "cid": decoded_cid,
+            "source": flight.source,
+            "content_type": flight.content_type,
+            "content_length": flight.content_length,
+            "path": None,
+            "response": None,
+            "flight": flight,
+            "range": byte_range
+        }
+
+    if r is None:
+        r, used_gateway = open_gateway_stream(decoded_cid, headers={"Range": byte_range} if byte_range else {})
+    content_length = r.headers.get("Content-Length")
+    return {
+        "cid": decoded_cid,
+        "source": used_gateway,
+        "content_type": r.headers.get("Content-Type", "application/octet-stream"),
+        "content_length": int(content_length) if content_length and content_length.isdigit() else None,
+        "path": None,
+        "response": r,
+        "range": byte_range
+    }
+
+def release_content(content):
+    """Give back what open_cid_content() holds when no response will be built from it"""
+    if content.get("flight"):
+        content["flight"].leave()
+    elif content.get("response") is not None:
+        content["response"].close()
+
+def stream_and_cache(content, skip=0, length=None, cacheable=True):
+    """Stream a gateway response to the client, teeing it into the content cache.
+    skip/length cut a byte range out of a full upstream body."""
+    r = content["response"]
+    # requests transparently decodes Content-Encoding, so Content-Length can't be checked then
+    expected = None if r.headers.get("Content-Encoding") else content["content_length"]
+    writer = content_cache.begin(content["cid"], content["content_type"], expected) if cacheable else None
+    completed = False
+    position = 0
+    try:
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if writer:
+                try:
+                    writer.write(chunk)
+                except OSError:
+                    writer.abort()
+                    writer = None
+
+            chunk_start, position = position, position + len(chunk)
+            if skip or length is not None:
+                stop = skip + length if length is not None else position
+                piece = chunk[max(0, skip - chunk_start):max(0, stop - chunk_start)]
+                if piece:
+                    yield piece
+                if position >= stop and writer is None:
+                    break
+            else:
+                yield chunk
+        completed = True
+    except Exception as e:
+        # Abort the connection rather than append text to a body clients may cache for a year
+        print(f"Stream error for {content['cid']}: {e}")
+        raise
+    finally:
+        r.close()
+        if writer:
+            if completed:
+                writer.commit()
+            else:
+                writer.abort()
+
+def content_response(content, content_type, headers):
+    """Build the (possibly partial) response for open_cid_content() output"""
+    headers = dict(headers)
+    headers["Accept-Ranges"] = "bytes"
+    headers["ETag"] = cid_etag(content["cid"])
+    headers.setdefault("Cache-Control", IMMUTABLE_CACHE_CONTROL)
+    byte_range = content.get("range")
+    size = content["content_length"]
+
+    if content["path"]:
+        ranges = parse_byte_ranges(byte_range, size) if byte_range else None
+        if ranges is not None:
+            return file_ranges_response(content["path"], ranges, size, content_type, headers)
+        # send_file hands the open file to wsgi.file_wrapper (sendfile where supported)
+        response = send_file(content["path"], mimetype=content_type, conditional=False, etag=False)
+        response.headers.update(headers)
+        return response
+
+    if content.get("local"):
+        ranges = parse_byte_ranges(byte_range, size) if byte_range else None
+        if ranges is not None:
+            return byte_ranges_response(lambda start, end: local_node_body(content["cid"], start, end - start + 1),
+                                        ranges, size, content_type, headers)
+        headers["Content-Length"] = str(size)
+        return Response(local_node_body(content["cid"]), content_type=content_type, headers=headers)
+
+    flight = content.get("flight")
+    if flight:
+        ranges = None
+        if byte_range and size is not None and not flight.encoded:
+            ranges = parse_byte_ranges(byte_range, size)
+        if ranges is not None:
+            return byte_ranges_response(flight._read, ranges, size, content_type, headers, flight.leave)
+        if size is not None and not flight.encoded:
+            headers["Content-Length"] = str(size)
+        return Response(flight.read(), content_type=content_type, headers=headers)
+
+    r = content["response"]
+    encoded = bool(r.headers.get("Content-Encoding"))
+
+    if r.status_code == 416:
+        r.close()
+        headers.pop("Cache-Control", None)
+        headers["Content-Range"] = r.headers.get("Content-Range", "bytes */*")
+        return Response(b"", status=416, headers=headers)
+
+    if r.status_code == 206:
+        # The gateway honoured the range; relay it (multi-range bodies keep their multipart type)
+        upstream_type = r.headers.get("Content-Type", content_type)
+        if upstream_type.startswith("multipart/byteranges"):
+            content_type = upstream_type
+        if r.headers.get("Content-Range"):
+            headers["Content-Range"] = r.headers["Content-Range"]
+        if size is not None and not encoded:
+            headers["Content-Length"] = str(size)
+        full = _content_range_covers_all(r.headers.get("Content-Range"))
+        return Response(ClosingIterator(stream_and_cache(content, cacheable=full), [r.close]), status=206,
+                        content_type=content_type, headers=headers)
+
+    if byte_range and size is not None and not encoded:
+        # The gateway ignored the range; cut a single range out of the full body ourselves
+        ranges = parse_byte_ranges(byte_range, size)
+        if ranges == []:
+            r.close()
+            return unsatisfiable_range_response(size, headers)
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            body = stream_and_cache(content, skip=start, length=end - start + 1,
+                                    cacheable=(start == 0 and end == size - 1))
+            body = ClosingIterator(body, [r.close])
+            return Response(body, status=206, content_type=content_type, headers=headers)
+
+    if size is not None and not encoded:
+        headers["Content-Length"] = str(size)
+    # ClosingIterator closes the upstream even if the body is never iterated
+    return Response(ClosingIterator(stream_and_cache(content), [r.close]), content_type=content_type, headers=headers)
+
 # ---------- Analytics Helper Functions ----------
 def get_client_info(request):
     """Extract client information for analytics"""
@@ -237,101 +2083,245 @@ def get_file_preview_info(filename, content_type=None):
         "can_preview": preview_type != "download"
     }
 
-def parse_ipfs_ls_output(ls_output, parent_cid):
-    """Parse IPFS ls command output"""
-    entries = []
-    for line in ls_output.strip().split("\n"):
-        if line:
-            parts = line.split(None, 2)
-            if len(parts) >= 3:
-                size, hash_cid, name = parts[0], parts[1], parts[2]
-
-                # Check if it's a directory
-                is_dir = False
-                try:
-                    ls_check = subprocess.run(
-                        ["ipfs", "ls", hash_cid], 
-                        capture_output=True, 
-                        text=True, 
-                        timeout=30
-                    )
-                    is_dir = ls_check.returncode == 0 and ls_check.stdout.strip()
-                except:
-                    pass
+# UnixFS node types reported by ls --resolve-type
+UNIXFS_DIRECTORY_TYPES = (1, 5)   # Directory, HAMTShard
+UNIXFS_FILE_TYPES = (0, 2, 4)     # Raw, File, Symlink
+LS_PROBE_WORKERS = int(os.environ.get("LS_PROBE_WORKERS", "8"))
+LS_PROBE_TIMEOUT = 30
 
-                file_type = "directory" if is_dir else mimetypes.guess_type(name)[0] or "application/octet-stream"
-                preview_info = get_file_preview_info(name, file_type)
-
-                entry = {
-                    "name": name,
-                    "cid": hash_cid,
-                    "size": int(size) if size.isdigit() else 0,
-                    "size_human": format_size(int(size)) if size.isdigit() else "0 B",
-                    "type": file_type,
-                    "is_directory": is_dir,
-                    "parent_cid": parent_cid,
-                    **preview_info
-                }
-                entries.append(entry)
+ls_probe_pool = ThreadPoolExecutor(max_workers=LS_PROBE_WORKERS, thread_name_prefix="ls-probe")
 
-    return entries
+def directory_flags(cids):
+    """is_dir for CIDs whose type ls couldn't tell us: cached values first, then
+    parallel files/stat probes (bounded by LS_PROBE_WORKERS)"""
+    flags = metadata_store.get_field_many("is_dir", cids)
+    missing = [cid for cid in dict.fromkeys(cids) if cid not in flags]
+    if not missing:
+        return flags
+
+    def probe(cid):
+        metadata_store._count("type_probes")
+        try:
+            return ipfs_public.files_stat(cid, timeout=LS_PROBE_TIMEOUT).get("Type") == "directory"
+        except Exception as e:
+            print(f"Type probe failed for {cid}: {e}")
+            return None
+
+    probed = dict(zip(missing, ls_probe_pool.map(probe, missing)))
+    found = {cid: is_dir for cid, is_dir in probed.items() if is_dir is not None}
+    metadata_store.put_field_many("is_dir", found, source="files_stat")
+    flags.update(found)
+    return flags
+
+def parse_ipfs_ls_output(links, parent_cid):
+    """Build directory entries from IPFS ls links, typed by their UnixFS node type"""
+    links = [link for link in links if link.get("Hash")]
+
+    # ls --resolve-type already reports each child's type; only probe what it left unknown
+    known, unknown = {}, []
+    for link in links:
+        if link.get("Type") in UNIXFS_DIRECTORY_TYPES:
+            known[link["Hash"]] = True
+        elif link.get("Type") in UNIXFS_FILE_TYPES:
+            known[link["Hash"]] = False
+        else:
+            unknown.append(link["Hash"])
+    metadata_store.put_field_many("is_dir", known, source="ipfs_ls")
+    if unknown:
+        known.update(directory_flags(unknown))
+
+    return [directory_entry(link.get("Name", ""), link["Hash"], int(link.get("Size") or 0),
+                            known.get(link["Hash"], False), parent_cid)
+            for link in links]
+
+def directory_entry(name, cid, size, is_dir, parent_cid):
+    """Listing entry for one directory link"""
+    file_type = "directory" if is_dir else mimetypes.guess_type(name)[0] or "application/octet-stream"
+    preview_info = get_file_preview_info(name, file_type)
+
+    return {
+        "name": name,
+        "cid": cid,
+        "size": size,
+        "size_human": format_size(size),
+        "type": file_type,
+        "is_directory": is_dir,
+        "parent_cid": parent_cid,
+        "thumbnail_url": None if is_dir else thumbnail_url_for(name, cid, preview_info["preview_type"]),
+        **preview_info
+    }
 
 # ---------- Gateway HTML Parser ----------
+GATEWAY_CID_RE = re.compile(r'/ipfs/([A-Za-z0-9]+)')
+GATEWAY_SIZE_RE = re.compile(r'^\s*([\d.,]+)\s*([kmgtpe]?)(i?)b?\s*$', re.IGNORECASE)
+GATEWAY_SIZE_POWERS = {"": 0, "k": 1, "m": 2, "g": 3, "t": 4, "p": 5, "e": 6}
+
+def parse_human_size(text):
+    """Bytes from a size as gateways render it ('1.2 kB', '3.4 MiB', '512 B'); 0 if unparseable"""
+    match = GATEWAY_SIZE_RE.match(text or "")
+    if not match:
+        return 0
+    try:
+        value = float(match.group(1).replace(',', ''))
+    except ValueError:
+        return 0
+    base = 1024 if match.group(3) else 1000
+    return int(value * base ** GATEWAY_SIZE_POWERS[match.group(2).lower()])
+
+class GatewayDirectoryParser(HTMLParser):
+    """Incremental parser for gateway directory listings; feed() may be called per chunk.
+
+    Handles the row layouts gateways render: the <table> rows of go-ipfs/Kubo gateways
+    and the <div class="type-icon"> grid of boxo-based ones (ipfs.io, cloudflare,
+    pinata). A row gives the name link, the child CID (ipfs-hash link), a folder icon
+    and the rendered size. Pages without recognisable rows fall back to every /ipfs/ link."""
+
+    def __init__(self, parent_cid):
+        super().__init__()
+        self.parent_cid = parent_cid
+        self.entries = []
+        self.loose = []       # links outside rows; only used if the page has no rows
+        self.has_rows = False
+        self.row = None
+        self.capture = None   # "name", "size" or "loose" while collecting text
+        self.loose_href = None
+        self.loose_text = ""
+
+    def _cid_for(self, href, name):
+        # Name links are /ipfs/<child> on some gateways and /ipfs/<parent>/<name> or
+        # plain relative paths on others; paths are still fetchable through a gateway
+        match = GATEWAY_CID_RE.search(href or "")
+        if match and not href[match.end():].split('?', 1)[0].strip('/'):
+            # A link to the listing itself (breadcrumb) is not an entry
+            return match.group(1) if match.group(1) != self.parent_cid else None
+        return f"{self.parent_cid}/{name}"
+
+    def _entry(self, name, href, cid, size, is_dir):
+        name = name.strip()
+        if not name or name in ('..', '.'):  # Skip parent directory links
+            return None
+        is_dir = is_dir or name.endswith('/')
+        name = name.rstrip('/')
+        cid = cid or self._cid_for(href, name)
+        if not cid:
+            return None
+        return directory_entry(name, cid, parse_human_size(size), is_dir, self.parent_cid)
+
+    def _start_row(self):
+        self._end_row()
+        self.has_rows = True
+        self.row = {"name": "", "href": None, "cid": None, "size": "", "is_dir": False}
+
+    def _end_row(self):
+        row, self.row = self.row, None
+        self.capture = None
+        if row and row["href"] is not None:
+            entry = self._entry(row["name"], row["href"], row["cid"], row["size"], row["is_dir"])
+            if entry:
+                self.entries.append(entry)
+
+    def handle_starttag(self, tag, attrs):
+        # Most tags in a listing are bare layout cells; only rows and links matter without attributes
+        if not attrs and tag not in ('tr', 'a'):
+            return
+        attrs = dict(attrs)
+        class_attr = attrs.get('class') or ''
+        classes = class_attr.split() if class_attr else ()
+
+        # Table layout opens a row with <tr>; the grid layout with its type-icon cell
+        if tag == 'tr' or ('type-icon' in classes and (self.row is None or self.row["href"] is not None)):
+            self._start_row()
+        row = self.row
+
+        if tag == 'a':
+            href = attrs.get('href') or ''
+            if row is None:
+                if href.startswith('/ipfs/'):
+                    self.capture, self.loose_href, self.loose_text = "loose", href, ""
+            elif 'ipfs-hash' in classes:
+                match = GATEWAY_CID_RE.search(href)
+                if match:
+                    row["cid"] = match.group(1)
+            elif row["href"] is None:
+                row["href"] = href
+                self.capture = "name"
+        elif row is not None:
+            if '_folder' in class_attr and any(c.endswith('_folder') for c in classes):
+                row["is_dir"] = True
+            elif tag in ('td', 'div') and row["href"] is not None and (
+                    'size' in (attrs.get('title') or '').lower()
+                    or (row["cid"] and ('no-linebreak' in classes or 'nowrap' in classes))):
+                self.capture = "size"
+                row["size"] = ""
+
+    def handle_data(self, data):
+        if self.capture == "name":
+            self.row["name"] += data
+        elif self.capture == "size":
+            self.row["size"] += data
+        elif self.capture == "loose":
+            self.loose_text += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.capture == "name":
+            self.capture = None
+        elif tag == 'a' and self.capture == "loose":
+            self.capture = None
+            entry = self._entry(self.loose_text, self.loose_href, None, "", False)
+            if entry:
+                self.loose.append(entry)
+        elif tag in ('td', 'div') and self.capture == "size":
+            self.capture = None
+        elif tag in ('tr', 'table'):
+            self._end_row()
+
+    def close(self):
+        super().close()
+        self._end_row()
+        if not self.has_rows:
+            self.entries.extend(self.loose)
+        self.loose = []
+
+    def drain(self):
+        entries, self.entries = self.entries, []
+        return entries
+
 def parse_gateway_directory_html(html_content, parent_cid):
     """Parse gateway HTML to extract directory entries"""
-
-    class DirectoryParser(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.entries = []
-            self.in_link = False
-            self.current_link = None
-            self.current_text = ""
-
-        def handle_starttag(self, tag, attrs):
-            if tag == 'a':
-                self.in_link = True
-                for attr_name, attr_value in attrs:
-                    if attr_name == 'href' and attr_value.startswith('/ipfs/'):
-                        self.current_link = attr_value.replace('/ipfs/', '')
-                        break
-
-        def handle_data(self, data):
-            if self.in_link:
-                self.current_text += data
-
-        def handle_endtag(self, tag):
-            if tag == 'a' and self.in_link:
-                if self.current_link and self.current_text.strip():
-                    name = self.current_text.strip()
-                    if name not in ['..', '.']:  # Skip parent directory links
-                        is_dir = name.endswith('/')
-                        clean_name = name.rstrip('/')
-                        file_type = "directory" if is_dir else mimetypes.guess_type(clean_name)[0] or "application/octet-stream"
-                        preview_info = get_file_preview_info(clean_name, file_type)
-
-                        self.entries.append({
-                            "name": clean_name,
-                            "cid": self.current_link.split('/')[-1] if '/' in self.current_link else self.current_link,
-                            "size": 0,
-                            "size_human": "0 B",
-                            "type": file_type,
-                            "is_directory": is_dir,
-                            "parent_cid": parent_cid,
-                            **preview_info
-                        })
-
-                self.in_link = False
-                self.current_link = None
-                self.current_text = ""
-
-    parser = DirectoryParser()
+    parser = GatewayDirectoryParser(parent_cid)
     try:
         parser.feed(html_content)
+        parser.close()
         return parser.entries
     except:
         return []
 
+def _response_charset(response):
+    # requests assumes ISO-8859-1 for text/* without a charset; listings are UTF-8
+    match = re.search(r'charset=([\w-]+)', response.headers.get('Content-Type', ''), re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+def iter_gateway_directory_entries(response, parent_cid):
+    """Yield entry batches from a streamed gateway listing page as it downloads"""
+    parser = GatewayDirectoryParser(parent_cid)
+    try:
+        decoder = codecs.getincrementaldecoder(_response_charset(response))(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    try:
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            parser.feed(decoder.decode(chunk))
+            entries = parser.drain()
+            if entries:
+                yield entries
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+        entries = parser.drain()
+        if entries:
+            yield entries
+    finally:
+        response.close()
+
 def format_size(size_bytes):
     """Format file size"""
     if size_bytes == 0: return "0 B"
@@ -538,6 +2528,7 @@ def set_gateway():
 
     if gateway_name in GATEWAYS:
         CURRENT_GATEWAY = GATEWAYS[gateway_name]
+        # The chosen gateway is now a scoring preference rather than a fixed first hop
         return jsonify({"message": f"Gateway switched to {gateway_name}", "url": CURRENT_GATEWAY}), 200
     else:
         return jsonify({"error": "Invalid gateway", "available": list(GATEWAYS.keys())}), 400
@@ -546,9 +2537,11 @@ def set_gateway():
 def get_current_gateway():
     current_name = next((k for k, v in GATEWAYS.items() if v == CURRENT_GATEWAY), "custom")
     return jsonify({
-        "current_gateway": current_name, 
+        "current_gateway": current_name,
         "url": CURRENT_GATEWAY,
-        "available_gateways": GATEWAYS
+        "available_gateways": GATEWAYS,
+        "scoreboard": gateway_router.snapshot(preferred=CURRENT_GATEWAY),
+        "hedging": get_hedge_stats()
     })
 
 # ---------- Helper Functions ----------
@@ -1074,244 +3067,1817 @@ def get_trending_cached():
 def get_trending():
     return jsonify(get_trending_cached())
 
+# ---------- Background Jobs ----------
+BACKGROUND_JOB_RETRY_AFTER = 2
+BACKGROUND_FAILURE_PRUNE_INTERVAL = 60
+
+class JobUnavailable(Exception):
+    """A derived resource that can't be served right now; status is the HTTP status"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def job_unavailable_response(e):
+    response = jsonify({"error": str(e)})
+    if e.retry_after:
+        response.headers["Retry-After"] = str(e.retry_after)
+    return response, e.status
+
+class BackgroundJobs:
+    """Keyed jobs on a bounded pool for resources derived from content (thumbnails, line
+    indexes). Concurrent callers for a key share one job; callers stop waiting after
+    wait seconds with a 503 while the job finishes and caches its result. A failure is
+    remembered for failure_ttl so a broken file isn't retried on every request."""
+
+    def __init__(self, name, workers, wait, failure_ttl, error, busy, fallback):
+        """error: the JobUnavailable subclass callers see; busy: its 503 message;
+        fallback: (status, message) remembered for any other exception"""
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.wait = wait
+        self.failure_ttl = failure_ttl
+        self.error = error
+        self.busy = busy
+        self.fallback = fallback
+        self.lock = Lock()
+        self.inflight = {}
+        self.failures = {}  # key -> (expires, status, message)
+        self.next_prune = 0
+        self.stats = {"failed": 0, "negative_hits": 0, "waits_timed_out": 0}
+
+    def run(self, key, job):
+        """job()'s result, computed here or by the job already running for key"""
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure and failure[0] > time.time():
+                self.stats["negative_hits"] += 1
+                raise self.error(failure[1], failure[2])
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.pool.submit(self._run, key, job)
+                self.inflight[key] = future
+        try:
+            return future.result(timeout=self.wait)
+        except FutureTimeout:
+            with self.lock:
+                self.stats["waits_timed_out"] += 1
+            raise self.error(503, self.busy, BACKGROUND_JOB_RETRY_AFTER)
+
+    def _run(self, key, job):
+        try:
+            return job()
+        except Exception as e:
+            print(f"{self.name} job {key} failed: {e}")
+            status, message = (e.status, str(e)) if isinstance(e, self.error) else self.fallback
+            now = time.time()
+            with self.lock:
+                self.stats["failed"] += 1
+                self.failures[key] = (now + self.failure_ttl, status, message)
+                if now >= self.next_prune:
+                    self.next_prune = now + BACKGROUND_FAILURE_PRUNE_INTERVAL
+                    self.failures = {k: v for k, v in self.failures.items() if v[0] > now}
+            raise self.error(status, message)
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self.inflight)
+            stats["remembered_failures"] = len(self.failures)
+        return stats
+
+# ---------- Text Preview and Line Paging ----------
+TEXT_PREVIEW_BYTES = int(os.environ.get("TEXT_PREVIEW_BYTES", str(64 * 1024)))
+TEXT_PREVIEW_MAX_BYTES = int(os.environ.get("TEXT_PREVIEW_MAX_BYTES", str(1024 ** 2)))
+TEXT_PAGE_DEFAULT_LINES = 200
+TEXT_PAGE_MAX_LINES = int(os.environ.get("TEXT_PAGE_MAX_LINES", "2000"))
+# Most a page returns; also the size below which a file is paged without an index
+TEXT_PAGE_MAX_BYTES = int(os.environ.get("TEXT_PAGE_MAX_BYTES", str(4 * 1024 ** 2)))
+TEXT_PREVIEW_TYPES = ("text", "code")
+LINE_INDEX_CACHE_DIR = os.path.join(CACHE_DIR, 'line_index')
+LINE_INDEX_CACHE_MAX_BYTES = int(os.environ.get("LINE_INDEX_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+LINE_INDEX_STRIDE = int(os.environ.get("LINE_INDEX_STRIDE", "1000"))
+LINE_INDEX_WORKERS = int(os.environ.get("LINE_INDEX_WORKERS", "2"))
+LINE_INDEX_WAIT = float(os.environ.get("LINE_INDEX_WAIT", "20"))
+LINE_INDEX_FAILURE_TTL = float(os.environ.get("LINE_INDEX_FAILURE_TTL", "300"))
+
+class TextPreviewUnavailable(JobUnavailable):
+    pass
+
+def read_cid_range(decoded_cid, start=0, end=None):
+    """Yield bytes [start, end] of a CID from the content cache, the local node or a gateway.
+    Nothing is opened until the first chunk is asked for."""
+    byte_range = f"bytes={start}-{'' if end is None else end}" if start or end is not None else None
+    length = None if end is None else end - start + 1
+    content = open_cid_content(decoded_cid, byte_range)
+
+    if content["path"]:
+        with open(content["path"], 'rb') as f:
+            f.seek(start)
+            while length is None or length > 0:
+                chunk = f.read(STREAM_CHUNK_SIZE if length is None else min(STREAM_CHUNK_SIZE, length))
+                if not chunk:
+                    return
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
+        return
+
+    if content.get("local"):
+        yield from local_node_body(decoded_cid, start, length)
+        return
+
+    flight = content.get("flight")
+    if flight:
+        body = flight.read(start, end)
+        try:
+            yield from body
+        finally:
+            body.close()
+        return
+
+    r = content["response"]
+    try:
+        if r.status_code == 416:
+            return
+        # A gateway that ignored the range sends the whole body; cut the slice out here
+        skip = start if r.status_code == 200 else 0
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk, skip = chunk[skip:], 0
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            if chunk:
+                yield chunk
+            if length == 0:
+                return
+    finally:
+        r.close()
+
+def read_cid_bytes(decoded_cid, start, end):
+    chunks = read_cid_range(decoded_cid, start, end)
+    try:
+        return b"".join(chunks)
+    finally:
+        chunks.close()
+
+def decode_text(data, final=True):
+    """UTF-8 with replacement; a non-final slice drops a character cut at its end"""
+    return codecs.getincrementaldecoder("utf-8")(errors="replace").decode(data, final=final)
+
+def split_text_lines(text):
+    lines = text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    return [line.rstrip("\r") for line in lines]
+
+class TextPreviewService:
+    """Bounded previews of text and code files, and pages of lines from large ones.
+
+    Paging uses a sparse line index: the byte offset of every LINE_INDEX_STRIDE-th line,
+    built in one streaming pass (which also fills the content cache) and kept in its own
+    disk cache, so any page afterwards is one ranged read of about a stride of lines.
+    Builds run on a small pool and concurrent requests for a CID share one build."""
+
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self.jobs = BackgroundJobs("line-index", workers, LINE_INDEX_WAIT, LINE_INDEX_FAILURE_TTL,
+                                   TextPreviewUnavailable, "Line index is still being built",
+                                   (502, "Content could not be read to index its lines"))
+        self.lock = Lock()
+        self.stats = {"previews": 0, "preview_bytes": 0, "truncated": 0, "pages": 0, "page_bytes": 0,
+                      "index_hits": 0, "indexes_built": 0, "bytes_indexed": 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def preview(self, cid, max_bytes):
+        """(text, truncated, bytes) for the first max_bytes of cid"""
+        # One byte past the limit tells us whether there is more, size known or not
+        data = read_cid_bytes(cid, 0, max_bytes)
+        truncated = len(data) > max_bytes
+        data = data[:max_bytes]
+        with self.lock:
+            self.stats["previews"] += 1
+            self.stats["preview_bytes"] += len(data)
+            self.stats["truncated"] += int(truncated)
+        return decode_text(data, final=not truncated), truncated, len(data)
+
+    def page(self, cid, size, offset, count):
+        """(lines, total_lines, truncated) for lines [offset, offset + count)"""
+        if size is not None and size <= TEXT_PAGE_MAX_BYTES:
+            data = read_cid_bytes(cid, 0, None)
+            self._count("pages")
+            self._count("page_bytes", len(data))
+            lines = split_text_lines(decode_text(data))
+            return lines[offset:offset + count], len(lines), False
+
+        size, total_lines, stride, offsets = self.index(cid)
+        self._count("pages")
+        if offset >= total_lines:
+            return [], total_lines, False
+
+        checkpoint = offset // stride
+        start = offsets[checkpoint]
+        after = -(-(offset + count) // stride)
+        end = offsets[after] - 1 if after < len(offsets) else size - 1
+        chunks = read_cid_range(cid, start, end)
+        try:
+            lines, truncated, read = self._collect(chunks, offset - checkpoint * stride, count)
+        finally:
+            chunks.close()
+        self._count("page_bytes", read)
+        return lines, total_lines, truncated
+
+    def _collect(self, chunks, skip, count):
+        """Skip lines without keeping them, then gather up to count lines within TEXT_PAGE_MAX_BYTES.
+        Lines are split as bytes (a UTF-8 newline byte is never part of another character),
+        so the limit counts encoded bytes and each line is decoded once."""
+        lines, pending, kept, read = [], b"", 0, 0
+        for chunk in chunks:
+            read += len(chunk)
+            parts = (pending + chunk).split(b"\n")
+            pending = parts.pop()
+            for part in parts:
+                if skip:
+                    skip -= 1
+                    continue
+                kept += len(part)
+                if kept > TEXT_PAGE_MAX_BYTES:
+                    return lines or [decode_text(part[:TEXT_PAGE_MAX_BYTES], final=False)], True, read
+                lines.append(decode_text(part).rstrip("\r"))
+                if len(lines) == count:
+                    return lines, False, read
+            if skip:
+                pending = b""  # the rest of a line being skipped is never needed
+            elif kept + len(pending) > TEXT_PAGE_MAX_BYTES:
+                return lines or [decode_text(pending[:TEXT_PAGE_MAX_BYTES], final=False)], True, read
+        if pending and not skip:
+            lines.append(decode_text(pending).rstrip("\r"))
+        return lines, False, read
+
+    def index(self, cid):
+        """(size, total_lines, stride, offsets) for cid, building the index if needed"""
+        key = f"{cid}#lines"
+        entry = self.cache.lookup(key)
+        if entry:
+            try:
+                with open(entry["path"], 'rb') as f:
+                    values = array('Q')
+                    values.frombytes(f.read())
+                self._count("index_hits")
+                return values[0], values[1], values[2], values[3:]
+            except (OSError, ValueError, IndexError) as e:
+                print(f"Line index {key} unreadable, rebuilding: {e}")
+        return self.jobs.run(key, lambda: self._build(key, cid))
+
+    def _build(self, key, cid):
+        stride = LINE_INDEX_STRIDE
+        offsets = array('Q', [0])
+        lines = position = 0
+        last = b"\n"
+        next_mark = stride
+        chunks = read_cid_range(cid)
+        try:
+            for chunk in chunks:
+                newlines = chunk.count(b"\n")
+                found = -1
+                # Only newlines that complete a stride are located; the rest are just counted
+                while lines + newlines >= next_mark:
+                    for _ in range(next_mark - lines):
+                        found = chunk.index(b"\n", found + 1)
+                    newlines -= next_mark - lines
+                    lines = next_mark
+                    offsets.append(position + found + 1)
+                    next_mark += stride
+                lines += newlines
+                position += len(chunk)
+                last = chunk[-1:]
+        finally:
+            chunks.close()
+        total_lines = lines + (1 if position and last != b"\n" else 0)
+
+        blob = (array('Q', [position, total_lines, stride]) + offsets).tobytes()
+        writer = self.cache.begin(key, "application/octet-stream", len(blob))
+        if writer is not None:
+            writer.write(blob)
+            writer.commit()
+        with self.lock:
+            self.stats["indexes_built"] += 1
+            self.stats["bytes_indexed"] += position
+        return position, total_lines, stride, offsets
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update(self.jobs.snapshot())
+        stats.update({
+            "preview_bytes_default": TEXT_PREVIEW_BYTES,
+            "stride": LINE_INDEX_STRIDE,
+            "cache": self.cache.snapshot()
+        })
+        return stats
+
+text_previews = TextPreviewService(ContentCache(LINE_INDEX_CACHE_DIR, LINE_INDEX_CACHE_MAX_BYTES), LINE_INDEX_WORKERS)
+
 # ---------- Enhanced Content Fetching ----------
-@app.route("/fetch/<cid>", methods=["GET"])
+@app.route("/fetch/<path:cid>", methods=["GET"])
 def fetch_cid_content(cid):
+    """Type of a CID and, for text and code, the first ?max_bytes= of it, or with
+    ?offset=&lines= a page of lines (&filename= helps classify code files)"""
     try:
         decoded_cid = unquote(cid.strip("/"))
+        try:
+            max_bytes = min(max(int(request.args.get("max_bytes", TEXT_PREVIEW_BYTES)), 1), TEXT_PREVIEW_MAX_BYTES)
+            offset = max(int(request.args.get("offset", 0)), 0)
+            count = min(max(int(request.args.get("lines", TEXT_PAGE_DEFAULT_LINES)), 1), TEXT_PAGE_MAX_LINES)
+        except ValueError:
+            return jsonify({"error": "max_bytes, offset and lines must be integers"}), 400
+        paged = "offset" in request.args or "lines" in request.args
 
         head_res, used_gateway = try_multiple_gateways(decoded_cid, 'head')
 
         track_view(decoded_cid, request, used_gateway)
 
         content_type = head_res.headers.get("Content-Type", "")
+        length = head_res.headers.get("Content-Length")
+        size = int(length) if length and length.isdigit() else None
+        filename = request.args.get("filename") or decoded_cid.rsplit("/", 1)[-1]
+        preview_type = get_file_preview_info(filename, content_type)["preview_type"]
 
-        text = None
-        if content_type.startswith("text/"):
-            try:
-                file_res, _ = try_multiple_gateways(decoded_cid, 'get')
-                text = file_res.content.decode("utf-8", errors="replace")
-            except Exception as e:
-                print(f"Failed to get text content: {e}")
-
-        return jsonify({
+        result = {
             "cid": decoded_cid,
             "type": content_type,
-            "text": text,
+            "text": None,
             "gateway_used": used_gateway
-        })
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        }
+        if not content_type.startswith("text/") and preview_type not in TEXT_PREVIEW_TYPES:
+            return jsonify(result)
+        result.update({"preview_type": preview_type, "size": size})
 
-# ---------- Upload Endpoint ----------
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+        if paged:
+            try:
+                lines, total_lines, truncated = text_previews.page(decoded_cid, size, offset, count)
+            except TextPreviewUnavailable as e:
+                return job_unavailable_response(e)
+            next_offset = offset + len(lines)
+            result.update({
+                "offset": offset,
+                "lines": lines,
+                "total_lines": total_lines,
+                "next_offset": next_offset if next_offset < total_lines else None,
+                "truncated": truncated
+            })
+            return jsonify(result)
 
-    file = request.files['file']
-    visibility = request.form.get('visibility', 'public')
+        try:
+            text, truncated, returned = text_previews.preview(decoded_cid, max_bytes)
+            result.update({"text": text, "truncated": truncated, "bytes_returned": returned})
+        except Exception as e:
+            print(f"Failed to get text content: {e}")
 
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+        return jsonify(result)
 
-    UPLOAD_BASE_FOLDER = os.path.join(os.getcwd(), 'uploads')
-    UPLOAD_FOLDER = os.path.join(UPLOAD_BASE_FOLDER, visibility)
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(filepath)
+# ---------- Upload Deduplication (SHA-256 -> CID) ----------
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") != "0"
+DEDUP_VERIFY_TIMEOUT = float(os.environ.get("DEDUP_VERIFY_TIMEOUT", "2"))
+SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+class ContentHashIndex:
+    """SHA-256 of uploaded bytes -> CID, per visibility (the two nodes hold different
+    content). A hit is confirmed with an offline stat before it is trusted, so content
+    the node has since garbage-collected is simply added again."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "stores": 0, "bytes_saved": 0,
+                      "prechecks": 0, "mismatches": 0}
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                sha256 TEXT NOT NULL,
+                visibility TEXT NOT NULL,
+                cid TEXT NOT NULL,
+                size INTEGER,
+                created_at REAL,
+                last_hit REAL,
+                PRIMARY KEY (sha256, visibility)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def lookup(self, sha256, visibility, size=None):
+        """CID of known content that is still on the node, else None"""
+        if not DEDUP_ENABLED or not sha256:
+            return None
+        conn = get_metadata_db()
+        row = conn.execute("SELECT cid, size FROM content_hashes WHERE sha256 = ? AND visibility = ?",
+                           (sha256, visibility)).fetchone()
+        if row is None or (size is not None and row[1] != size):
+            self._count("misses")
+            return None
+        cid, known_size = row
+        try:
+            stat = ipfs_client_for(visibility).files_stat(cid, timeout=DEDUP_VERIFY_TIMEOUT, with_local=True, offline=True)
+            present = stat.get("Local") and stat.get("Size") == known_size
+        except IPFSError:
+            present = False
+        if not present:
+            conn.execute("DELETE FROM content_hashes WHERE sha256 = ? AND visibility = ?", (sha256, visibility))
+            conn.commit()
+            self._count("stale")
+            self._count("misses")
+            return None
+        conn.execute("UPDATE content_hashes SET last_hit = ? WHERE sha256 = ? AND visibility = ?",
+                     (time.time(), sha256, visibility))
+        conn.commit()
+        with self.lock:
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += known_size or 0
+        return cid
 
+    def remember(self, sha256, visibility, cid, size):
+        if not DEDUP_ENABLED:
+            return
+        conn = get_metadata_db()
+        conn.execute(
+            "INSERT INTO content_hashes (sha256, visibility, cid, size, created_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(sha256, visibility) DO UPDATE SET cid = excluded.cid, size = excluded.size",
+            (sha256, visibility, cid, size, time.time()))
+        conn.commit()
+        self._count("stores")
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["enabled"] = DEDUP_ENABLED
+        return stats
+
+content_hashes = ContentHashIndex(METADATA_DB_PATH)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@app.route('/upload/check', methods=['GET'])
+def upload_precheck():
+    """Ask whether content is already stored before sending it: ?sha256=&size=&visibility=
+
+    Public content is answered with its CID, so the upload can be skipped. For private
+    content a hash alone doesn't prove the caller has the bytes, so the CID is never
+    revealed; the client sends the file with its sha256 field and, on a match against
+    the hash computed server-side, the IPFS add is skipped."""
+    sha256 = (request.args.get('sha256') or '').lower()
+    if not SHA256_HEX.match(sha256):
+        return jsonify({'error': 'sha256 must be 64 hex characters'}), 400
     try:
-        ipfs_env = os.environ.copy()
+        size = int(request.args['size']) if request.args.get('size') else None
+    except ValueError:
+        return jsonify({'error': 'size must be an integer'}), 400
+    visibility = 'private' if request.args.get('visibility') == 'private' else 'public'
+    content_hashes._count("prechecks")
+
+    if visibility == 'private':
+        # Not even looked up: any difference in the answer would reveal what is stored
+        return jsonify({'send_bytes': True}), 200
+    cid = content_hashes.lookup(sha256, visibility, size)
+    if cid:
+        return jsonify({'known': True, 'send_bytes': False, 'cid': cid, 'visibility': visibility}), 200
+    return jsonify({'known': False, 'send_bytes': True}), 200
+
+# ---------- Streaming Multipart Uploads ----------
+UPLOAD_READ_CHUNK = 64 * 1024
+UPLOAD_MAX_FIELD_BYTES = 64 * 1024
+UPLOAD_SPOOL_FOLDER = os.path.join(os.getcwd(), 'uploads', 'incoming')
+
+class MultipartStream:
+    """Pull-based multipart/form-data reader over the raw request body.
+
+    parts() yields ("field", name, value, None) and ("file", name, filename, chunks)
+    in arrival order without spooling anything to disk. A file's chunks are drained
+    automatically if the caller moves on without reading them."""
+
+    def __init__(self, stream, boundary):
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary.encode())
+        self.eof = False
+
+    def _next_event(self):
+        while True:
+            event = self.decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            if self.eof:
+                raise ValueError("Multipart body ended early")
+            chunk = self.stream.read(UPLOAD_READ_CHUNK)
+            if chunk:
+                self.decoder.receive_data(chunk)
+            else:
+                self.eof = True
+                self.decoder.receive_data(None)
+
+    def _data(self):
+        while True:
+            event = self._next_event()
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+    def parts(self):
+        while True:
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, Field):
+                value = b""
+                for data in self._data():
+                    value += data
+                    if len(value) > UPLOAD_MAX_FIELD_BYTES:
+                        raise ValueError(f"Form field '{event.name}' is too large")
+                yield "field", event.name, value.decode('utf-8', errors='replace'), None
+            elif isinstance(event, File):
+                chunks = self._data()
+                yield "file", event.name, event.filename, chunks
+                for _ in chunks:
+                    pass
 
-        if visibility == 'private':
-            ipfs_env["IPFS_PATH"] = os.path.expanduser("~/.ipfs-private")
-            result = subprocess.run(
-                ["ipfs", "--offline", "add", "-Q", filepath],
-                env=ipfs_env,
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=180
-            )
-        else:
-            ipfs_env["IPFS_PATH"] = os.path.expanduser("~/.ipfs")
-            result = subprocess.run(
-                ["ipfs", "add", "-Q", filepath],
-                env=ipfs_env,
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=180
-            )
-            cid = result.stdout.strip()
-            threading.Thread(target=lambda: subprocess.run(
-                ["ipfs", "dht", "provide", cid],
-                env=ipfs_env,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=300
-            ), daemon=True).start()
+def counted(chunks, totals):
+    """Pass chunks through, adding their length to totals["bytes"] and feeding
+    totals["sha256"] when present"""
+    digest = totals.get("sha256")
+    for chunk in chunks:
+        totals["bytes"] += len(chunk)
+        if digest:
+            digest.update(chunk)
+        yield chunk
+
+# ---------- Upload Admission Control ----------
+ADMISSION_CONCURRENCY = {
+    "public": int(os.environ.get("ADMISSION_CONCURRENCY_PUBLIC", "4")),
+    "private": int(os.environ.get("ADMISSION_CONCURRENCY_PRIVATE", "2"))
+}
+ADMISSION_BYTES = {
+    "public": int(os.environ.get("ADMISSION_BYTES_PUBLIC", str(2 * 1024 ** 3))),
+    "private": int(os.environ.get("ADMISSION_BYTES_PRIVATE", str(1024 ** 3)))
+}
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", "8"))
+ADMISSION_WAIT = float(os.environ.get("ADMISSION_WAIT", "10"))
+ADMISSION_SAMPLES = 200
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Caps concurrent uploads and their declared bytes for one repo. Requests that
+    don't fit wait in a short FIFO queue; a full queue is answered with 429 and a
+    wait longer than max_wait with 503, both with Retry-After."""
+
+    def __init__(self, name, max_concurrent, max_bytes, max_waiting, max_wait):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.active = 0
+        self.bytes = 0
+        self.waiting = deque()
+        self.queue_times = deque(maxlen=ADMISSION_SAMPLES)
+        self.service_times = deque(maxlen=ADMISSION_SAMPLES)
+        self.stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    def _fits(self, cost):
+        return self.active < self.max_concurrent and (self.bytes == 0 or self.bytes + cost <= self.max_bytes)
+
+    def retry_after(self):
+        """Caller holds self.cond"""
+        average = sum(self.service_times) / len(self.service_times) if self.service_times else 1.0
+        return max(1, int(average * (len(self.waiting) + 1) / max(1, self.max_concurrent) + 0.999))
+
+    def acquire(self, cost):
+        """Block until the request may run; returns (cost, admitted_at) for release()"""
+        # A single request larger than the whole budget runs alone rather than never
+        cost = min(cost, self.max_bytes)
+        arrived = time.time()
+        with self.cond:
+            if not self.waiting and self._fits(cost):
+                return self._admit(cost, arrived)
+            if len(self.waiting) >= self.max_waiting:
+                self.stats["rejected_full"] += 1
+                raise AdmissionRejected(429, f"Too many {self.name} uploads in progress", self.retry_after())
+
+            ticket = object()
+            self.waiting.append(ticket)
+            self.stats["queued"] += 1
+            deadline = arrived + self.max_wait
+            while not (self.waiting[0] is ticket and self._fits(cost)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting.remove(ticket)
+                    self.stats["rejected_timeout"] += 1
+                    self.cond.notify_all()
+                    raise AdmissionRejected(503, f"{self.name.capitalize()} uploads are saturated", self.retry_after())
+                self.cond.wait(remaining)
+            self.waiting.popleft()
+            admission = self._admit(cost, arrived)
+            self.cond.notify_all()
+            return admission
+
+    def _admit(self, cost, arrived):
+        now = time.time()
+        self.active += 1
+        self.bytes += cost
+        self.stats["admitted"] += 1
+        self.queue_times.append(now - arrived)
+        return cost, now
+
+    def release(self, admission):
+        cost, admitted_at = admission
+        with self.cond:
+            self.active -= 1
+            self.bytes -= cost
+            self.service_times.append(time.time() - admitted_at)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats.update({
+                "active": self.active,
+                "bytes_in_flight": self.bytes,
+                "waiting": len(self.waiting),
+                "max_concurrent": self.max_concurrent,
+                "max_bytes": self.max_bytes
+            })
+            samples = {"queue_ms": sorted(self.queue_times), "service_ms": sorted(self.service_times)}
+        for key, values in samples.items():
+            if values:
+                stats[key] = {
+                    "samples": len(values),
+                    "p50": round(values[len(values) // 2] * 1000, 3),
+                    "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+                    "max": round(values[-1] * 1000, 3)
+                }
+        return stats
 
-        cid = result.stdout.strip()
+upload_admission = {
+    visibility: AdmissionController(visibility, ADMISSION_CONCURRENCY[visibility], ADMISSION_BYTES[visibility],
+                                    ADMISSION_QUEUE, ADMISSION_WAIT)
+    for visibility in ("public", "private")
+}
 
+def upload_visibility(view_args):
+    """Repo an upload request targets, known before its body is read: the session's
+    own for resumable uploads, else ?visibility= (the form isn't parsed yet)"""
+    if 'session_id' in view_args:
         try:
-            os.remove(filepath)
-        except:
-            pass
+            return upload_sessions.status(view_args['session_id'])["visibility"]
+        except UploadSessionError:
+            return 'public'
+    return 'private' if request.args.get('visibility') == 'private' else 'public'
+
+def admitted_visibility(form_value):
+    """A visibility form field, which must name the repo the request was admitted for:
+    the limits were chosen from ?visibility= before the body was read. ValueError otherwise."""
+    visibility = 'private' if form_value == 'private' else 'public'
+    if visibility != upload_visibility({}):
+        raise ValueError(f"Form visibility '{visibility}' differs from the query's; "
+                         f"send ?visibility={visibility} with the request")
+    return visibility
+
+def admission_controlled(view):
+    """Admit an upload request before its body is read; its cost is Content-Length"""
+    @wraps(view)
+    def admitted(*args, **kwargs):
+        controller = upload_admission[upload_visibility(kwargs)]
+        try:
+            admission = controller.acquire(request.content_length or 0)
+        except AdmissionRejected as e:
+            response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, e.status
+        try:
+            return view(*args, **kwargs)
+        finally:
+            controller.release(admission)
+    return admitted
+
+# ---------- Upload Jobs (background ipfs add) ----------
+UPLOAD_JOB_WORKERS = {
+    "public": int(os.environ.get("UPLOAD_JOB_WORKERS_PUBLIC", "2")),
+    "private": int(os.environ.get("UPLOAD_JOB_WORKERS_PRIVATE", "2"))
+}
+UPLOAD_JOB_QUEUE_DEPTH = {
+    "public": int(os.environ.get("UPLOAD_JOB_QUEUE_PUBLIC", "16")),
+    "private": int(os.environ.get("UPLOAD_JOB_QUEUE_PRIVATE", "16"))
+}
+UPLOAD_JOB_RETENTION = int(os.environ.get("UPLOAD_JOB_RETENTION", "3600"))
+UPLOAD_JOB_RETRY_AFTER = int(os.environ.get("UPLOAD_JOB_RETRY_AFTER", "5"))
+
+class UploadQueueFull(Exception):
+    def __init__(self, visibility, retry_after):
+        super().__init__(f"{visibility} upload queue is full")
+        self.retry_after = retry_after
+
+class UploadJobs:
+    """Bounded per-visibility queues of ipfs add jobs, so long adds don't hold request
+    threads. Finished jobs stay queryable for UPLOAD_JOB_RETENTION seconds."""
+
+    def __init__(self, workers, depths):
+        self.lock = Lock()
+        self.jobs = OrderedDict()
+        self.queues = {visibility: queue.Queue(maxsize=depths[visibility]) for visibility in workers}
+        self.workers = dict(workers)
+        self.running = {visibility: 0 for visibility in workers}
+        self.durations = {visibility: deque(maxlen=50) for visibility in workers}
+        self.stats = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0}
+        for visibility, count in workers.items():
+            for i in range(count):
+                threading.Thread(target=self._work, args=(visibility,), daemon=True,
+                                 name=f"upload-{visibility}-{i}").start()
+
+    def submit(self, kind, visibility, bytes_total, fn, cleanup=None):
+        """Queue fn(progress) -> result dict. cleanup() runs once the job is finished,
+        or immediately when the queue is full (UploadQueueFull is raised)."""
+        visibility = 'private' if visibility == 'private' else 'public'
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "visibility": visibility,
+            "state": "queued",
+            "bytes_total": bytes_total,
+            "bytes_processed": 0,
+            "files": {},
+            "result": None,
+            "error": None,
+            "details": None,
+            "status_code": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None
+        }
+        with self.lock:
+            self._expire()
+            self.jobs[job["id"]] = job
+        try:
+            self.queues[visibility].put_nowait((job, fn, cleanup))
+        except queue.Full:
+            with self.lock:
+                self.jobs.pop(job["id"], None)
+                self.stats["rejected"] += 1
+            if cleanup:
+                cleanup()
+            raise UploadQueueFull(visibility, self.retry_after(visibility))
+        with self.lock:
+            self.stats["submitted"] += 1
+            return self.describe(job)
+
+    def _progress(self, job):
+        def update(name, processed):
+            with self.lock:
+                job["files"][name] = processed
+                job["bytes_processed"] = sum(job["files"].values())
+        return update
+
+    def _work(self, visibility):
+        while True:
+            job, fn, cleanup = self.queues[visibility].get()
+            with self.lock:
+                job["state"] = "running"
+                job["started"] = time.time()
+                self.running[visibility] += 1
+            try:
+                result = fn(self._progress(job))
+                with self.lock:
+                    job.update({"state": "done", "result": result, "status_code": 200})
+                    if job["bytes_total"]:
+                        job["bytes_processed"] = job["bytes_total"]
+                    self.stats["done"] += 1
+            except Exception as e:
+                if isinstance(e, IPFSTimeout):
+                    error, details, status = 'Adding to IPFS timed out', e.details, 408
+                elif isinstance(e, IPFSError):
+                    error, details, status = 'Failed to add to IPFS', e.details, 500
+                elif isinstance(e, UploadSessionError):
+                    error, details, status = str(e), None, e.status
+                else:
+                    error, details, status = str(e), None, 500
+                print(f"Upload job {job['id']} failed: {error} {details or ''}")
+                with self.lock:
+                    job.update({"state": "failed", "error": error, "details": details, "status_code": status})
+                    self.stats["failed"] += 1
+            finally:
+                if cleanup:
+                    try:
+                        cleanup()
+                    except Exception as e:
+                        print(f"Upload job {job['id']} cleanup failed: {e}")
+                with self.lock:
+                    job["finished"] = time.time()
+                    self.running[visibility] -= 1
+                    self.durations[visibility].append(job["finished"] - job["started"])
+                self.queues[visibility].task_done()
+
+    def _expire(self):
+        cutoff = time.time() - UPLOAD_JOB_RETENTION
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["finished"] and job["finished"] < cutoff]:
+            del self.jobs[job_id]
+
+    def retry_after(self, visibility):
+        """Seconds until a queue slot is likely to free up, from recent job durations"""
+        with self.lock:
+            durations = self.durations[visibility]
+            average = sum(durations) / len(durations) if durations else UPLOAD_JOB_RETRY_AFTER
+        waiting = self.queues[visibility].qsize()
+        return max(1, int(average * max(1, waiting) / max(1, self.workers[visibility]) + 0.999))
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return self.describe(job) if job else None
+
+    @staticmethod
+    def describe(job):
+        described = {key: value for key, value in job.items() if key != "files"}
+        described["status_url"] = f"/jobs/{job['id']}"
+        if job["result"]:
+            result = job["result"]
+            described["cids"] = [cid for cid in [result.get("cid") or result.get("folderCid")] if cid] + \
+                [f["cid"] for f in result.get("files", []) if f.get("cid")]
+        return described
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["tracked"] = len(self.jobs)
+            stats["queues"] = {
+                visibility: {
+                    "queued": self.queues[visibility].qsize(),
+                    "running": self.running[visibility],
+                    "workers": self.workers[visibility],
+                    "depth": self.queues[visibility].maxsize
+                }
+                for visibility in self.queues
+            }
+        return stats
 
-        return jsonify({
-            'message': 'File uploaded and added to IPFS',
-            'cid': cid,
-            'visibility': visibility
-        }), 200
+upload_jobs = UploadJobs(UPLOAD_JOB_WORKERS, UPLOAD_JOB_QUEUE_DEPTH)
 
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': 'Failed to add to IPFS', 'details': e.stderr}), 500
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Upload timeout - file too large or network slow. Please try again.'}), 408
+def async_requested(request):
+    """Clients opt in with ?async=1 or Prefer: respond-async"""
+    return request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', '')
 
-# ---------- Folder Upload Endpoint ----------
-@app.route('/upload-folder', methods=['POST'])
-def upload_folder():
-    """Handle folder upload with multiple files"""
-    if 'files' not in request.files:
-        return jsonify({'error': 'No files provided'}), 400
+def queue_upload_job(kind, visibility, bytes_total, fn, cleanup=None):
+    """Submit an upload job and build the 202 (or 429 when the queue is full) response"""
+    try:
+        job = upload_jobs.submit(kind, visibility, bytes_total, fn, cleanup)
+    except UploadQueueFull as e:
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    response = jsonify({'message': 'Upload accepted', 'job_id': job["id"], 'job': job})
+    response.headers['Location'] = job["status_url"]
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def upload_job_status(job_id):
+    job = upload_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
 
-    files = request.files.getlist('files')
-    visibility = request.form.get('visibility', 'public')
+# ---------- Upload Endpoint ----------
+def finish_file_upload(cid, visibility, size, sha256=None, deduplicated=False):
+    """Post-add bookkeeping shared by direct, queued and resumable uploads"""
+    if sha256 and not deduplicated:
+        content_hashes.remember(sha256, visibility, cid, size)
+    if visibility == 'public':
+        local_content.mark_local(cid, size)
+        if not deduplicated:
+            provide_scheduler.enqueue([cid], PROVIDE_PRIORITY_UPLOAD)
+    return {
+        'message': 'File already stored, reused existing CID' if deduplicated else 'File uploaded and added to IPFS',
+        'cid': cid,
+        'visibility': visibility,
+        'sha256': sha256,
+        'deduplicated': deduplicated
+    }
 
-    if not files:
-        return jsonify({'error': 'No files selected'}), 400
+def add_spooled_file(path, visibility, size, sha256, timeout, progress=None):
+    """Add a fully received file unless identical content is already stored"""
+    cid = content_hashes.lookup(sha256, visibility, size)
+    if cid:
+        return finish_file_upload(cid, visibility, size, sha256, deduplicated=True)
+    cid = ipfs_client_for(visibility).add_path(path, timeout=timeout, progress=progress)[-1]["Hash"]
+    return finish_file_upload(cid, visibility, size, sha256)
 
-    # Create temporary directory for folder structure
-    temp_dir = os.path.join(os.getcwd(), 'temp_uploads', str(uuid.uuid4()))
-    os.makedirs(temp_dir, exist_ok=True)
+@app.route('/upload', methods=['POST'])
+@admission_controlled
+def upload_file():
+    """Add one file to IPFS, streaming the request body into the node as it arrives.
+
+    Visibility must be known before the file part (?visibility= or a preceding form
+    field) for the body to go straight to the right node; otherwise the file is
+    spooled to disk until the rest of the form has been read. With ?async=1 the
+    file is always spooled and added by a background job (202 + job id). A visibility
+    field must agree with ?visibility= (public when absent), which chose the limits.
+
+    Content already stored (same SHA-256) is not added again: spooled files are
+    checked once received, and streamed ones when the client declares the hash up
+    front (sha256 field before the file, or X-Content-SHA256)."""
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'No file provided'}), 400
 
-    try:
-        # Extract folder structure and save files
-        folder_name = None
-        file_results = []
+    visibility = request.args.get('visibility')
+    if visibility:
+        visibility = 'private' if visibility == 'private' else 'public'
+    declared = (request.headers.get('X-Content-SHA256') or '').lower() or None
+    queued = async_requested(request)
+    result = None
+    spool_path = None
+    totals = {"bytes": 0, "sha256": hashlib.sha256()}
 
-        # Process each file and maintain directory structure
-        for i, file in enumerate(files):
-            if file.filename == '':
+    try:
+        for kind, name, value, chunks in MultipartStream(request.stream, boundary).parts():
+            if kind == "field":
+                if name == 'visibility':
+                    visibility = admitted_visibility(value)
+                elif name == 'sha256' and not declared:
+                    declared = value.strip().lower() or None
                 continue
+            if name != 'file' or result or spool_path:
+                continue
+            if not value:
+                return jsonify({'error': 'No selected file'}), 400
+
+            filename = secure_filename(value) or 'file'
+            known = content_hashes.lookup(declared, visibility) if visibility and declared else None
+            if known:
+                # The client says we already have this; hash what it sends to make sure
+                for _ in counted(chunks, totals):
+                    pass
+                if totals["sha256"].hexdigest() != declared:
+                    content_hashes._count("mismatches")
+                    return jsonify({'error': 'Uploaded content does not match the declared sha256'}), 400
+                result = finish_file_upload(known, visibility, totals["bytes"], declared, deduplicated=True)
+            elif visibility and not queued:
+                # Hashing happens in the node while the client is still uploading
+                client = ipfs_client_for(visibility)
+                cid = client.add_stream(filename, counted(chunks, totals), timeout=180)[-1]["Hash"]
+                result = finish_file_upload(cid, visibility, totals["bytes"], totals["sha256"].hexdigest())
+            else:
+                os.makedirs(UPLOAD_SPOOL_FOLDER, exist_ok=True)
+                spool_path = os.path.join(UPLOAD_SPOOL_FOLDER, f"{uuid.uuid4().hex}-{filename}")
+                with open(spool_path, 'wb') as f:
+                    for chunk in counted(chunks, totals):
+                        f.write(chunk)
+
+        if not result and not spool_path:
+            return jsonify({'error': 'No file provided'}), 400
+
+        visibility = visibility or 'public'
+        if spool_path:
+            sha256, size = totals["sha256"].hexdigest(), totals["bytes"]
+            if declared and declared != sha256:
+                content_hashes._count("mismatches")
+                return jsonify({'error': 'Uploaded content does not match the declared sha256'}), 400
+            known = content_hashes.lookup(sha256, visibility, size)
+            if known:
+                result = finish_file_upload(known, visibility, size, sha256, deduplicated=True)
+            elif queued:
+                path = spool_path
+                spool_path = None  # owned by the job from here on
+                return queue_upload_job(
+                    "file", visibility, size,
+                    lambda progress: add_spooled_file(path, visibility, size, sha256, UPLOAD_FINALIZE_TIMEOUT, progress),
+                    cleanup=lambda: os.remove(path))
+            else:
+                result = add_spooled_file(spool_path, visibility, size, sha256, 180)
+        return jsonify(result), 200
 
-            # Get the relative path for this file
-            path_key = f'paths_{i}'
-            relative_path = request.form.get(path_key, file.filename)
+    except ValueError as e:
+        return jsonify({'error': 'Malformed upload', 'details': str(e)}), 400
+    except IPFSTimeout:
+        return jsonify({'error': 'Upload timeout - file too large or network slow. Please try again.'}), 408
+    except IPFSError as e:
+        return jsonify({'error': 'Failed to add to IPFS', 'details': e.details}), 500
+    finally:
+        if spool_path:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
+
+# ---------- Provide Scheduler (batched DHT announcements) ----------
+PROVIDE_WORKERS = int(os.environ.get("PROVIDE_WORKERS", "1"))
+PROVIDE_BATCH = int(os.environ.get("PROVIDE_BATCH", "32"))
+PROVIDE_TIMEOUT = int(os.environ.get("PROVIDE_TIMEOUT", "300"))
+PROVIDE_MAX_ATTEMPTS = int(os.environ.get("PROVIDE_MAX_ATTEMPTS", "8"))
+PROVIDE_BACKOFF_BASE = float(os.environ.get("PROVIDE_BACKOFF_BASE", "30"))
+PROVIDE_BACKOFF_MAX = float(os.environ.get("PROVIDE_BACKOFF_MAX", "3600"))
+PROVIDE_RETENTION = float(os.environ.get("PROVIDE_RETENTION", str(7 * 86400)))
+PROVIDE_PRIORITY_UPLOAD = 10
+
+class ProvideScheduler:
+    """Persistent, deduplicated queue of CIDs to announce, drained in batches by a fixed
+    number of workers. Rows live in metadata.db so pending provides survive restarts;
+    workers claim rows atomically, so several processes can share the queue."""
+
+    def __init__(self, path, client, workers):
+        self.client = client
+        self.lock = Lock()
+        self.wake = threading.Event()
+        self.stats = {"enqueued": 0, "deduplicated": 0, "batches": 0, "provided": 0,
+                      "retries": 0, "failed": 0}
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS provide_queue (
+                cid TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                priority INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                claimed_by TEXT,
+                claimed_at REAL,
+                last_error TEXT,
+                enqueued_at REAL,
+                provided_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS provide_queue_due ON provide_queue (state, priority, next_attempt)')
+        # Batches claimed by a process that died are handed back once they can't still be running
+        conn.execute("UPDATE provide_queue SET state = 'pending', claimed_by = NULL "
+                     "WHERE state = 'providing' AND claimed_at < ?", (time.time() - PROVIDE_TIMEOUT,))
+        conn.commit()
+        conn.close()
+        for i in range(workers):
+            threading.Thread(target=self._work, daemon=True, name=f"provide-{i}").start()
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def enqueue(self, cids, priority=0):
+        """Queue CIDs for announcement; CIDs already queued keep their place (and get
+        the higher priority), CIDs already provided are left alone, failed ones restart"""
+        now = time.time()
+        conn = get_metadata_db()
+        cids = list(dict.fromkeys(cids))
+        added = 0
+        for cid in cids:
+            row = conn.execute("SELECT state FROM provide_queue WHERE cid = ?", (cid,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO provide_queue (cid, state, priority, next_attempt, enqueued_at) "
+                    "VALUES (?, 'pending', ?, ?, ?)", (cid, priority, now, now))
+                added += 1
+            elif row[0] == 'failed':
+                # Explicitly queued again: start over with a fresh retry budget
+                conn.execute(
+                    "UPDATE provide_queue SET state = 'pending', priority = ?, attempts = 0, next_attempt = ?, "
+                    "enqueued_at = ? WHERE cid = ?", (priority, now, now, cid))
+                added += 1
+            elif row[0] == 'pending':
+                conn.execute("UPDATE provide_queue SET priority = MAX(priority, ?) WHERE cid = ?", (priority, cid))
+        conn.commit()
+        self._count("enqueued", added)
+        self._count("deduplicated", len(cids) - added)
+        self.wake.set()
+
+    def _claim(self, token):
+        conn = get_metadata_db()
+        conn.execute(
+            "UPDATE provide_queue SET state = 'providing', claimed_by = ?, claimed_at = ? "
+            "WHERE cid IN (SELECT cid FROM provide_queue WHERE state = 'pending' AND next_attempt <= ? "
+            "ORDER BY priority DESC, next_attempt LIMIT ?)",
+            (token, time.time(), time.time(), PROVIDE_BATCH))
+        conn.commit()
+        return [row[0] for row in conn.execute(
+            "SELECT cid FROM provide_queue WHERE claimed_by = ? AND state = 'providing'", (token,))]
+
+    def _next_due(self):
+        row = get_metadata_db().execute(
+            "SELECT MIN(next_attempt) FROM provide_queue WHERE state = 'pending'").fetchone()
+        return row[0] if row and row[0] is not None else None
+
+    def _release(self, token):
+        """Return rows a failed batch left in 'providing' to the queue"""
+        conn = get_metadata_db()
+        conn.execute("UPDATE provide_queue SET state = 'pending', claimed_by = NULL "
+                     "WHERE claimed_by = ? AND state = 'providing'", (token,))
+        conn.commit()
 
-            # Extract folder name from first file's path
-            if folder_name is None and '/' in relative_path:
-                folder_name = relative_path.split('/')[0]
-            elif folder_name is None:
-                folder_name = f"uploaded_folder_{int(time.time())}"
+    def _work(self):
+        while True:
+            token = uuid.uuid4().hex
+            try:
+                batch = self._claim(token)
+                if not batch:
+                    self._idle()
+                    continue
+                try:
+                    self._provide(batch)
+                finally:
+                    self._release(token)
+            except Exception as e:
+                print(f"Provide scheduler error: {e}")
+                time.sleep(5)
+
+    def _idle(self):
+        due = self._next_due()
+        timeout = PROVIDE_BACKOFF_MAX if due is None else max(0.0, due - time.time())
+        self.wake.wait(timeout)
+        self.wake.clear()
+        conn = get_metadata_db()
+        conn.execute("DELETE FROM provide_queue WHERE state IN ('done', 'failed') AND enqueued_at < ?",
+                     (time.time() - PROVIDE_RETENTION,))
+        conn.commit()
 
-            # Create directory structure
-            file_path = os.path.join(temp_dir, relative_path)
-            file_dir = os.path.dirname(file_path)
-            os.makedirs(file_dir, exist_ok=True)
+    def _provide(self, batch):
+        self._count("batches")
+        conn = get_metadata_db()
+        placeholders = ",".join("?" * len(batch))
+        try:
+            self.client.provide(batch, timeout=PROVIDE_TIMEOUT)
+        except Exception as e:
+            error = getattr(e, "details", None) or str(e)
+            print(f"Provide failed for {len(batch)} CID(s): {error}")
+            rows = conn.execute(f"SELECT cid, attempts FROM provide_queue WHERE cid IN ({placeholders})",
+                                batch).fetchall()
+            for cid, attempts in rows:
+                attempts += 1
+                if attempts >= PROVIDE_MAX_ATTEMPTS:
+                    state, next_attempt = 'failed', None
+                    self._count("failed")
+                else:
+                    state = 'pending'
+                    next_attempt = time.time() + min(PROVIDE_BACKOFF_BASE * 2 ** (attempts - 1), PROVIDE_BACKOFF_MAX)
+                    self._count("retries")
+                conn.execute(
+                    "UPDATE provide_queue SET state = ?, attempts = ?, next_attempt = ?, last_error = ?, "
+                    "claimed_by = NULL WHERE cid = ?",
+                    (state, attempts, next_attempt, error[:500], cid))
+            conn.commit()
+            return
+        conn.execute(
+            f"UPDATE provide_queue SET state = 'done', attempts = attempts + 1, provided_at = ?, "
+            f"last_error = NULL, claimed_by = NULL WHERE cid IN ({placeholders})",
+            [time.time()] + batch)
+        conn.commit()
+        self._count("provided", len(batch))
+
+    def status(self, cid):
+        row = get_metadata_db().execute(
+            "SELECT state, priority, attempts, next_attempt, last_error, enqueued_at, provided_at "
+            "FROM provide_queue WHERE cid = ?", (cid,)).fetchone()
+        if row is None:
+            return None
+        keys = ("state", "priority", "attempts", "next_attempt", "last_error", "enqueued_at", "provided_at")
+        return {"cid": cid, **dict(zip(keys, row))}
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        try:
+            stats["queue"] = dict(get_metadata_db().execute(
+                "SELECT state, COUNT(*) FROM provide_queue GROUP BY state").fetchall())
+        except sqlite3.Error as e:
+            stats["queue_error"] = str(e)
+        return stats
+
+provide_scheduler = ProvideScheduler(METADATA_DB_PATH, ipfs_public, PROVIDE_WORKERS)
+
+@app.route('/provide/<cid>', methods=['GET'])
+def provide_status(cid):
+    """Announcement state of a public upload: pending, providing, done or failed"""
+    status = provide_scheduler.status(cid)
+    if not status:
+        return jsonify({'error': 'CID is not in the provide queue'}), 404
+    return jsonify(status), 200
+
+# ---------- Resumable Upload Sessions ----------
+UPLOAD_SESSION_FOLDER = os.path.join(os.getcwd(), 'uploads', 'sessions')
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_SESSION_GC_INTERVAL = int(os.environ.get("UPLOAD_SESSION_GC_INTERVAL", "600"))
+UPLOAD_SESSION_MAX_BYTES = int(os.environ.get("UPLOAD_SESSION_MAX_BYTES", str(64 * 1024 ** 3)))
+UPLOAD_SESSION_CHUNK = int(os.environ.get("UPLOAD_SESSION_CHUNK", str(8 * 1024 * 1024)))
+UPLOAD_FINALIZE_TIMEOUT = int(os.environ.get("UPLOAD_FINALIZE_TIMEOUT", "1800"))
+UPLOAD_SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadSessionError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def merge_ranges(ranges):
+    """Merge half-open [start, end) byte ranges into a sorted, non-overlapping list"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class UploadSessions:
+    """Resumable uploads: chunks land at their offsets in one preallocated file under
+    uploads/sessions/<id>/, received ranges are persisted next to it, and the file is
+    added to IPFS once on finalize. Sessions survive restarts and are swept after
+    UPLOAD_SESSION_TTL seconds without activity."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.sessions = {}
+        self.stats = {"created": 0, "chunks": 0, "bytes": 0, "partial_chunks": 0,
+                      "finalized": 0, "failed": 0, "aborted": 0, "expired": 0}
+        os.makedirs(root, exist_ok=True)
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def _paths(self, session_id):
+        folder = os.path.join(self.root, session_id)
+        return folder, os.path.join(folder, 'data'), os.path.join(folder, 'session.json')
+
+    def _save(self, session):
+        _, _, meta_path = self._paths(session["id"])
+        part = f"{meta_path}.part-{uuid.uuid4().hex}"
+        with open(part, 'w') as f:
+            json.dump(session, f)
+        os.replace(part, meta_path)
+
+    def _get(self, session_id):
+        """Caller holds self.lock; falls back to disk for sessions from a previous run"""
+        if not UPLOAD_SESSION_ID.match(session_id or ''):
+            raise UploadSessionError("Upload session not found", 404)
+        session = self.sessions.get(session_id)
+        if session is None:
+            try:
+                with open(self._paths(session_id)[2]) as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                raise UploadSessionError("Upload session not found", 404)
+            if session["state"] == "finalizing":
+                # The process died mid-add; the data is still there, so allow a retry
+                session["state"] = "open"
+            self.sessions[session_id] = session
+        return session
+
+    def create(self, filename, size, visibility):
+        if size < 0 or size > UPLOAD_SESSION_MAX_BYTES:
+            raise UploadSessionError(f"size must be between 0 and {UPLOAD_SESSION_MAX_BYTES} bytes")
+        session = {
+            "id": uuid.uuid4().hex,
+            "filename": secure_filename(filename) or 'file',
+            "size": size,
+            "visibility": 'private' if visibility == 'private' else 'public',
+            "received": [],
+            "state": "open",
+            "cid": None,
+            "error": None,
+            "created": time.time(),
+            "updated": time.time()
+        }
+        folder, data_path, _ = self._paths(session["id"])
+        os.makedirs(folder)
+        with open(data_path, 'wb') as f:
+            f.truncate(size)
+        with self.lock:
+            self._save(session)
+            self.sessions[session["id"]] = session
+            self.stats["created"] += 1
+        return self.describe(session)
+
+    def write(self, session_id, offset, length, stream):
+        """Copy one chunk from stream into place. Whatever arrives before a disconnect
+        is kept, so the client can resume from the reported missing ranges."""
+        with self.lock:
+            session = self._get(session_id)
+            if session["state"] != "open":
+                raise UploadSessionError(f"Upload session is {session['state']}", 409)
+            size = session["size"]
+        if offset < 0 or length < 0 or offset + length > size:
+            raise UploadSessionError(f"Chunk {offset}+{length} is outside the {size} byte upload", 416)
+
+        written = 0
+        fd = None
+        try:
+            # Opened inside the try: an abort or expiry may have removed the file already
+            fd = os.open(self._paths(session_id)[1], os.O_WRONLY | getattr(os, "O_BINARY", 0))
+            while written < length:
+                chunk = memoryview(stream.read(min(UPLOAD_READ_CHUNK, length - written)))
+                if not chunk:
+                    break
+                while chunk:
+                    n = pwrite(fd, chunk, offset + written)
+                    written += n
+                    chunk = chunk[n:]
+        except (OSError, ClientDisconnected) as e:
+            print(f"Upload session {session_id}: chunk at {offset} interrupted after {written} bytes: {e}")
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        with self.lock:
+            if self.sessions.get(session_id) is not session:
+                raise UploadSessionError("Upload session not found", 404)
+            if written:
+                session["received"] = merge_ranges(session["received"] + [[offset, offset + written]])
+            session["updated"] = time.time()
+            self._save(session)
+            self.stats["chunks"] += 1
+            self.stats["bytes"] += written
+            if written < length:
+                self.stats["partial_chunks"] += 1
+            return self.describe(session)
+
+    def status(self, session_id):
+        with self.lock:
+            return self.describe(self._get(session_id))
+
+    def finalize(self, session_id, progress=None):
+        """Add the assembled file to IPFS exactly once; repeated calls return the same CID"""
+        with self.lock:
+            session = self._get(session_id)
+            if session["state"] == "complete":
+                return self.describe(session)
+            if session["state"] == "finalizing":
+                raise UploadSessionError("Upload session is already being finalized", 409)
+            if self._missing(session):
+                raise UploadSessionError("Upload is incomplete", 409)
+            session["state"] = "finalizing"
+            self._save(session)
+
+        _, data_path, _ = self._paths(session_id)
+        try:
+            sha256 = file_sha256(data_path)
+            cid = content_hashes.lookup(sha256, session["visibility"], session["size"])
+            deduplicated = cid is not None
+            if not deduplicated:
+                cid = ipfs_client_for(session["visibility"]).add_path(
+                    data_path, timeout=UPLOAD_FINALIZE_TIMEOUT, progress=progress)[-1]["Hash"]
+        except Exception as e:
+            # Anything that stops the add (not just IPFS errors) must reopen the session,
+            # or retries, abort and gc would all refuse it until a restart
+            with self.lock:
+                session["state"] = "open"
+                session["error"] = (e.details if isinstance(e, IPFSError) else None) or str(e)
+                session["updated"] = time.time()
+                self._save(session)
+                self.stats["failed"] += 1
+            raise
 
-            # Save file
-            file.save(file_path)
+        try:
+            os.remove(data_path)
+        except OSError:
+            pass
+        with self.lock:
+            session.update({"state": "complete", "cid": cid, "sha256": sha256, "deduplicated": deduplicated,
+                            "error": None, "updated": time.time()})
+            self._save(session)
+            self.stats["finalized"] += 1
+            return self.describe(session)
+
+    def abort(self, session_id):
+        with self.lock:
+            session = self._get(session_id)
+            if session["state"] == "finalizing":
+                raise UploadSessionError("Upload session is being finalized", 409)
+            self.sessions.pop(session_id, None)
+            self.stats["aborted"] += 1
+        shutil.rmtree(self._paths(session_id)[0], ignore_errors=True)
+
+    def gc(self):
+        """Remove sessions (open or finished) idle for longer than UPLOAD_SESSION_TTL"""
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return 0
+        removed = 0
+        for name in names:
+            folder, _, meta_path = self._paths(name)
+            with self.lock:
+                session = self.sessions.get(name)
+                if session and session["state"] == "finalizing":
+                    continue
+                try:
+                    updated = session["updated"] if session else os.path.getmtime(meta_path)
+                except OSError:
+                    updated = os.path.getmtime(folder) if os.path.isdir(folder) else 0
+                if updated > cutoff:
+                    continue
+                self.sessions.pop(name, None)
+                self.stats["expired"] += 1
+            shutil.rmtree(folder, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(UPLOAD_SESSION_GC_INTERVAL)
+            try:
+                removed = self.gc()
+                if removed:
+                    print(f"Upload sessions: removed {removed} stale session(s)")
+            except Exception as e:
+                print(f"Upload session GC failed: {e}")
+
+    def start_gc(self):
+        self.gc()
+        threading.Thread(target=self._gc_loop, daemon=True, name="upload-session-gc").start()
+
+    @staticmethod
+    def _missing(session):
+        missing, position = [], 0
+        for start, end in session["received"]:
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if position < session["size"]:
+            missing.append([position, session["size"]])
+        return missing
+
+    def describe(self, session):
+        received = sum(end - start for start, end in session["received"])
+        return {
+            "id": session["id"],
+            "filename": session["filename"],
+            "size": session["size"],
+            "visibility": session["visibility"],
+            "state": session["state"],
+            "received_bytes": received,
+            "received": [list(r) for r in session["received"]],
+            "missing": self._missing(session),
+            "chunk_size": UPLOAD_SESSION_CHUNK,
+            "cid": session["cid"],
+            "sha256": session.get("sha256"),
+            "deduplicated": session.get("deduplicated", False),
+            "error": session["error"],
+            "expires_at": session["updated"] + UPLOAD_SESSION_TTL
+        }
 
-            file_results.append({
-                'path': relative_path,
-                'size': os.path.getsize(file_path),
-                'type': mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-            })
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["active"] = sum(1 for s in self.sessions.values() if s["state"] != "complete")
+        return stats
+
+upload_sessions = UploadSessions(UPLOAD_SESSION_FOLDER)
+upload_sessions.start_gc()
+
+def chunk_offset(request):
+    """Offset and length of a chunk from Content-Range (bytes a-b/total) or ?offset="""
+    content_range = request.headers.get('Content-Range')
+    length = request.content_length
+    if content_range:
+        match = re.match(r'^bytes (\d+)-(\d+)/(\d+|\*)$', content_range.strip())
+        if not match:
+            raise UploadSessionError("Malformed Content-Range")
+        start, end = int(match.group(1)), int(match.group(2))
+        if end < start or (length is not None and length != end - start + 1):
+            raise UploadSessionError("Content-Range does not match the body length")
+        return start, end - start + 1
+    if length is None:
+        raise UploadSessionError("Content-Length is required", 411)
+    try:
+        return int(request.args.get('offset', 0)), length
+    except ValueError:
+        raise UploadSessionError("offset must be an integer")
+
+@app.route('/upload/sessions', methods=['POST'])
+def create_upload_session():
+    """Start a resumable upload: {"filename", "size", "visibility"}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size is required'}), 400
+    if not data.get('filename'):
+        return jsonify({'error': 'filename is required'}), 400
+    try:
+        return jsonify(upload_sessions.create(data['filename'], size, data.get('visibility', 'public'))), 201
+    except UploadSessionError as e:
+        return jsonify({'error': str(e)}), e.status
+
+@app.route('/upload/sessions/<session_id>', methods=['PUT', 'PATCH'])
+@admission_controlled
+def upload_session_chunk(session_id):
+    """Write one chunk; chunks may arrive in any order and in parallel"""
+    try:
+        offset, length = chunk_offset(request)
+        return jsonify(upload_sessions.write(session_id, offset, length, request.stream)), 200
+    except UploadSessionError as e:
+        return jsonify({'error': str(e)}), e.status
 
-        # Upload folder to IPFS
-        ipfs_env = os.environ.copy()
-
-        if visibility == 'private':
-            ipfs_env["IPFS_PATH"] = os.path.expanduser("~/.ipfs-private")
-            # Use --offline for private uploads
-            result = subprocess.run(
-                ["ipfs", "--offline", "add", "-r", "-Q", temp_dir],
-                env=ipfs_env,
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=300
-            )
+@app.route('/upload/sessions/<session_id>', methods=['GET'])
+def upload_session_status(session_id):
+    try:
+        return jsonify(upload_sessions.status(session_id)), 200
+    except UploadSessionError as e:
+        return jsonify({'error': str(e)}), e.status
+
+def finish_upload_session(session_id, progress=None):
+    session = upload_sessions.finalize(session_id, progress)
+    result = finish_file_upload(session["cid"], session["visibility"], session["size"],
+                                session["sha256"], session["deduplicated"])
+    result['session'] = session
+    return result
+
+@app.route('/upload/sessions/<session_id>/finalize', methods=['POST'])
+@admission_controlled
+def finalize_upload_session(session_id):
+    """Add the finished upload to IPFS; with ?async=1 the add runs as a background job"""
+    try:
+        if async_requested(request):
+            session = upload_sessions.status(session_id)
+            if session["state"] != "complete":
+                if session["missing"]:
+                    return jsonify({'error': 'Upload is incomplete'}), 409
+                return queue_upload_job("session", session["visibility"], session["size"],
+                                        lambda progress: finish_upload_session(session_id, progress))
+        return jsonify(finish_upload_session(session_id)), 200
+    except UploadSessionError as e:
+        return jsonify({'error': str(e)}), e.status
+    except IPFSTimeout:
+        return jsonify({'error': 'Adding the upload to IPFS timed out. Finalize can be retried.'}), 408
+    except IPFSError as e:
+        return jsonify({'error': 'Failed to add to IPFS', 'details': e.details}), 500
+
+@app.route('/upload/sessions/<session_id>', methods=['DELETE'])
+def abort_upload_session(session_id):
+    try:
+        upload_sessions.abort(session_id)
+        return jsonify({'message': 'Upload session removed'}), 200
+    except UploadSessionError as e:
+        return jsonify({'error': str(e)}), e.status
+
+# ---------- Folder Upload Endpoint ----------
+FOLDER_WRITE_WORKERS = int(os.environ.get("FOLDER_WRITE_WORKERS", "8"))
+FOLDER_SMALL_FILE = 1024 * 1024
+folder_write_pool = ThreadPoolExecutor(max_workers=FOLDER_WRITE_WORKERS, thread_name_prefix="folder-write")
+
+DRIVE_PREFIX = re.compile(r'^[A-Za-z]:')
+
+def safe_relative_path(relative_path):
+    """Client-supplied folder path with names kept as sent. Raises ValueError for absolute
+    paths, drive prefixes and empty, '.' or '..' segments rather than rewriting them."""
+    segments = relative_path.replace('\\', '/').split('/')
+    for segment in segments:
+        if segment in ('', '.', '..') or '\0' in segment or DRIVE_PREFIX.match(segment):
+            raise ValueError(f"Unsafe path in folder upload: {relative_path!r}")
+    return '/'.join(segments)
+
+class FolderSpool:
+    """Writes folder upload parts under root as they are parsed. Small files are handed
+    to a writer pool so file creation overlaps parsing the rest of the body; bigger
+    ones stream straight to disk. At most 4 small files per writer are in flight."""
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {root}
+        self.dirs_lock = Lock()
+        self.slots = threading.Semaphore(FOLDER_WRITE_WORKERS * 4)
+        self.futures = []
+        self.files = set()
+        self.folders = set()
+
+    def claim(self, relative_path):
+        """Reserve relative_path for one file; ValueError if another file or folder has it"""
+        segments = relative_path.split('/')
+        parents = {'/'.join(segments[:i]) for i in range(1, len(segments))}
+        if relative_path in self.files or relative_path in self.folders or parents & self.files:
+            raise ValueError(f"More than one file in the upload has the path {relative_path!r}")
+        self.files.add(relative_path)
+        self.folders |= parents
+
+    def path_for(self, relative_path):
+        return os.path.join(self.root, *relative_path.split('/'))
+
+    def _ensure_dir(self, folder):
+        with self.dirs_lock:
+            if folder in self.dirs:
+                return
+        os.makedirs(folder, exist_ok=True)
+        with self.dirs_lock:
+            self.dirs.add(folder)
+
+    def _write_small(self, dest, data):
+        try:
+            self._ensure_dir(os.path.dirname(dest))
+            with open(dest, 'wb') as f:
+                f.write(data)
+        finally:
+            self.slots.release()
+
+    def write(self, dest, chunks):
+        """Consume one file part into dest; returns its size"""
+        head = bytearray()
+        for chunk in chunks:
+            head += chunk
+            if len(head) > FOLDER_SMALL_FILE:
+                break
         else:
-            ipfs_env["IPFS_PATH"] = os.path.expanduser("~/.ipfs")
-            # Upload recursively to maintain folder structure
-            result = subprocess.run(
-                ["ipfs", "add", "-r", "-Q", temp_dir],
-                env=ipfs_env,
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=300
-            )
+            self.slots.acquire()
+            self.futures.append(folder_write_pool.submit(self._write_small, dest, bytes(head)))
+            return len(head)
+
+        self._ensure_dir(os.path.dirname(dest))
+        size = len(head)
+        with open(dest, 'wb') as f:
+            f.write(head)
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def move(self, src, dest):
+        self._ensure_dir(os.path.dirname(dest))
+        os.replace(src, dest)
+
+    def wait(self):
+        """Block until queued writes are on disk, re-raising the first failure"""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+def add_folder(temp_dir, folder_name, file_results, visibility, progress=None):
+    """Add a saved folder tree to IPFS and build the /upload-folder response"""
+    client = ipfs_client_for(visibility)
+    added = client.add_path(temp_dir, recursive=True, timeout=300, progress=progress)
+
+    # Root folder is the last entry; files are matched by their path inside it
+    folder_cid = added[-1]["Hash"] if added else None
+
+    if not folder_cid:
+        raise Exception("No CID returned from IPFS")
+
+    root_name = added[-1].get("Name", "")
+    added_cids = {entry.get("Name", ""): entry["Hash"] for entry in added}
+    for file_result in file_results:
+        cid = added_cids.get(f"{root_name}/{file_result['path']}")
+        if cid:
+            file_result['cid'] = cid
+
+    # Provide to DHT for public uploads, and index the tree for browsing and search
+    if visibility == 'public':
+        provide_scheduler.enqueue([folder_cid], PROVIDE_PRIORITY_UPLOAD)
+        dag_indexer.start(folder_cid)
+
+    # Calculate total size
+    total_size = sum(f['size'] for f in file_results)
 
-        # Parse IPFS output - last line is the folder CID
-        output_lines = result.stdout.strip().split('\n')
-        folder_cid = output_lines[-1] if output_lines else None
+    return {
+        'success': True,
+        'message': 'Folder uploaded successfully to IPFS',
+        'folderCid': folder_cid,
+        'folderName': folder_name,
+        'visibility': visibility,
+        'totalSize': total_size,
+        'fileCount': len(file_results),
+        'files': file_results
+    }
 
-        if not folder_cid:
-            raise Exception("No CID returned from IPFS")
+@app.route('/upload-folder', methods=['POST'])
+@admission_controlled
+def upload_folder():
+    """Handle folder upload with multiple files.
 
-        # Get individual file CIDs from output
-        individual_cids = output_lines[:-1] if len(output_lines) > 1 else []
+    The body is parsed as a stream: each 'files' part is written under the temp folder
+    while the rest is still arriving. A file's paths_<i> field should precede it so it
+    lands in place directly; otherwise it is parked and moved once its path is known."""
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'No files provided'}), 400
 
-        # Update file results with CIDs
-        for i, cid in enumerate(individual_cids):
-            if i < len(file_results):
-                file_results[i]['cid'] = cid
+    visibility = upload_visibility({})
 
-        # Provide to DHT for public uploads
-        if visibility == 'public':
-            threading.Thread(target=lambda: subprocess.run(
-                ["ipfs", "dht", "provide", folder_cid],
-                env=ipfs_env,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=300
-            ), daemon=True).start()
+    # Create temporary directory for folder structure
+    temp_dir = os.path.join(os.getcwd(), 'temp_uploads', str(uuid.uuid4()))
+    parked_dir = os.path.join(temp_dir, '.parts')
+    root_dir = os.path.join(temp_dir, 'folder')
+    os.makedirs(root_dir, exist_ok=True)
+    spool = FolderSpool(root_dir)
 
-        # Calculate total size
-        total_size = sum(f['size'] for f in file_results)
+    try:
+        paths = {}
+        parked = {}
+        file_results = {}
+        index = -1
+
+        for kind, name, value, chunks in MultipartStream(request.stream, boundary).parts():
+            if kind == "field":
+                if name == 'visibility':
+                    visibility = admitted_visibility(value)
+                elif name.startswith('paths_'):
+                    paths[name[len('paths_'):]] = safe_relative_path(value)
+                continue
+            if name != 'files':
+                continue
+            index += 1
+            if not value:
+                continue
 
+            relative_path = paths.get(str(index))
+            if relative_path:
+                spool.claim(relative_path)
+                size = spool.write(spool.path_for(relative_path), chunks)
+            else:
+                os.makedirs(parked_dir, exist_ok=True)
+                parked[index] = os.path.join(parked_dir, str(index))
+                size = spool.write(parked[index], chunks)
+            file_results[index] = {'path': relative_path, 'filename': value, 'size': size}
+
+        if not file_results:
+            return jsonify({'error': 'No files provided'}), 400
+
+        spool.wait()
+        results = []
+        for i, file_result in file_results.items():
+            relative_path = file_result['path'] or paths.get(str(i)) or safe_relative_path(file_result['filename'])
+            if i in parked:
+                spool.claim(relative_path)
+                spool.move(parked[i], spool.path_for(relative_path))
+            results.append({
+                'path': relative_path,
+                'size': file_result['size'],
+                'type': mimetypes.guess_type(relative_path)[0] or 'application/octet-stream'
+            })
+        file_results = None
+        shutil.rmtree(parked_dir, ignore_errors=True)
+
+        # Extract folder name from first file's path
+        first_path = results[0]['path']
+        folder_name = first_path.split('/')[0] if '/' in first_path else f"uploaded_folder_{int(time.time())}"
+
+        if async_requested(request):
+            job_dir = temp_dir
+            temp_dir = None  # owned by the job from here on
+            return queue_upload_job(
+                "folder", visibility, sum(f['size'] for f in results),
+                lambda progress: add_folder(os.path.join(job_dir, 'folder'), folder_name, results, visibility, progress),
+                cleanup=lambda: shutil.rmtree(job_dir, ignore_errors=True))
+
+        return jsonify(add_folder(root_dir, folder_name, results, visibility)), 200
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': 'Malformed upload', 'details': str(e)}), 400
+    except IPFSTimeout:
         return jsonify({
-            'success': True,
-            'message': 'Folder uploaded successfully to IPFS',
-            'folderCid': folder_cid,
-            'folderName': folder_name,
-            'visibility': visibility,
-            'totalSize': total_size,
-            'fileCount': len(file_results),
-            'files': file_results
-        }), 200
-
-    except subprocess.CalledProcessError as e:
+            'success': False,
+            'error': 'Folder upload timeout - too many files or network slow. Please try again.'
+        }), 408
+    except IPFSError as e:
         return jsonify({
             'success': False,
             'error': 'Failed to add folder to IPFS', 
-            'details': e.stderr
+            'details': e.details
         }), 500
-    except subprocess.TimeoutExpired:
-        return jsonify({
-            'success': False,
-            'error': 'Folder upload timeout - too many files or network slow. Please try again.'
-        }), 408
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
     finally:
-        # Clean up temporary directory
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            print(f"Failed to clean up temp directory: {e}")
+        # Clean up temporary directory (after any writes still queued for it)
+        if temp_dir:
+            try:
+                spool.wait()
+            except OSError:
+                pass
+            try:
+                shutil.rmtree(temp_dir)
+            except Exception as e:
+                print(f"Failed to clean up temp directory: {e}")
 
 # ---------- Enhanced Metadata ----------
 def _get_metadata_internal(decoded_cid):
@@ -1327,19 +4893,9 @@ def _get_metadata_internal(decoded_cid):
 
         if size == 0:
             try:
-                stat_result = subprocess.run(
-                    ["ipfs", "object", "stat", decoded_cid], 
-                    capture_output=True, 
-                    text=True, 
-                    timeout=60
-                )
-                if stat_result.returncode == 0:
-                    for line in stat_result.stdout.splitlines():
-                        if line.startswith("CumulativeSize:"):
-                            size = int(line.split(":", 1)[1].strip())
-                            break
+                size = ipfs_public.files_stat(decoded_cid, timeout=60).get("CumulativeSize", 0)
             except Exception as e:
-                print(f"IPFS object stat failed for {decoded_cid}: {e}")
+                print(f"IPFS files stat failed for {decoded_cid}: {e}")
 
         return {
             "cid": decoded_cid,
@@ -1351,27 +4907,10 @@ def _get_metadata_internal(decoded_cid):
 
     except Exception as e:
         try:
-            print(f"Trying local IPFS commands for {decoded_cid}")
-            stat_result = subprocess.run(
-                ["ipfs", "object", "stat", decoded_cid], 
-                capture_output=True, 
-                text=True, 
-                timeout=90
-            )
-            size = 0
-            if stat_result.returncode == 0:
-                for line in stat_result.stdout.splitlines():
-                    if line.startswith("CumulativeSize:"):
-                        size = int(line.split(":", 1)[1].strip())
-                        break
-
-            ls_result = subprocess.run(
-                ["ipfs", "ls", decoded_cid], 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
-            is_dir = ls_result.returncode == 0 and ls_result.stdout.strip()
+            print(f"Trying local IPFS node for {decoded_cid}")
+            stat = ipfs_public.files_stat(decoded_cid, timeout=90)
+            size = stat.get("CumulativeSize", 0)
+            is_dir = stat.get("Type") == "directory"
 
             return {
                 "cid": decoded_cid,
@@ -1393,132 +4932,1148 @@ def get_metadata():
         cid = cid.strip("/")
         decoded_cid = unquote(cid)
 
-        metadata = cached_metadata_lookup(decoded_cid)
-        return jsonify(metadata)
+        etag = cid_etag(decoded_cid, "meta")
+        not_modified = conditional_not_modified(request, etag)
+        if not_modified:
+            return not_modified
 
+        prefetcher.note_use(decoded_cid, ("metadata",))
+        metadata = cached_metadata_lookup(decoded_cid)
+        response = jsonify(metadata)
+        if metadata.get("type") == "unknown" or not metadata.get("size"):
+            # Degraded lookup (local fallback or missing size) - let clients retry soon
+            response.headers["Cache-Control"] = "public, max-age=300"
+        else:
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    except MetadataBackoff as e:
+        response = jsonify({"error": str(e)})
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/metadata/warmup", methods=["POST"])
+def warmup_metadata():
+    """Queue background metadata lookups for a batch of CIDs"""
+    data = request.get_json(silent=True) or {}
+    cids = [unquote(str(cid).strip("/")) for cid in data.get("cids", []) if cid]
+
+    if not cids:
+        return jsonify({"error": "Missing cids"}), 400
+    if len(cids) > METADATA_WARMUP_MAX:
+        return jsonify({"error": f"At most {METADATA_WARMUP_MAX} CIDs per warmup"}), 400
+
+    queued = warm_metadata(cids)
+    return jsonify({"requested": len(cids), "queued": queued, "already_cached": len(cids) - queued}), 202
+
+# ---------- Path Resolver (memoized /navigate) ----------
+RESOLVER_CACHE_SIZE = int(os.environ.get("RESOLVER_CACHE_SIZE", "100000"))
+RESOLVER_LATENCY_SAMPLES = 1024
+RESOLVER_MAX_SEGMENTS = 64
+
+class PathResolver:
+    """(parent_cid, name) -> child CID, memoized in memory in front of the directory index.
+
+    Links inside a CID never change, so entries (including "no such name" in a fully
+    listed directory) stay valid until the LRU pushes them out."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.links = OrderedDict()   # (parent, name) -> (cid, is_dir) or None when absent
+        self.lock = Lock()
+        self.stats = {"lookups": 0, "memory_hits": 0, "index_hits": 0, "node_resolves": 0,
+                      "listing_scans": 0, "not_found": 0}
+        self.latency = {}   # source -> recent latencies in seconds
+
+    def _count(self, name, source=None, seconds=None):
+        with self.lock:
+            self.stats[name] += 1
+            if source:
+                self.latency.setdefault(source, deque(maxlen=RESOLVER_LATENCY_SAMPLES)).append(seconds)
+
+    def _store(self, key, link):
+        with self.lock:
+            self.links[key] = link
+            self.links.move_to_end(key)
+            while len(self.links) > self.max_entries:
+                self.links.popitem(last=False)
+
+    def remember(self, parent, name, cid, is_dir=None):
+        self._store((parent, name), (cid, is_dir))
+
+    def remember_missing(self, parent, name):
+        self._store((parent, name), None)
+
+    def remember_listing(self, parent, entries):
+        """Record every link of a directory listing"""
+        with self.lock:
+            for entry in entries:
+                self.links[(parent, entry["name"])] = (entry["cid"], entry["is_directory"])
+            while len(self.links) > self.max_entries:
+                self.links.popitem(last=False)
+
+    def _cached(self, parent, name):
+        with self.lock:
+            key = (parent, name)
+            if key in self.links:
+                self.links.move_to_end(key)
+                return True, self.links[key]
+        return False, None
+
+    def resolve_link(self, parent, name):
+        """(cid, is_dir, source) for one path segment, or None if the directory has no such link"""
+        started = time.perf_counter()
+        found, link = self._cached(parent, name)
+        if found:
+            self._count("memory_hits", "memory", time.perf_counter() - started)
+            return (*link, "memory") if link else None
+
+        indexed = directory_index.lookup(parent, name)
+        if indexed:
+            self.remember(parent, name, *indexed)
+            self._count("index_hits", "index", time.perf_counter() - started)
+            return (*indexed, "index")
+        if directory_index.status(parent):
+            # Fully indexed and the name isn't there
+            self.remember_missing(parent, name)
+            self._count("not_found", "index", time.perf_counter() - started)
+            return None
+
+        # Concurrent misses for one link share a single node resolve
+        return single_flight.do("resolve", (parent, name), lambda: self._resolve_uncached(parent, name, started))
+
+    def _resolve_uncached(self, parent, name, started):
+        path = f"/ipfs/{parent}/{quote(name)}"
+        try:
+            cid = ipfs_public.resolve(path, timeout=60).replace("/ipfs/", "")
+            is_dir = (metadata_store.get_field_many("is_dir", [cid]) or {}).get(cid)
+            self.remember(parent, name, cid, is_dir)
+            self._count("node_resolves", "node_resolve", time.perf_counter() - started)
+            return cid, is_dir, "resolve"
+        except IPFSError as e:
+            print(f"IPFS resolve failed for {path}: {e.details}")
+
+        # Fallback: list (and index) the parent, which also memoizes its siblings
+        if directory_listing_status(parent) is None:
+            raise Exception(f"Could not list {parent}")
+        indexed = directory_index.lookup(parent, name)
+        self._count("listing_scans", "listing_scan", time.perf_counter() - started)
+        if indexed:
+            return (*indexed, "ls_lookup")
+        self.remember_missing(parent, name)
+        self._count("not_found")
+        return None
+
+    def resolve_path(self, parent, path):
+        """Follow a slash-separated path from parent; returns the hops, or None if a segment is missing"""
+        segments = [segment for segment in path.split('/') if segment]
+        if not segments or len(segments) > RESOLVER_MAX_SEGMENTS:
+            raise ValueError(f"Path must have 1-{RESOLVER_MAX_SEGMENTS} segments")
+        with self.lock:
+            self.stats["lookups"] += 1
+
+        hops, current = [], parent
+        for segment in segments:
+            link = self.resolve_link(current, segment)
+            if link is None:
+                return None
+            cid, is_dir, source = link
+            hops.append({"name": segment, "parent_cid": current, "cid": cid, "is_directory": is_dir,
+                         "source": source})
+            current = cid
+        return hops
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            samples = {source: sorted(values) for source, values in self.latency.items()}
+            stats["cached_links"] = len(self.links)
+        segment_lookups = sum(stats[k] for k in ("memory_hits", "index_hits", "node_resolves", "listing_scans"))
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["index_hits"]) / segment_lookups, 4) \
+            if segment_lookups else 0.0
+        stats["latency_ms"] = {
+            source: {
+                "samples": len(values),
+                "p50": round(values[len(values) // 2] * 1000, 3),
+                "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+                "max": round(values[-1] * 1000, 3)
+            }
+            for source, values in samples.items() if values
+        }
+        return stats
+
+path_resolver = PathResolver(RESOLVER_CACHE_SIZE)
+
 # ---------- IPFS Folder Navigation Routes ----------
 @app.route("/navigate")
 def navigate_to_file():
-    """Navigate to a specific file or folder within IPFS"""
+    """Navigate to a file or folder within IPFS; name may be a multi-segment path (a/b/c.txt)"""
     parent_cid = request.args.get("parent")
-    file_name = request.args.get("name")
+    file_name = request.args.get("name") or request.args.get("path")
 
     if not parent_cid or not file_name:
         return jsonify({"error": "Missing parent CID or file name"}), 400
 
     try:
+        parent_cid = parent_cid.strip("/")
         # Construct the IPFS path
-        full_path = f"{parent_cid}/{quote(file_name)}"
+        full_path = f"{parent_cid}/{'/'.join(quote(segment) for segment in file_name.split('/') if segment)}"
 
-        # Get the specific CID for this file/folder
         try:
-            result = subprocess.run(
-                ["ipfs", "resolve", f"/ipfs/{full_path}"], 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
-
-            if result.returncode == 0:
-                # Extract CID from the resolve output
-                resolved_path = result.stdout.strip()
-                file_cid = resolved_path.replace("/ipfs/", "")
-
-                return jsonify({
-                    "success": True,
-                    "parent_cid": parent_cid,
-                    "file_name": file_name,
-                    "file_cid": file_cid,
-                    "full_path": full_path,
-                    "resolved_path": resolved_path
-                })
-            else:
-                # Fallback: try to get the file CID from ls output
-                ls_result = subprocess.run(
-                    ["ipfs", "ls", parent_cid], 
-                    capture_output=True, 
-                    text=True, 
-                    timeout=60
-                )
-
-                if ls_result.returncode == 0:
-                    for line in ls_result.stdout.strip().split("\n"):
-                        if line:
-                            parts = line.split(None, 2)
-                            if len(parts) >= 3 and parts[2] == file_name:
-                                file_cid = parts[1]
-                                return jsonify({
-                                    "success": True,
-                                    "parent_cid": parent_cid,
-                                    "file_name": file_name,
-                                    "file_cid": file_cid,
-                                    "full_path": full_path,
-                                    "method": "ls_lookup"
-                                })
-
-                return jsonify({"error": "File not found in directory"}), 404
-
+            hops = path_resolver.resolve_path(parent_cid, file_name)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
             print(f"Navigation error: {e}")
             return jsonify({"error": f"Navigation failed: {str(e)}"}), 500
 
+        if hops is None:
+            return jsonify({"error": "File not found in directory"}), 404
+
+        target = hops[-1]
+        result = {
+            "success": True,
+            "parent_cid": parent_cid,
+            "file_name": file_name,
+            "file_cid": target["cid"],
+            "full_path": full_path,
+            "resolved_path": f"/ipfs/{target['cid']}",
+            "method": target["source"]
+        }
+        if target["is_directory"] is not None:
+            result["is_directory"] = target["is_directory"]
+        if len(hops) > 1:
+            result["hops"] = hops
+        return jsonify(result)
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ---------- Directory Index (sorted listings in metadata.db) ----------
+LS_PAGE_DEFAULT = 200
+LS_PAGE_MAX = int(os.environ.get("LS_PAGE_MAX", "1000"))
+LS_STREAM_BATCH = 256
+LS_INDEX_PAGE = 500
+LS_INDEX_WAIT = 300
+# Entries kept across all indexed directories; least recently listed ones go first
+LS_INDEX_MAX_ENTRIES = int(os.environ.get("LS_INDEX_MAX_ENTRIES", "2000000"))
+LS_INDEX_EVICT_INTERVAL = 60
+LS_INDEX_TOUCH_INTERVAL = 300
+
+class DirectoryIndex:
+    """Directory listings per CID, sorted by name so pages are served without re-listing.
+
+    A CID's listing can never change, so an index is never invalidated; it is only
+    evicted, least recently used first, once all listings exceed LS_INDEX_MAX_ENTRIES."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.building = {}
+        self.last_evict = 0
+        self.stats = {"index_hits": 0, "builds": 0, "aborted": 0, "pages": 0, "evicted": 0}
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dir_index (
+                cid TEXT PRIMARY KEY,
+                total INTEGER,
+                method TEXT,
+                gateway_used TEXT,
+                indexed_at REAL,
+                last_access REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dir_entries (
+                parent_cid TEXT,
+                name TEXT,
+                cid TEXT,
+                size INTEGER,
+                is_dir INTEGER,
+                position INTEGER,
+                PRIMARY KEY (parent_cid, name)
+            ) WITHOUT ROWID
+        ''')
+        # Indexes made before eviction and listing order were tracked
+        for table, column in (("dir_index", "last_access REAL"), ("dir_entries", "position INTEGER")):
+            try:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass  # Column already exists
+        conn.commit()
+        conn.close()
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def status(self, cid):
+        """Summary of a finished index, or None if the CID hasn't been indexed"""
+        conn = get_metadata_db()
+        row = conn.execute(
+            "SELECT total, method, gateway_used, last_access FROM dir_index WHERE cid = ?", (cid,)).fetchone()
+        if row is None:
+            return None
+        self._count("index_hits")
+        now = time.time()
+        # Recency for eviction, written at most once per interval rather than per read
+        if not row[3] or now - row[3] > LS_INDEX_TOUCH_INTERVAL:
+            conn.execute("UPDATE dir_index SET last_access = ? WHERE cid = ?", (now, cid))
+            conn.commit()
+        return {"total_items": row[0], "method": row[1], "gateway_used": row[2]}
+
+    def claim(self, cid):
+        """(leader, event): the leader lists and indexes the CID, everyone else waits on event"""
+        with self.lock:
+            event = self.building.get(cid)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                event.aborted = False
+                self.building[cid] = event
+        _count_flight("ls", leader)
+        return leader, event
+
+    def release(self, cid, aborted=False):
+        if aborted:
+            # Drop a partial listing before anyone can take over the claim
+            conn = get_metadata_db()
+            conn.execute('''
+                DELETE FROM dir_entries WHERE parent_cid = ?
+                AND NOT EXISTS (SELECT 1 FROM dir_index WHERE cid = ?)
+            ''', (cid, cid))
+            conn.commit()
+        with self.lock:
+            event = self.building.pop(cid, None)
+            if aborted:
+                self.stats["aborted"] += 1
+        if event:
+            event.aborted = aborted
+            event.set()
+
+    def clear(self, cid):
+        conn = get_metadata_db()
+        conn.execute("DELETE FROM dir_entries WHERE parent_cid = ?", (cid,))
+        conn.commit()
+
+    def add(self, cid, entries, position=0):
+        """Store a batch of a live listing; position is the batch's offset in node order"""
+        conn = get_metadata_db()
+        conn.executemany(
+            "INSERT OR REPLACE INTO dir_entries (parent_cid, name, cid, size, is_dir, position) VALUES (?, ?, ?, ?, ?, ?)",
+            [(cid, e["name"], e["cid"], e["size"], int(e["is_directory"]), position + i)
+             for i, e in enumerate(entries)])
+        conn.commit()
+        path_resolver.remember_listing(cid, entries)
+
+    def finish(self, cid, method, gateway_used=None):
+        conn = get_metadata_db()
+        total = conn.execute("SELECT COUNT(*) FROM dir_entries WHERE parent_cid = ?", (cid,)).fetchone()[0]
+        now = time.time()
+        conn.execute('''
+            INSERT OR REPLACE INTO dir_index (cid, total, method, gateway_used, indexed_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (cid, total, method, gateway_used, now, now))
+        conn.commit()
+        self._count("builds")
+        if now - self.last_evict > LS_INDEX_EVICT_INTERVAL:
+            self.last_evict = now
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used listings until the entry budget holds again"""
+        conn = get_metadata_db()
+        total = conn.execute("SELECT COALESCE(SUM(total), 0) FROM dir_index").fetchone()[0]
+        if total <= LS_INDEX_MAX_ENTRIES:
+            return
+        victims = []
+        for cid, entries in conn.execute(
+                "SELECT cid, total FROM dir_index ORDER BY COALESCE(last_access, indexed_at)").fetchall():
+            if total <= LS_INDEX_MAX_ENTRIES:
+                break
+            victims.append(cid)
+            total -= entries or 0
+        for cid in victims:
+            conn.execute("DELETE FROM dir_index WHERE cid = ?", (cid,))
+            conn.execute("DELETE FROM dir_entries WHERE parent_cid = ?", (cid,))
+        conn.commit()
+        self._count("evicted", len(victims))
+
+    def lookup(self, parent_cid, name):
+        """(cid, is_dir) of a named link in an indexed directory, or None"""
+        row = get_metadata_db().execute(
+            "SELECT cid, is_dir FROM dir_entries WHERE parent_cid = ? AND name = ?", (parent_cid, name)).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def entries(self, cid):
+        """Every entry in the order the node (or gateway) listed them"""
+        rows = get_metadata_db().execute(
+            "SELECT name, cid, size, is_dir FROM dir_entries WHERE parent_cid = ? ORDER BY position, name",
+            (cid,)).fetchall()
+        self._count("pages")
+        return [directory_entry(name, child, size, bool(is_dir), cid) for name, child, size, is_dir in rows]
+
+    def page(self, cid, after=None, limit=None):
+        """Entries sorted by name, strictly after the cursor name"""
+        query = "SELECT name, cid, size, is_dir FROM dir_entries WHERE parent_cid = ? AND name > ? ORDER BY name"
+        params = [cid, after or ""]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = get_metadata_db().execute(query, params).fetchall()
+        self._count("pages")
+        return [directory_entry(name, child, size, bool(is_dir), cid) for name, child, size, is_dir in rows]
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["building"] = len(self.building)
+        try:
+            stats["indexed"] = get_metadata_db().execute("SELECT COUNT(*) FROM dir_index").fetchone()[0]
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
+
+directory_index = DirectoryIndex(METADATA_DB_PATH)
+
+class DirectoryRecorder:
+    """Live listing batches that are written to the index as they are consumed.
+
+    Holds the CID's index claim until exhausted or closed (closing early discards it)."""
+
+    def __init__(self, cid, method, gateway_used, batches):
+        self.cid = cid
+        self.method = method
+        self.gateway_used = gateway_used
+        self.batches = batches
+        self.released = False
+
+    def __iter__(self):
+        try:
+            directory_index.clear(self.cid)
+            position = 0
+            for entries in self.batches:
+                directory_index.add(self.cid, entries, position)
+                position += len(entries)
+                yield entries
+            directory_index.finish(self.cid, self.method, self.gateway_used)
+            self._release(aborted=False)
+        finally:
+            self.close()
+
+    def _release(self, aborted):
+        if not self.released:
+            self.released = True
+            directory_index.release(self.cid, aborted)
+
+    def close(self):
+        self._release(aborted=True)
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
 # ---------- Enhanced Directory Listing with Navigation Support ----------
+def live_directory_listing(decoded_cid):
+    """Start listing a directory CID via local IPFS, falling back to gateway HTML.
+
+    Returns (method, gateway_used, batches) where batches yields entry lists as they
+    are parsed, or None if the CID is not listable."""
+    # Try the local IPFS node first
+    try:
+        links = ipfs_public.ls_stream(decoded_cid, timeout=90)
+        batches = (parse_ipfs_ls_output(batch, decoded_cid) for batch in _batched(links, LS_STREAM_BATCH))
+        first = next(batches, None)
+        if first:
+            return "local_ipfs", None, chain([first], batches)
+        # No links: an empty directory, or a single-block file (which the gateway can't list either)
+        if first is None and ipfs_public.files_stat(decoded_cid, timeout=LS_PROBE_TIMEOUT).get("Type") == "directory":
+            return "local_ipfs", None, iter([])
+    except Exception as ls_err:
+        print(f"IPFS ls failed for {decoded_cid}: {ls_err}")
+
+    # Fallback to gateway method
+    try:
+        r, used_gateway = try_multiple_gateways(decoded_cid, 'stream')
+        if 'text/html' in r.headers.get('Content-Type', ''):
+            return "gateway_html", used_gateway, iter_gateway_directory_entries(r, decoded_cid)
+        r.close()
+    except Exception as gateway_err:
+        print(f"Gateway directory listing failed for {decoded_cid}: {gateway_err}")
+
+    return None
+
+def open_directory_listing(decoded_cid):
+    """("indexed", status) or ("live", DirectoryRecorder); None if the CID is not listable.
+
+    Only one request lists a CID at a time; the others wait for its index."""
+    while True:
+        status = directory_index.status(decoded_cid)
+        if status:
+            return "indexed", status
+        leader, event = directory_index.claim(decoded_cid)
+        if leader:
+            break
+        if not event.wait(LS_INDEX_WAIT):
+            raise Exception("Timed out waiting for directory listing")
+        if not event.aborted:
+            status = directory_index.status(decoded_cid)
+            return ("indexed", status) if status else None
+        # The leader gave up part way (client went away or node error); take over
+
+    try:
+        # Indexed between our status check and the claim
+        status = directory_index.status(decoded_cid)
+        if status:
+            directory_index.release(decoded_cid)
+            return "indexed", status
+        listing = live_directory_listing(decoded_cid)
+    except BaseException:
+        directory_index.release(decoded_cid, aborted=True)
+        raise
+    if listing is None:
+        directory_index.release(decoded_cid)
+        return None
+    return "live", DirectoryRecorder(decoded_cid, *listing)
+
+def directory_listing_status(decoded_cid):
+    """Index summary for a directory CID, listing and indexing it first if needed"""
+    opened = open_directory_listing(decoded_cid)
+    if opened is None:
+        return None
+    kind, value = opened
+    if kind == "live":
+        for _ in value:
+            pass
+        return directory_index.status(decoded_cid)
+    return value
+
+def list_directory(decoded_cid):
+    """Full listing of a directory CID (served from the index); None if not listable"""
+    status = directory_listing_status(decoded_cid)
+    if status is None:
+        return None
+    listing = {
+        "cid": decoded_cid,
+        "entries": directory_index.entries(decoded_cid),
+        "method": status["method"],
+        "total_items": status["total_items"],
+        "is_directory": True
+    }
+    if status["gateway_used"]:
+        listing["gateway_used"] = status["gateway_used"]
+    return listing
+
+def ndjson_directory_listing(decoded_cid, opened, after, limit):
+    """NDJSON body: one entry per line, then a summary line with "done": true"""
+    kind, value = opened
+    sent, cursor, more = 0, after, False
+
+    if kind == "live":
+        # First listing of this CID: emit entries in node order as they are parsed
+        for entries in value:
+            for entry in entries:
+                yield json.dumps(entry) + "\n"
+            sent += len(entries)
+        summary = {"method": value.method, "gateway_used": value.gateway_used}
+    else:
+        while True:
+            want = min(LS_INDEX_PAGE, limit - sent) if limit else LS_INDEX_PAGE
+            entries = directory_index.page(decoded_cid, cursor, want + 1)
+            more = len(entries) > want
+            entries = entries[:want]
+            for entry in entries:
+                yield json.dumps(entry) + "\n"
+            sent += len(entries)
+            if entries:
+                cursor = entries[-1]["name"]
+            if not more or (limit and sent >= limit):
+                break
+        summary = {"method": value["method"], "gateway_used": value["gateway_used"]}
+
+    yield json.dumps({
+        "done": True,
+        "cid": decoded_cid,
+        "count": sent,
+        "next_cursor": cursor if more else None,
+        "is_directory": True,
+        **summary
+    }) + "\n"
+
 @app.route("/ls")
 def list_cid():
-    """Enhanced directory listing with proper navigation support"""
+    """Directory listing: full JSON, cursor pages (limit/after) or NDJSON (format=ndjson)"""
     cid_path = request.args.get("cid")
     if not cid_path:
         return jsonify({"error": "Missing CID"}), 400
 
+    after = request.args.get("after") or None
+    limit = request.args.get("limit")
+    ndjson = request.args.get("format") == "ndjson" or \
+        request.accept_mimetypes.best == "application/x-ndjson"
+    try:
+        limit = int(limit) if limit else (LS_PAGE_DEFAULT if after else None)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit is not None and not 1 <= limit <= LS_PAGE_MAX:
+        return jsonify({"error": f"limit must be between 1 and {LS_PAGE_MAX}"}), 400
+
     try:
         decoded_cid = unquote(cid_path.strip("/"))
 
-        # Try IPFS ls command first
-        try:
-            result = subprocess.run(
-                ["ipfs", "ls", decoded_cid], 
-                capture_output=True, 
-                text=True, 
-                timeout=90
-            )
+        variant = "ls"
+        if ndjson or limit:
+            variant += "-" + hashlib.sha256(f"{ndjson}\0{after}\0{limit}".encode()).hexdigest()[:12]
+        etag = cid_etag(decoded_cid, variant)
+        not_modified = conditional_not_modified(request, etag)
+        if not_modified:
+            return not_modified
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept"}
+
+        if ndjson:
+            opened = open_directory_listing(decoded_cid)
+            if opened and opened[0] == "live" and (after or limit):
+                # Pages are cut from the sorted index, so finish indexing first
+                for _ in opened[1]:
+                    pass
+                opened = ("indexed", directory_index.status(decoded_cid))
+            if opened is None:
+                return jsonify({"error": "Could not list directory contents"}), 404
+            body = ndjson_directory_listing(decoded_cid, opened, after, limit)
+            if opened[0] == "live":
+                body = ClosingIterator(body, [opened[1].close])
+            return Response(body, mimetype="application/x-ndjson", headers=headers)
+
+        if limit is None:
+            listing = list_directory(decoded_cid)
+            if listing is None:
+                return jsonify({"error": "Could not list directory contents"}), 404
+            headers.update(schedule_prefetch(request, listing["entries"]))
+            return jsonify(listing), 200, headers
+
+        status = directory_listing_status(decoded_cid)
+        if status is None:
+            return jsonify({"error": "Could not list directory contents"}), 404
+        entries = directory_index.page(decoded_cid, after, limit + 1)
+        more = len(entries) > limit
+        entries = entries[:limit]
+        page = {
+            "cid": decoded_cid,
+            "entries": entries,
+            "method": status["method"],
+            "total_items": status["total_items"],
+            "is_directory": True,
+            "limit": limit,
+            "after": after,
+            "next_cursor": entries[-1]["name"] if more else None
+        }
+        if status["gateway_used"]:
+            page["gateway_used"] = status["gateway_used"]
+        headers.update(schedule_prefetch(request, entries))
+        return jsonify(page), 200, headers
 
-            if result.returncode == 0:
-                entries = parse_ipfs_ls_output(result.stdout, decoded_cid)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-                return jsonify({
-                    "cid": decoded_cid,
-                    "entries": entries,
-                    "method": "local_ipfs",
-                    "total_items": len(entries),
-                    "is_directory": True
-                })
-        except Exception as ls_err:
-            print(f"IPFS ls failed for {decoded_cid}: {ls_err}")
+# ---------- Predictive Prefetch ----------
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "2"))
+PREFETCH_QUEUE_MAX = 256
+PREFETCH_MAX_CHILDREN = int(os.environ.get("PREFETCH_MAX_CHILDREN", "24"))
+PREFETCH_MAX_IMAGES = int(os.environ.get("PREFETCH_MAX_IMAGES", "12"))
+PREFETCH_SMALL_FILE = int(os.environ.get("PREFETCH_SMALL_FILE", str(1024 * 1024)))
+PREFETCH_HEAD_BYTES = int(os.environ.get("PREFETCH_HEAD_BYTES", str(256 * 1024)))
+PREFETCH_RATE_PER_GATEWAY = float(os.environ.get("PREFETCH_RATE_PER_GATEWAY", "2"))
+PREFETCH_BURST = 4
+PREFETCH_TRACK_MAX = 5000
+
+class PrefetchCanceled(Exception):
+    pass
+
+class Prefetcher:
+    """Warms what a client will most likely open next after listing a folder.
+
+    Jobs run on a small dedicated pool behind a bounded queue, so prefetching never
+    competes with request threads; upstream fetches are rate limited per gateway. A
+    new listing from the same client cancels its previous batch."""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=PREFETCH_QUEUE_MAX)
+        self.lock = Lock()
+        self.batches = {}          # batch id -> {"cancel": Event, "pending": n, "client": client}
+        self.client_batches = {}   # client -> latest batch id
+        self.buckets = {}          # gateway -> (tokens, updated)
+        self.prefetched = OrderedDict()   # (kind, cid) -> finished at, until first use
+        self.stats = {"scheduled": 0, "completed": 0, "already_cached": 0, "failed": 0, "dropped": 0,
+                      "canceled": 0, "throttled": 0, "expired": 0}
+        self.hits = {"metadata": 0, "content": 0, "head": 0}
+        self.done_by_kind = {"metadata": 0, "content": 0, "head": 0}
+        for i in range(PREFETCH_WORKERS):
+            threading.Thread(target=self._work, daemon=True, name=f"prefetch-{i}").start()
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def plan(self, entries):
+        """(kind, cid) jobs for a listing: small images in full, the first video's head, then metadata"""
+        files = [e for e in entries if not e["is_directory"]][:PREFETCH_MAX_CHILDREN]
+        jobs = [("content", e["cid"]) for e in files
+                if e.get("preview_type") == "image" and e["size"] <= PREFETCH_SMALL_FILE][:PREFETCH_MAX_IMAGES]
+        video = next((e for e in files if e.get("preview_type") == "video"), None)
+        if video:
+            jobs.append(("head", video["cid"]))
+        jobs.extend(("metadata", e["cid"]) for e in files)
+        return jobs
+
+    def schedule(self, entries, client):
+        """Queue prefetch jobs for a listing; returns (batch id, queued) or None"""
+        jobs = self.plan(entries)
+        if not jobs:
+            return None
+        batch_id = uuid.uuid4().hex[:16]
+        batch = {"cancel": threading.Event(), "pending": 0, "client": client}
+        with self.lock:
+            previous = self.batches.get(self.client_batches.get(client))
+            self.batches[batch_id] = batch
+            self.client_batches[client] = batch_id
+        if previous:
+            previous["cancel"].set()
+            self._count("canceled")
+
+        queued = 0
+        for kind, cid in jobs:
+            with self.lock:
+                batch["pending"] += 1
+            try:
+                self.queue.put_nowait((batch_id, kind, cid))
+                queued += 1
+            except queue.Full:
+                self._count("dropped", len(jobs) - queued)
+                self._finish(batch_id)
+                break
+        self._count("scheduled", queued)
+        return batch_id, queued
+
+    def cancel(self, batch_id, client):
+        """Cancel a batch; only the client that listed the folder may"""
+        with self.lock:
+            batch = self.batches.get(batch_id)
+        if batch is None or batch["client"] != client:
+            return False
+        batch["cancel"].set()
+        self._count("canceled")
+        return True
+
+    def _finish(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch:
+                batch["pending"] -= 1
+                if batch["pending"] <= 0:
+                    self.batches.pop(batch_id, None)
+                    self.client_batches = {c: b for c, b in self.client_batches.items() if b != batch_id}
+
+    def _work(self):
+        while True:
+            batch_id, kind, cid = self.queue.get()
+            with self.lock:
+                batch = self.batches.get(batch_id)
+            try:
+                if batch is None or batch["cancel"].is_set():
+                    continue
+                if self._run(kind, cid, batch["cancel"]):
+                    self._remember(kind, cid)
+            except PrefetchCanceled:
+                pass
+            except Exception as e:
+                self._count("failed")
+                print(f"Prefetch {kind} failed for {cid}: {e}")
+            finally:
+                self._finish(batch_id)
+
+    def _run(self, kind, cid, cancel):
+        """Run one job; False if there was nothing to do"""
+        if kind == "metadata":
+            if metadata_store.get(cid) is not None:
+                self._count("already_cached")
+                return False
+            gateway = self._throttle(cancel)
+            self._settle(gateway, cached_metadata_lookup(cid).get("gateway_used"))
+
+        elif kind == "content":
+            if content_cache.contains(cid):
+                self._count("already_cached")
+                return False
+            gateway = self._throttle(cancel)
+            content = open_cid_content(cid)
+            self._settle(gateway, content["source"])
+            if content.get("flight"):
+                # Reading the shared stream to the end publishes it into the content cache
+                body = content["flight"].read()
+                try:
+                    for _ in body:
+                        if cancel.is_set():
+                            raise PrefetchCanceled()
+                finally:
+                    body.close()
+            else:
+                release_content(content)
+
+        elif kind == "head":
+            # Too big for a full prefetch: pull the first bytes so the gateway has the
+            # root blocks hot when playback starts
+            gateway = self._throttle(cancel)
+            r, served = try_multiple_gateways(cid, 'stream', headers={"Range": f"bytes=0-{PREFETCH_HEAD_BYTES - 1}"})
+            self._settle(gateway, served)
+            try:
+                for _ in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if cancel.is_set():
+                        raise PrefetchCanceled()
+            finally:
+                r.close()
+
+        self._count("completed")
+        return True
+
+    def _refill(self, gateway, now):
+        """Current tokens for gateway; callers hold self.lock"""
+        tokens, updated = self.buckets.get(gateway, (PREFETCH_BURST, now))
+        return min(PREFETCH_BURST, tokens + (now - updated) * PREFETCH_RATE_PER_GATEWAY)
+
+    def _throttle(self, cancel):
+        """Wait for a token from the bucket of the gateway the router will try first.
+        Returns that gateway; _settle() moves the token if another one answers."""
+        gateway = gateway_router.ordered(preferred=CURRENT_GATEWAY)[0]
+        while True:
+            now = time.time()
+            with self.lock:
+                tokens = self._refill(gateway, now)
+                if tokens >= 1:
+                    self.buckets[gateway] = (tokens - 1, now)
+                    return gateway
+                self.buckets[gateway] = (tokens, now)
+                self.stats["throttled"] += 1
+            if cancel.wait((1 - tokens) / PREFETCH_RATE_PER_GATEWAY):
+                raise PrefetchCanceled()
+
+    def _settle(self, expected, served):
+        """Charge the gateway that actually served the job (it may owe a token and wait
+        next time); cache and local node answers cost no gateway anything"""
+        if served == expected:
+            return
+        now = time.time()
+        with self.lock:
+            self.buckets[expected] = (min(PREFETCH_BURST, self._refill(expected, now) + 1), now)
+            if served in gateway_router.stats:
+                self.buckets[served] = (self._refill(served, now) - 1, now)
+
+    def _remember(self, kind, cid):
+        with self.lock:
+            self.done_by_kind[kind] += 1
+            self.prefetched[(kind, cid)] = time.time()
+            while len(self.prefetched) > PREFETCH_TRACK_MAX:
+                self.prefetched.popitem(last=False)
+                self.stats["expired"] += 1
+
+    def note_use(self, cid, kinds):
+        """A client asked for something: count a hit if it was prefetched"""
+        with self.lock:
+            for kind in kinds:
+                if self.prefetched.pop((kind, cid), None) is not None:
+                    self.hits[kind] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["hits"] = dict(self.hits)
+            stats["hit_rate"] = {
+                kind: round(self.hits[kind] / done, 4) if done else 0.0
+                for kind, done in self.done_by_kind.items()
+            }
+            stats["active_batches"] = len(self.batches)
+        stats["enabled"] = PREFETCH_ENABLED
+        stats["queued"] = self.queue.qsize()
+        return stats
+
+prefetcher = Prefetcher()
+
+def prefetch_requested(request):
+    """PREFETCH_ENABLED, overridable per request with ?prefetch=1/0"""
+    flag = request.args.get("prefetch")
+    if flag is None:
+        return PREFETCH_ENABLED
+    return flag.lower() in ("1", "true", "yes")
+
+def schedule_prefetch(request, entries):
+    """Queue prefetching for listed entries; returns headers describing the batch"""
+    if not prefetch_requested(request):
+        return {}
+    scheduled = prefetcher.schedule(entries, get_client_info(request)['ip_address'])
+    if not scheduled:
+        return {}
+    return {"X-Prefetch-Id": scheduled[0], "X-Prefetch-Queued": str(scheduled[1])}
+
+@app.route("/prefetch", methods=["GET"])
+def prefetch_stats():
+    return jsonify(prefetcher.snapshot()), 200
+
+@app.route("/prefetch/<batch_id>", methods=["DELETE"])
+def cancel_prefetch(batch_id):
+    if not prefetcher.cancel(batch_id, get_client_info(request)['ip_address']):
+        return jsonify({"error": "Unknown or finished prefetch batch"}), 404
+    return jsonify({"canceled": batch_id}), 200
+
+# ---------- DAG Index (recursive folder index and path search) ----------
+DAG_INDEX_WALKERS = int(os.environ.get("DAG_INDEX_WALKERS", "2"))
+DAG_INDEX_CONCURRENCY = int(os.environ.get("DAG_INDEX_CONCURRENCY", "4"))
+DAG_INDEX_MAX_ENTRIES = int(os.environ.get("DAG_INDEX_MAX_ENTRIES", "500000"))
+DAG_INDEX_MAX_ROOTS = int(os.environ.get("DAG_INDEX_MAX_ROOTS", "500"))
+SEARCH_PAGE_DEFAULT = 100
+
+class DagIndexer:
+    """Walks a folder CID's whole tree once in the background and keeps every
+    path -> CID/size/type row for search. CIDs are immutable, so a finished index
+    is only ever evicted (least recently used root first), never invalidated."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.active = set()
+        self.stats = {"walks": 0, "completed": 0, "failed": 0, "evicted": 0, "searches": 0}
+        self.walk_pool = ThreadPoolExecutor(max_workers=DAG_INDEX_WALKERS, thread_name_prefix="dag-walk")
+        self.list_pool = ThreadPoolExecutor(max_workers=DAG_INDEX_CONCURRENCY, thread_name_prefix="dag-list")
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dag_roots (
+                root_cid TEXT PRIMARY KEY,
+                status TEXT,
+                entries INTEGER DEFAULT 0,
+                directories INTEGER DEFAULT 0,
+                error TEXT,
+                started_at REAL,
+                finished_at REAL,
+                last_access REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dag_index (
+                root_cid TEXT,
+                path TEXT,
+                cid TEXT,
+                size INTEGER,
+                is_dir INTEGER,
+                PRIMARY KEY (root_cid, path)
+            ) WITHOUT ROWID
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def status(self, root):
+        row = get_metadata_db().execute('''
+            SELECT status, entries, directories, error, started_at, finished_at
+            FROM dag_roots WHERE root_cid = ?
+        ''', (root,)).fetchone()
+        if row is None:
+            return None
+        status = dict(zip(("status", "entries", "directories", "error", "started_at", "finished_at"), row))
+        with self.lock:
+            if status["status"] == "indexing" and root not in self.active:
+                status["status"] = "interrupted"
+        return status
+
+    def start(self, root):
+        """Queue a walk of root unless it is already indexed or being indexed; returns its status"""
+        with self.lock:
+            busy = root in self.active
+            self.active.add(root)
+        if busy:
+            return self.status(root)
+        current = self.status(root)
+        if current and current["status"] == "complete":
+            with self.lock:
+                self.active.discard(root)
+            return current
+
+        conn = get_metadata_db()
+        now = time.time()
+        conn.execute("DELETE FROM dag_index WHERE root_cid = ?", (root,))
+        conn.execute('''
+            INSERT OR REPLACE INTO dag_roots (root_cid, status, entries, directories, started_at, last_access)
+            VALUES (?, 'indexing', 0, 0, ?, ?)
+        ''', (root, now, now))
+        conn.commit()
+        self._count("walks")
+        self.walk_pool.submit(self._walk, root)
+        return self.status(root)
+
+    def _walk(self, root):
+        conn = get_metadata_db()
+        entries = directories = 0
+        # Breadth-first: every directory on one level is listed in parallel
+        frontier = [("", root)]
+        try:
+            while frontier:
+                listed = self.list_pool.map(lambda item: directory_listing_status(item[1]), frontier)
+                next_frontier, rows = [], []
+                for (prefix, cid), listing in zip(frontier, listed):
+                    if listing is None:
+                        if not prefix:
+                            raise Exception("Not a listable directory")
+                        print(f"DAG index: could not list {root}/{prefix}")
+                        continue
+                    directories += 1
+                    for entry in directory_index.page(cid):
+                        path = prefix + entry["name"]
+                        rows.append((root, path, entry["cid"], entry["size"], int(entry["is_directory"])))
+                        if entry["is_directory"]:
+                            next_frontier.append((path + "/", entry["cid"]))
+
+                entries += len(rows)
+                if entries > DAG_INDEX_MAX_ENTRIES:
+                    raise Exception(f"More than {DAG_INDEX_MAX_ENTRIES} entries")
+                conn.executemany("INSERT OR REPLACE INTO dag_index VALUES (?, ?, ?, ?, ?)", rows)
+                conn.execute("UPDATE dag_roots SET entries = ?, directories = ? WHERE root_cid = ?",
+                             (entries, directories, root))
+                conn.commit()
+                frontier = next_frontier
+
+            conn.execute("UPDATE dag_roots SET status = 'complete', finished_at = ? WHERE root_cid = ?",
+                         (time.time(), root))
+            conn.commit()
+            self._count("completed")
+            print(f"DAG index: {root} complete ({entries} entries, {directories} directories)")
+        except Exception as e:
+            conn.execute("DELETE FROM dag_index WHERE root_cid = ?", (root,))
+            conn.execute("UPDATE dag_roots SET status = 'failed', error = ?, finished_at = ? WHERE root_cid = ?",
+                         (str(e)[:500], time.time(), root))
+            conn.commit()
+            self._count("failed")
+            print(f"DAG index: {root} failed: {e}")
+        finally:
+            with self.lock:
+                self.active.discard(root)
+        self._evict()
+
+    def _evict(self):
+        conn = get_metadata_db()
+        stale = conn.execute('''
+            SELECT root_cid FROM dag_roots WHERE status != 'indexing'
+            ORDER BY last_access DESC LIMIT -1 OFFSET ?
+        ''', (DAG_INDEX_MAX_ROOTS,)).fetchall()
+        for (root,) in stale:
+            conn.execute("DELETE FROM dag_index WHERE root_cid = ?", (root,))
+            conn.execute("DELETE FROM dag_roots WHERE root_cid = ?", (root,))
+            self._count("evicted")
+        conn.commit()
+
+    def search(self, root, pattern=None, after=None, limit=SEARCH_PAGE_DEFAULT, kind=None):
+        """Rows under root whose path matches a glob (plain text matches anywhere), sorted by path"""
+        conn = get_metadata_db()
+        query = "SELECT path, cid, size, is_dir FROM dag_index WHERE root_cid = ? AND path > ?"
+        params = [root, after or ""]
+        if pattern:
+            if not any(ch in pattern for ch in "*?["):
+                pattern = f"*{pattern}*"
+            query += " AND path GLOB ?"
+            params.append(pattern)
+        if kind in ("file", "directory"):
+            query += " AND is_dir = ?"
+            params.append(int(kind == "directory"))
+        query += " ORDER BY path LIMIT ?"
+        params.append(limit)
+        rows = conn.execute(query, params).fetchall()
+        conn.execute("UPDATE dag_roots SET last_access = ? WHERE root_cid = ?", (time.time(), root))
+        conn.commit()
+        self._count("searches")
+        return rows
 
-        # Fallback to gateway method
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["active"] = len(self.active)
         try:
-            r, used_gateway = try_multiple_gateways(decoded_cid, 'get')
-            if 'text/html' in r.headers.get('Content-Type', ''):
-                entries = parse_gateway_directory_html(r.text, decoded_cid)
-                return jsonify({
-                    "cid": decoded_cid, 
-                    "entries": entries, 
-                    "method": "gateway_html",
-                    "gateway_used": used_gateway,
-                    "total_items": len(entries),
-                    "is_directory": True
-                })
-        except Exception as gateway_err:
-            print(f"Gateway directory listing failed for {decoded_cid}: {gateway_err}")
+            conn = get_metadata_db()
+            stats["roots"] = conn.execute("SELECT COUNT(*) FROM dag_roots").fetchone()[0]
+            stats["rows"] = conn.execute("SELECT COUNT(*) FROM dag_index").fetchone()[0]
+        except sqlite3.Error as e:
+            stats["error"] = str(e)
+        return stats
+
+dag_indexer = DagIndexer(METADATA_DB_PATH)
+
+@app.route("/index", methods=["POST"])
+def start_dag_index():
+    """Start indexing a folder CID's whole tree in the background"""
+    data = request.get_json(silent=True) or {}
+    cid = data.get("cid") or request.args.get("cid")
+    if not cid:
+        return jsonify({"error": "Missing CID"}), 400
+    root = unquote(cid.strip("/"))
+    status = dag_indexer.start(root)
+    return jsonify({"cid": root, **status}), 200 if status["status"] == "complete" else 202
+
+@app.route("/index/<path:cid>", methods=["GET"])
+def dag_index_status(cid):
+    root = unquote(cid.strip("/"))
+    status = dag_indexer.status(root)
+    if status is None:
+        return jsonify({"error": "CID has not been indexed"}), 404
+    return jsonify({"cid": root, **status}), 200
+
+@app.route("/search", methods=["GET"])
+def search_dag_index():
+    """Path/glob search inside an indexed folder tree (starts indexing on first use)"""
+    root = request.args.get("cid")
+    if not root:
+        return jsonify({"error": "Missing CID"}), 400
+    root = unquote(root.strip("/"))
+    pattern = request.args.get("q")
+    after = request.args.get("after") or None
+    kind = request.args.get("type")
+    try:
+        limit = int(request.args.get("limit", SEARCH_PAGE_DEFAULT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not 1 <= limit <= LS_PAGE_MAX:
+        return jsonify({"error": f"limit must be between 1 and {LS_PAGE_MAX}"}), 400
 
-        return jsonify({"error": "Could not list directory contents"}), 404
+    try:
+        status = dag_indexer.status(root)
+        if status is None or status["status"] == "interrupted":
+            status = dag_indexer.start(root)
+        if status["status"] == "failed":
+            return jsonify({"error": f"Indexing failed: {status['error']}"}), 404
+
+        # While the walk runs, return what has been indexed so far
+        rows = dag_indexer.search(root, pattern, after, limit + 1, kind)
+        more = len(rows) > limit
+        matches = []
+        for path, cid, size, is_dir in rows[:limit]:
+            entry = directory_entry(path.rsplit('/', 1)[-1], cid, size, bool(is_dir), None)
+            entry["path"] = path
+            entry["root_cid"] = root
+            matches.append(entry)
 
+        return jsonify({
+            "cid": root,
+            "query": pattern,
+            "matches": matches,
+            "next_cursor": matches[-1]["path"] if more else None,
+            "index_status": status["status"],
+            "indexed_entries": status["entries"]
+        }), 200 if status["status"] == "complete" else 202
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1536,47 +6091,254 @@ def preview_folder_file():
     try:
         decoded_cid = unquote(file_cid.strip("/"))
 
-        # Use multiple gateways with streaming
-        r, used_gateway = try_multiple_gateways(decoded_cid, 'stream')
-
-        if r.status_code != 200:
-            return f"Error fetching content: {r.status_code}", 404
-
-        content_type = r.headers.get("Content-Type", "application/octet-stream")
+        not_modified = conditional_not_modified(request, cid_etag(decoded_cid))
+        if not_modified:
+            track_view(decoded_cid, request, "not_modified")
+            return not_modified
 
-        # If content type is not detected, guess from filename
-        if content_type == "application/octet-stream" and filename:
-            guessed_type = mimetypes.guess_type(filename)[0]
-            if guessed_type:
-                content_type = guessed_type
-
-        content_length = r.headers.get("Content-Length", 0)
+        # Serve from the content cache, else stream from the best gateway
+        content = open_cid_content(decoded_cid, requested_range(request, decoded_cid))
+        try:
+            used_gateway = content["source"]
+            content_type = content["content_type"]
 
-        # Track the view
-        track_view(decoded_cid, request, used_gateway)
+            # If content type is not detected, guess from filename
+            if content_type == "application/octet-stream" and filename:
+                guessed_type = mimetypes.guess_type(filename)[0]
+                if guessed_type:
+                    content_type = guessed_type
 
-        # Stream the content directly WITHOUT download headers for inline viewing
-        def generate():
-            try:
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-            except Exception as e:
-                yield f"Stream error: {str(e)}".encode()
+            # Track the view
+            track_view(decoded_cid, request, used_gateway)
 
-        return Response(
-            generate(),
-            content_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=3600",
+            # Stream the content directly WITHOUT download headers for inline viewing
+            return content_response(content, content_type, {
+                "Cache-Control": IMMUTABLE_CACHE_CONTROL,
                 "X-Gateway-Used": used_gateway,
                 "X-Parent-CID": parent_cid or "unknown",
                 "X-Filename": filename
-            }
-        )
+            })
+        except Exception:
+            release_content(content)
+            raise
 
     except Exception as e:
         return f"Server error: {str(e)}", 500
 
+# ---------- Thumbnails and Poster Frames ----------
+THUMBNAIL_CACHE_DIR = os.path.join(CACHE_DIR, 'thumbnails')
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+THUMBNAIL_SIZES = (128, 256, 512)
+THUMBNAIL_DEFAULT_SIZE = 256
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_WAIT = float(os.environ.get("THUMBNAIL_WAIT", "20"))
+THUMBNAIL_MAX_SOURCE = int(os.environ.get("THUMBNAIL_MAX_SOURCE", str(50 * 1024 ** 2)))
+THUMBNAIL_FAILURE_TTL = float(os.environ.get("THUMBNAIL_FAILURE_TTL", "600"))
+THUMBNAIL_FFMPEG_TIMEOUT = 30
+FFMPEG_PATH = shutil.which("ffmpeg")
+# ffmpeg is only pointed at sniffed containers it reads with a plain demuxer
+THUMBNAIL_VIDEO_DEMUXERS = {
+    "video/mp4": "mov", "video/quicktime": "mov", "video/x-m4v": "mov", "video/3gpp": "mov",
+    "video/webm": "matroska", "video/x-matroska": "matroska", "video/x-msvideo": "avi",
+    "video/mpeg": "mpeg", "video/mp2t": "mpegts", "video/ogg": "ogg", "video/x-flv": "flv",
+}
+if PILImage is not None and pil_features.check("webp"):
+    THUMBNAIL_FORMAT, THUMBNAIL_CONTENT_TYPE = "WEBP", "image/webp"
+else:
+    THUMBNAIL_FORMAT, THUMBNAIL_CONTENT_TYPE = "JPEG", "image/jpeg"
+# Formats Pillow can't rasterize even though they're images
+THUMBNAIL_SKIP_EXTENSIONS = {'.svg'}
+
+class ThumbnailUnavailable(JobUnavailable):
+    pass
+
+def thumbnail_kind_available(kind):
+    return (kind == "image" and PILImage is not None) or (kind == "video" and FFMPEG_PATH is not None)
+
+def thumbnail_url_for(name, cid, preview_type):
+    """Listing hint for tiles; None when this kind can't be rendered here"""
+    if preview_type not in ("image", "video") or not thumbnail_kind_available(preview_type):
+        return None
+    if os.path.splitext(name)[1].lower() in THUMBNAIL_SKIP_EXTENSIONS:
+        return None
+    return f"/thumbnail/{quote(cid)}?size={THUMBNAIL_DEFAULT_SIZE}&kind={preview_type}"
+
+class ThumbnailService:
+    """Small derivatives of images (Pillow) and poster frames of videos (ffmpeg), made
+    on a bounded worker pool and kept in their own CID@size.kind keyed disk cache.
+    Concurrent requests for the same thumbnail share one job; failures are
+    remembered for THUMBNAIL_FAILURE_TTL so broken files aren't retried per tile."""
+
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self.jobs = BackgroundJobs("thumbnail", workers, THUMBNAIL_WAIT, THUMBNAIL_FAILURE_TTL,
+                                   ThumbnailUnavailable, "Thumbnail is still being generated",
+                                   (415, "Original could not be rendered as a thumbnail"))
+        self.lock = Lock()
+        self.stats = {"generated": 0, "images": 0, "videos": 0, "source_bytes": 0, "thumbnail_bytes": 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def get(self, cid, size, kind):
+        """Cache entry ({"path", "content_type", ...}) for cid at size, generating it if needed"""
+        key = f"{cid}@{size}.{kind}"
+        entry = self.cache.lookup(key)
+        if entry:
+            return entry
+        return self.jobs.run(key, lambda: self._generate(key, cid, size, kind))
+
+    def _generate(self, key, cid, size, kind):
+        data = self._render_video(cid, size) if kind == "video" else self._render_image(cid, size)
+        writer = self.cache.begin(key, THUMBNAIL_CONTENT_TYPE, len(data))
+        if writer is None:
+            raise ThumbnailUnavailable(500, "Thumbnail cache is not writable")
+        writer.write(data)
+        if not writer.commit():
+            raise ThumbnailUnavailable(500, "Thumbnail cache is not writable")
+        with self.lock:
+            self.stats["generated"] += 1
+            self.stats["images" if kind != "video" else "videos"] += 1
+            self.stats["thumbnail_bytes"] += len(data)
+        return self.cache.lookup(key)
+
+    def _original(self, cid, dest):
+        """Path to the original bytes: the content cache, our own node, else a gateway"""
+        cached = content_cache.lookup(cid)
+        if cached:
+            if cached["size"] > THUMBNAIL_MAX_SOURCE:
+                raise ThumbnailUnavailable(413, "Original is too large to thumbnail")
+            self._count("source_bytes", cached["size"])
+            return cached["path"]
+
+        if local_content.size_if_local(cid) is not None:
+            stream = ipfs_public.cat(cid, offline=True)
+            source, close = stream, stream.close
+        else:
+            response, _ = try_multiple_gateways(cid, 'stream')
+            if response is None or response.status_code != 200:
+                raise ThumbnailUnavailable(502, "Original could not be fetched")
+            source, close = response.iter_content(chunk_size=STREAM_CHUNK_SIZE), response.close
+
+        written = 0
+        try:
+            with open(dest, 'wb') as f:
+                for chunk in source:
+                    written += len(chunk)
+                    if written > THUMBNAIL_MAX_SOURCE:
+                        raise ThumbnailUnavailable(413, "Original is too large to thumbnail")
+                    f.write(chunk)
+        finally:
+            close()
+        self._count("source_bytes", written)
+        return dest
+
+    def _with_original(self, cid, render):
+        """render(path) on the original, which is removed afterwards if it had to be fetched"""
+        # Named like a partial write so the cache's startup sweep removes strays
+        scratch = os.path.join(THUMBNAIL_CACHE_DIR, f"source.part-{uuid.uuid4().hex}")
+        try:
+            return render(self._original(cid, scratch))
+        finally:
+            try:
+                os.remove(scratch)
+            except OSError:
+                pass
+
+    def _render_image(self, cid, size):
+        if PILImage is None:
+            raise ThumbnailUnavailable(501, "Image thumbnails need Pillow")
+
+        def render(path):
+            with PILImage.open(path) as img:
+                # JPEG can decode straight at a reduced scale, which is most of the win
+                img.draft("RGB", (size, size))
+                img = PILImageOps.exif_transpose(img)
+                img.thumbnail((size, size))
+                if img.mode not in ("RGB", "L") and (THUMBNAIL_FORMAT == "JPEG" or img.mode not in ("RGBA", "LA")):
+                    img = img.convert("RGB" if THUMBNAIL_FORMAT == "JPEG" else "RGBA")
+                out = io.BytesIO()
+                img.save(out, THUMBNAIL_FORMAT, quality=80)
+                return out.getvalue()
+
+        return self._with_original(cid, render)
+
+    def _render_video(self, cid, size):
+        if FFMPEG_PATH is None:
+            raise ThumbnailUnavailable(501, "Poster frames need ffmpeg")
+        scale = f"scale={size}:{size}:force_original_aspect_ratio=decrease"
+        codec = ["-c:v", "libwebp"] if THUMBNAIL_FORMAT == "WEBP" else ["-c:v", "mjpeg", "-q:v", "5"]
+
+        def render(path):
+            with open(path, 'rb') as f:
+                demuxer = THUMBNAIL_VIDEO_DEMUXERS.get(sniff_mime(f.read(SNIFF_BYTES)).lower())
+            if demuxer is None:
+                raise ThumbnailUnavailable(415, "Not a video container poster frames are made from")
+            # Local file only: no network or nested protocols, and no format probing
+            source = ["-protocol_whitelist", "file", "-f", demuxer, "-i", "file:" + path]
+            error = "no frame"
+            # Skip the (often black) first second when the video is long enough
+            for seek in ("1", "0"):
+                try:
+                    result = subprocess.run(
+                        [FFMPEG_PATH, "-v", "error", "-ss", seek] + source + ["-frames:v", "1",
+                         "-vf", scale] + codec + ["-f", "image2pipe", "pipe:1"],
+                        capture_output=True, timeout=THUMBNAIL_FFMPEG_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    error = "ffmpeg timed out"
+                    break
+                if result.returncode == 0 and result.stdout:
+                    return result.stdout
+                error = result.stderr.decode(errors="replace").strip()[-200:] or error
+            raise ThumbnailUnavailable(415, f"No poster frame: {error}")
+
+        return self._with_original(cid, render)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update(self.jobs.snapshot())
+        stats.update({
+            "images_enabled": PILImage is not None,
+            "videos_enabled": FFMPEG_PATH is not None,
+            "format": THUMBNAIL_FORMAT,
+            "cache": self.cache.snapshot()
+        })
+        return stats
+
+thumbnails = ThumbnailService(ContentCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES), THUMBNAIL_WORKERS)
+
+@app.route("/thumbnail/<path:cid>")
+def thumbnail(cid):
+    """Small preview for folder tiles: ?size=128|256|512&kind=image|video (or &filename=)"""
+    decoded_cid = unquote(cid.strip("/"))
+    try:
+        requested = int(request.args.get("size", THUMBNAIL_DEFAULT_SIZE))
+    except ValueError:
+        return jsonify({"error": "size must be an integer"}), 400
+    # Snap to a few sizes so the cache holds at most three variants per CID
+    size = next((s for s in THUMBNAIL_SIZES if s >= requested), THUMBNAIL_SIZES[-1])
+    kind = request.args.get("kind") or get_file_preview_info(request.args.get("filename", ""))["preview_type"]
+    if kind not in ("image", "video"):
+        kind = "image"
+    if not thumbnail_kind_available(kind):
+        return jsonify({"error": f"{kind.capitalize()} thumbnails are not available on this server"}), 501
+
+    etag = cid_etag(decoded_cid, f"thumb-{kind}{size}")
+    not_modified = conditional_not_modified(request, etag)
+    if not_modified:
+        return not_modified
+
+    try:
+        entry = thumbnails.get(decoded_cid, size, kind)
+    except ThumbnailUnavailable as e:
+        return job_unavailable_response(e)
+
+    response = send_file(entry["path"], mimetype=entry["content_type"], conditional=False, etag=False)
+    response.headers.update({"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL, "X-Thumbnail-Size": str(size)})
+    return response
+
 # ---------- Preview Content (for inline viewing) ----------
 @app.route("/preview")
 def preview_content():
@@ -1590,35 +6352,29 @@ def preview_content():
         cid = cid.strip("/")
         decoded_cid = unquote(cid)
 
-        # Use multiple gateways with streaming
-        r, used_gateway = try_multiple_gateways(decoded_cid, 'stream')
-
-        if r.status_code != 200:
-            return f"Error fetching content: {r.status_code}", 404
-
-        content_type = r.headers.get("Content-Type", "application/octet-stream")
-        content_length = r.headers.get("Content-Length", 0)
+        not_modified = conditional_not_modified(request, cid_etag(decoded_cid))
+        if not_modified:
+            track_view(decoded_cid, request, "not_modified")
+            return not_modified
 
-        # Track the view
-        track_view(decoded_cid, request, used_gateway)
+        # Serve from the content cache, else stream from the best gateway
+        content = open_cid_content(decoded_cid, requested_range(request, decoded_cid))
+        try:
+            used_gateway = content["source"]
+            content_type = content["content_type"]
 
-        # Stream the content directly WITHOUT download headers
-        def generate():
-            try:
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-            except Exception as e:
-                yield f"Stream error: {str(e)}".encode()
+            # Track the view
+            track_view(decoded_cid, request, used_gateway)
 
-        return Response(
-            generate(),
-            content_type=content_type,
-            headers={
+            # Stream the content directly WITHOUT download headers
+            return content_response(content, content_type, {
                 # NO Content-Disposition header - this allows inline viewing
-                "Cache-Control": "public, max-age=3600",
+                "Cache-Control": IMMUTABLE_CACHE_CONTROL,
                 "X-Gateway-Used": used_gateway
-            }
-        )
+            })
+        except Exception:
+            release_content(content)
+            raise
 
     except Exception as e:
         return f"Server error: {str(e)}", 500
@@ -1637,39 +6393,32 @@ def download_content():
         cid = cid.strip("/")
         decoded_cid = unquote(cid)
 
-        r, used_gateway = try_multiple_gateways(decoded_cid, 'stream')
-
-        if r.status_code != 200:
-            return f"Error fetching content: {r.status_code}", 404
+        not_modified = conditional_not_modified(request, cid_etag(decoded_cid))
+        if not_modified:
+            return not_modified
 
-        content_type = r.headers.get("Content-Type", "application/octet-stream")
-        content_length = r.headers.get("Content-Length", 0)
-
-        # Track the download
-        track_download(decoded_cid, request, used_gateway, int(content_length) if content_length else 0)
+        content = open_cid_content(decoded_cid, requested_range(request, decoded_cid))
+        try:
+            used_gateway = content["source"]
+            content_type = content["content_type"]
 
-        # Use custom filename if provided
-        if filename:
-            final_filename = filename
-        else:
-            ext = get_extension(content_type)
-            final_filename = f"{cid}{ext}"
+            # Track the download
+            track_download(decoded_cid, request, used_gateway, content["content_length"] or 0)
 
-        def generate():
-            try:
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-            except Exception as e:
-                yield f"Stream error: {str(e)}".encode()
+            # Use custom filename if provided
+            if filename:
+                final_filename = filename
+            else:
+                ext = get_extension(content_type)
+                final_filename = f"{cid}{ext}"
 
-        return Response(
-            generate(),
-            content_type=content_type,
-            headers={
+            return content_response(content, content_type, {
                 "Content-Disposition": f'attachment; filename="{final_filename}"',  # Force download
                 "X-Gateway-Used": used_gateway
-            }
-        )
+            })
+        except Exception:
+            release_content(content)
+            raise
 
     except Exception as e:
         return f"Server error: {str(e)}", 500
@@ -1688,88 +6437,101 @@ def get_content():
         cid = cid.strip("/")
         decoded_cid = unquote(cid)
 
-        r, used_gateway = try_multiple_gateways(decoded_cid, 'stream')
-
-        if r.status_code != 200:
-            return f"Error fetching content: {r.status_code}", 404
-
-        content_type = r.headers.get("Content-Type", "application/octet-stream")
-        content_length = r.headers.get("Content-Length", 0)
+        not_modified = conditional_not_modified(request, cid_etag(decoded_cid))
+        if not_modified:
+            track_view(decoded_cid, request, "not_modified")
+            return not_modified
 
-        track_view(decoded_cid, request, used_gateway)
+        content = open_cid_content(decoded_cid, requested_range(request, decoded_cid))
+        try:
+            used_gateway = content["source"]
+            content_type = content["content_type"]
 
-        if filename:
-            final_filename = filename
-        else:
-            ext = get_extension(content_type)
-            final_filename = f"{cid}{ext}"
+            track_view(decoded_cid, request, used_gateway)
 
-        def generate():
-            try:
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-            except Exception as e:
-                yield f"Stream error: {str(e)}".encode()
-
-        # Check if it's a PDF or other previewable content
-        if content_type == 'application/pdf' or content_type.startswith('image/') or content_type.startswith('video/'):
-            # Return without download headers for inline viewing
-            return Response(
-                generate(),
-                content_type=content_type,
-                headers={
-                    "Cache-Control": "public, max-age=3600",
+            if filename:
+                final_filename = filename
+            else:
+                ext = get_extension(content_type)
+                final_filename = f"{cid}{ext}"
+
+            # Check if it's a PDF or other previewable content
+            if content_type == 'application/pdf' or content_type.startswith('image/') or content_type.startswith('video/'):
+                # Return without download headers for inline viewing
+                return content_response(content, content_type, {
+                    "Cache-Control": IMMUTABLE_CACHE_CONTROL,
                     "X-Gateway-Used": used_gateway
-                }
-            )
-        else:
-            # Force download for other file types
-            return Response(
-                generate(),
-                content_type=content_type,
-                headers={
+                })
+            else:
+                # Force download for other file types
+                return content_response(content, content_type, {
                     "Content-Disposition": f'attachment; filename="{final_filename}"',
                     "X-Gateway-Used": used_gateway
-                }
-            )
+                })
+        except Exception:
+            release_content(content)
+            raise
 
     except Exception as e:
         return f"Server error: {str(e)}", 500
 
 # ---------- Private Preview ----------
+PRIVATE_STAT_TIMEOUT = 10
+
+def private_content_type(cid):
+    """Sniffed MIME of a private file, cached per CID like local public content"""
+    cached = metadata_store.get(cid, ("mime",), counters=MIME_COUNTERS)
+    if cached:
+        return cached["mime"]
+    head = ipfs_private.cat(cid, length=SNIFF_BYTES, timeout=PRIVATE_STAT_TIMEOUT, offline=True).read_all()
+    mime_type = sniff_mime(head) if head else "application/octet-stream"
+    metadata_store.put(cid, source="private_node", mime=mime_type)
+    return mime_type
+
 @app.route('/preview-private/<cid>', methods=['GET'])
 def preview_private(cid):
     try:
-        track_view(cid, request, "private_ipfs")
+        etag = cid_etag(cid, "private")
+        not_modified = conditional_not_modified(request, etag, PRIVATE_IMMUTABLE_CACHE_CONTROL)
+        if not_modified:
+            track_view(cid, request, "private_ipfs")
+            return not_modified
 
-        ipfs_env = os.environ.copy()
-        ipfs_env["IPFS_PATH"] = os.path.expanduser("~/.ipfs-private")
-
-        result = subprocess.run(
-            ["ipfs", "cat", cid],
-            env=ipfs_env,
-            capture_output=True,
-            check=True,
-            timeout=120
-        )
-        content = result.stdout
+        try:
+            stat = ipfs_private.files_stat(cid, timeout=PRIVATE_STAT_TIMEOUT, offline=True)
+        except IPFSTimeout:
+            raise
+        except IPFSError as e:
+            return jsonify({"error": "Private CID not found", "details": e.details}), 404
+        if stat.get("Type") != "file":
+            return jsonify({"error": "Private CID is not a file"}), 400
+        size = stat.get("Size") or 0
 
-        mime = magic.Magic(mime=True)
-        mime_type = mime.from_buffer(content[:1024])
+        track_view(cid, request, "private_ipfs")
 
+        mime_type = private_content_type(cid)
         extension = mimetypes.guess_extension(mime_type) or ''
+        headers = {
+            "Content-Disposition": f'inline; filename="{cid}{extension}"',
+            "ETag": etag,
+            "Cache-Control": PRIVATE_IMMUTABLE_CACHE_CONTROL,
+            "Accept-Ranges": "bytes"
+        }
 
-        return Response(
-            content,
-            content_type=mime_type,
-            headers={
-                "Content-Disposition": f'inline; filename="{cid}{extension}"'
-            }
-        )
-    except subprocess.CalledProcessError as e:
-        return jsonify({"error": "Failed to read private CID", "details": e.stderr.decode()}), 500
-    except subprocess.TimeoutExpired:
+        range_header = requested_range(request, cid, etag)
+        ranges = parse_byte_ranges(range_header, size) if range_header else None
+        if ranges is not None:
+            return byte_ranges_response(
+                lambda start, end: local_node_body(cid, start, end - start + 1, client=ipfs_private),
+                ranges, size, mime_type, headers)
+
+        # Streamed straight from the node, so memory stays at a few chunks whatever the size
+        headers["Content-Length"] = str(size)
+        return Response(local_node_body(cid, client=ipfs_private), content_type=mime_type, headers=headers)
+    except IPFSTimeout:
         return jsonify({"error": "Request timeout - content too large or not available"}), 408
+    except IPFSError as e:
+        return jsonify({"error": "Failed to read private CID", "details": e.details}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -2047,6 +6809,27 @@ def get_realtime_analytics():
         return jsonify({"error": str(e)}), 500
 
 # ---------- Health Check ----------
+def subsystem_stats():
+    """Snapshots reported by /health whether or not a gateway answers"""
+    return {
+        "content_cache": content_cache.snapshot(),
+        "metadata_cache": metadata_store.snapshot(),
+        "coalescing": get_coalesce_stats(),
+        "ipfs": {"public": ipfs_public.snapshot(), "private": ipfs_private.snapshot()},
+        "directory_index": directory_index.snapshot(),
+        "dag_index": dag_indexer.snapshot(),
+        "resolver": path_resolver.snapshot(),
+        "prefetch": prefetcher.snapshot(),
+        "local_node": local_content.snapshot(),
+        "upload_sessions": upload_sessions.snapshot(),
+        "upload_jobs": upload_jobs.snapshot(),
+        "provide": provide_scheduler.snapshot(),
+        "dedup": content_hashes.snapshot(),
+        "admission": {visibility: controller.snapshot() for visibility, controller in upload_admission.items()},
+        "thumbnails": thumbnails.snapshot(),
+        "text_preview": text_previews.snapshot()
+    }
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Health check endpoint"""
@@ -2058,13 +6841,15 @@ def health_check():
             "status": "healthy",
             "primary_gateway": CURRENT_GATEWAY,
             "gateway_used": used_gateway,
-            "response_code": head_res.status_code
+            "response_code": head_res.status_code,
+            **subsystem_stats()
         }), 200
     except Exception as e:
         return jsonify({
             "status": "unhealthy",
             "error": str(e),
-            "primary_gateway": CURRENT_GATEWAY
+            "primary_gateway": CURRENT_GATEWAY,
+            **subsystem_stats()
         }), 503
 
 if __name__ == "__main__":
@@ -36,6 +36,7 @@ import {
 } from '@heroicons/react/24/solid';
 
 const API_BASE = "https://silver-dec-v4-ubdd.onrender.com";
+const HASH_MAX_BYTES = 256 * 1024 * 1024;
 
 // Error Boundary Component
 class ErrorBoundary extends React.Component {
@@ -631,6 +632,18 @@ const NexusBrowser = ({ darkMode }) => {
     }
   };
 
+  const hashFile = async (file) => {
+    // Hashing reads the whole file into memory, so only do it for modest sizes
+    if (!window.crypto?.subtle || file.size > HASH_MAX_BYTES) return null;
+    try {
+      const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+      return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    } catch (err) {
+      console.warn("⚠️ Could not hash file before upload:", err);
+      return null;
+    }
+  };
+
   const handleFileUpload = async (e) => {
     const files = Array.from(e.target.files);
     if (!files.length) return;
@@ -645,16 +658,34 @@ const NexusBrowser = ({ darkMode }) => {
       await handleFolderUpload(files);
     } else {
       const file = files[0];
-      const formData = new FormData();
-      formData.append('file', file);
-      formData.append('visibility', visibility);
 
       try {
-        const res = await fetch(`${API_BASE}/upload`, {
-          method: 'POST',
-          body: formData,
-        });
-        const data = await res.json();
+        const sha256 = await hashFile(file);
+        let data = null;
+        if (sha256) {
+          // Content the server already has doesn't need to be sent again
+          const known = await fetch(
+            `${API_BASE}/upload/check?sha256=${sha256}&size=${file.size}&visibility=${encodeURIComponent(visibility)}`
+          ).then(res => res.ok ? res.json() : null).catch(() => null);
+          if (known?.cid) data = known;
+        }
+
+        if (!data) {
+          // Visibility and hash go first so the server can stream the file straight into IPFS
+          const formData = new FormData();
+          formData.append('visibility', visibility);
+          if (sha256) formData.append('sha256', sha256);
+          formData.append('file', file);
+
+          const res = await fetch(`${API_BASE}/upload?visibility=${encodeURIComponent(visibility)}`, {
+            method: 'POST',
+            body: formData,
+          });
+          data = await res.json();
+          if (res.status === 429 || res.status === 503) {
+            throw new Error(`Server is busy, please retry in ${data.retry_after}s`);
+          }
+        }
         if (data.cid) {
           setUploadedCid(data.cid);
           saveCidToHistory(data.cid);
@@ -665,31 +696,57 @@ const NexusBrowser = ({ darkMode }) => {
         }
       } catch (err) {
         console.error("Upload failed:", err);
-        alert("❌ Upload failed.");
+        alert(`❌ Upload failed: ${err.message}`);
       }
     }
 
     setUploading(false);
   };
 
+  const waitForUploadJob = async (jobId, totalFiles) => {
+    // Folder adds run as background jobs on the server; poll until the job finishes
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const res = await fetch(`${API_BASE}/jobs/${jobId}`);
+      const job = await res.json();
+      if (!res.ok) throw new Error(job.error || "Upload job not found");
+      if (job.state === 'done') return job.result;
+      if (job.state === 'failed') throw new Error(job.details ? `${job.error}: ${job.details}` : job.error);
+      if (job.bytes_total) {
+        setFolderUploadProgress(prev => ({
+          ...prev,
+          current: Math.floor(totalFiles * job.bytes_processed / job.bytes_total),
+          status: 'processing'
+        }));
+      }
+    }
+  };
+
   const handleFolderUpload = async (files) => {
     try {
       setFolderUploadProgress({ current: 0, total: files.length, status: 'uploading' });
       
+      // Fields go ahead of each file so the server can write it straight into place
       const formData = new FormData();
+      formData.append('visibility', visibility);
+      formData.append('type', 'folder');
       files.forEach((file, index) => {
-        formData.append('files', file);
         formData.append(`paths_${index}`, file.webkitRelativePath || file.name);
+        formData.append('files', file);
       });
-      formData.append('visibility', visibility);
-      formData.append('type', 'folder');
 
-      const res = await fetch(`${API_BASE}/upload-folder`, {
+      const res = await fetch(`${API_BASE}/upload-folder?async=1&visibility=${encodeURIComponent(visibility)}`, {
         method: 'POST',
         body: formData,
       });
 
-      const data = await res.json();
+      let data = await res.json();
+      if (res.status === 429 || res.status === 503) {
+        throw new Error(`Server is busy, please retry in ${data.retry_after}s`);
+      }
+      if (data.job_id) {
+        data = await waitForUploadJob(data.job_id, files.length);
+      }
       
       if (data.success) {
         if (data.folderCid) {
@@ -348,6 +348,7 @@ const SearchResults = ({ darkMode }) => {
 
   // Enhanced folder item component with FIXED size display
   const FolderItem = ({ item, index }) => {
+    const [thumbnailFailed, setThumbnailFailed] = useState(false);
     const isSelected = selectedItems.has(item.name);
     const fileInfo = getFileTypeInfo(item);
     const IconComponent = fileInfo.icon;
@@ -529,9 +530,20 @@ const SearchResults = ({ darkMode }) => {
         
         <div className="text-center pt-4">
           <div className="flex justify-center mb-3">
-            <div className={`p-4 rounded-2xl ${fileInfo.bgColor} transition-all duration-200 group-hover:scale-110`}>
-              <IconComponent className={`w-8 h-8 ${fileInfo.color}`} />
-            </div>
+            {item.thumbnail_url && !thumbnailFailed ? (
+              // Small server-side thumbnail instead of the full-size original
+              <img
+                src={`${API_BASE}${item.thumbnail_url}`}
+                alt={item.name}
+                loading="lazy"
+                onError={() => setThumbnailFailed(true)}
+                className="w-24 h-24 object-cover rounded-2xl transition-all duration-200 group-hover:scale-105"
+              />
+            ) : (
+              <div className={`p-4 rounded-2xl ${fileInfo.bgColor} transition-all duration-200 group-hover:scale-110`}>
+                <IconComponent className={`w-8 h-8 ${fileInfo.color}`} />
+              </div>
+            )}
           </div>
           
           <h3 className={`font-medium text-sm mb-2 line-clamp-2 px-2 ${
@@ -1458,7 +1470,8 @@ const SearchResults = ({ darkMode }) => {
                 modified: entry.modified || entry.last_modified,
                 created: entry.created || entry.created_at,
                 item_count: entry.item_count, // For directories
-                fileSize: entry.fileSize || entry.size // Additional fallback
+                fileSize: entry.fileSize || entry.size, // Additional fallback
+                thumbnail_url: entry.thumbnail_url || null
               }));
               setEntries(enhancedEntries);
             }